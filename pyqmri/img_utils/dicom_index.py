@@ -0,0 +1,117 @@
+__author__ = 'Dharshan Chandramohan'
+
+import os
+import json
+import sqlite3
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    header TEXT
+)"""
+
+# sqlite's default limit on host parameters is 999
+_QUERY_CHUNK = 900
+
+def default_index_path():
+    """Central DICOM header index ($PYQMRI_CACHE/dicom_index.sqlite, default ~/.cache/pyqmri/dicom_index.sqlite)"""
+    root = os.environ.get('PYQMRI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pyqmri'))
+    return os.path.join(root, 'dicom_index.sqlite')
+
+class DICOMIndex(object):
+    """Persistent (SQLite) cache of parsed DICOM headers
+
+    Entries are keyed by absolute file path and validated against the file
+    size and mtime, so only new or modified files are parsed again. A header
+    is any JSON serializable dict (the loaders store the sort keys, geometry
+    and pixel data offset); files that are not DICOM are cached as None so
+    they are skipped without being reopened.
+
+    The index can be one central file (default) or one file per exam
+    directory, e.g. DICOMIndex(os.path.join(dirname, '.pyqmri_index.sqlite')).
+    """
+    def __init__(self, path=None):
+        self.path = default_index_path() if path is None else path
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    def _cached(self, paths):
+        rows = {}
+        for ii in range(0, len(paths), _QUERY_CHUNK):
+            chunk = paths[ii:ii + _QUERY_CHUNK]
+            query = 'SELECT path, size, mtime_ns, header FROM headers WHERE path IN ({:s})'.format(
+                ','.join('?' * len(chunk)))
+            for path, size, mtime_ns, header in self._conn.execute(query, chunk):
+                rows[path] = (size, mtime_ns, header)
+        return rows
+
+    def headers(self, fnames, parse, map_fn=map):
+        """Headers of fnames, parsing only files that are not (validly) indexed
+
+        @param fnames :: list of file names
+        @param parse :: parse(fname) -> header dict, or None if not a DICOM file
+        @param map_fn :: map used for the files that need parsing (e.g., ThreadPoolExecutor.map)
+
+        @return headers :: list of header dicts (None for non-DICOM files), in the order of fnames
+        """
+        paths = [os.path.abspath(fname) for fname in fnames]
+        stats = [os.stat(path) for path in paths]
+        rows = self._cached(paths)
+
+        out = [None] * len(paths)
+        stale = []
+        for ii, (path, st) in enumerate(zip(paths, stats)):
+            row = rows.get(path)
+            if (row is not None) and (row[0] == st.st_size) and (row[1] == st.st_mtime_ns):
+                out[ii] = None if row[2] is None else json.loads(row[2])
+                # the stored name may be relative to another working directory
+                if (out[ii] is not None) and ('fname' in out[ii]):
+                    out[ii]['fname'] = fnames[ii]
+            else:
+                stale.append(ii)
+
+        if stale:
+            parsed = list(map_fn(parse, [fnames[ii] for ii in stale]))
+            entries = []
+            for ii, hdr in zip(stale, parsed):
+                out[ii] = hdr
+                entries.append((paths[ii], stats[ii].st_size, stats[ii].st_mtime_ns,
+                                None if hdr is None else json.dumps(hdr)))
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)', entries)
+
+            # Parsed dicts go through the same JSON round trip as cached ones
+            for ii in stale:
+                if out[ii] is not None:
+                    out[ii] = json.loads(json.dumps(out[ii]))
+
+        return out
+
+    def prune(self):
+        """Remove entries of files that no longer exist
+
+        @return n_removed :: number of removed entries
+        """
+        missing = [(path,) for (path,) in self._conn.execute('SELECT path FROM headers')
+                   if not os.path.exists(path)]
+        with self._conn:
+            self._conn.executemany('DELETE FROM headers WHERE path = ?', missing)
+        return len(missing)
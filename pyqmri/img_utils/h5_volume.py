@@ -0,0 +1,186 @@
+__author__ = 'Dharshan Chandramohan'
+
+import numpy as np
+import h5py
+
+# Axis names of the reconstructions written by the MATLAB recon (v7.3 .mat files
+# are stored transposed, so h5py sees [echo, coil, z, y, x])
+DEFAULT_AXES = {
+    3 : ('z', 'y', 'x'),
+    4 : ('echo', 'z', 'y', 'x'),
+    5 : ('echo', 'coil', 'z', 'y', 'x'),
+}
+
+def complex_dtype_of(dtype):
+    """Complex dtype with the memory layout of a {real, imag} compound dtype
+
+    @return cplx_dtype :: numpy complex dtype, or None if dtype is not a plain {real, imag} pair
+    """
+    if (dtype.names is None) or (len(dtype.names) != 2) or (set(dtype.names) != {'real', 'imag'}):
+        return None
+
+    f_real, f_imag = dtype.fields['real'], dtype.fields['imag']
+    if (f_real[0] != f_imag[0]) or (f_real[0].kind != 'f'):
+        return None
+
+    cplx_dtype = np.dtype('c{:d}'.format(2 * f_real[0].itemsize)).newbyteorder(f_real[0].byteorder)
+    if (f_real[1] != 0) or (f_imag[1] != f_real[0].itemsize) or (dtype.itemsize != cplx_dtype.itemsize):
+        return None
+    return cplx_dtype
+
+class ReconVolume(object):
+    """Lazy accessor for complex reconstructions stored in HDF5 / MATLAB v7.3 files ('imall')
+
+    Nothing is read on construction; indexing reads only the selected
+    hyperslab. The {real, imag} compound dtype is presented as a complex view
+    of the buffer h5py reads into (no per-voxel conversion or extra copy), and
+    uncompressed contiguous datasets can be memory mapped (memmap()).
+
+    Usage:
+        with ReconVolume('data/recon_multi-ute.mat') as vol:
+            echo0 = vol.select(echo=0, coil=0)      # [z, y, x] complex64
+            for z0, z1, slab in vol.iter_slabs(coil=0):
+                ...                                  # slab: [echo, z1 - z0, y, x]
+    """
+    def __init__(self, fname, dataset='imall', axes=None):
+        self.fname = fname
+        self._file = h5py.File(fname, 'r')
+        self._ds = self._file[dataset]
+
+        self.shape = self._ds.shape
+        self.ndim = len(self.shape)
+        self.chunks = self._ds.chunks
+        self.axes = tuple(axes) if axes is not None else DEFAULT_AXES.get(
+            self.ndim, tuple('ax{:d}'.format(ii) for ii in range(self.ndim)))
+        if len(self.axes) != self.ndim:
+            raise Exception('Expected {:d} axis names, got {:s}'.format(self.ndim, str(self.axes)))
+
+        self._mag_cache = {}
+        self._cplx_dtype = complex_dtype_of(self._ds.dtype)
+        self.is_complex = (self._ds.dtype.names is not None) or (self._ds.dtype.kind == 'c')
+        if self._cplx_dtype is not None:
+            self.dtype = self._cplx_dtype
+        elif self._ds.dtype.names is not None:
+            self.dtype = np.result_type(self._ds.dtype.fields['real'][0], np.complex64)
+        else:
+            self.dtype = self._ds.dtype
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _as_complex(self, raw):
+        if raw.dtype.names is None:
+            return raw
+        if self._cplx_dtype is not None:
+            return raw.view(self._cplx_dtype)
+        # e.g., fields stored imag first: needs a real conversion
+        cplx = np.empty(raw.shape, dtype=self.dtype)
+        cplx.real = raw['real']
+        cplx.imag = raw['imag']
+        return cplx
+
+    def __getitem__(self, key):
+        """Read a hyperslab (h5py/numpy basic indexing) as a complex array"""
+        raw = self._ds[key]
+        if np.ndim(raw) == 0:
+            raw = np.asarray(raw).reshape(1)
+            return self._as_complex(raw)[0]
+        return self._as_complex(raw)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        return data if dtype is None else data.astype(dtype)
+
+    def axis_index(self, name):
+        if name not in self.axes:
+            raise Exception('No axis named {:s} (axes: {:s})'.format(name, str(self.axes)))
+        return self.axes.index(name)
+
+    def _key(self, **sel):
+        key = [slice(None)] * self.ndim
+        for name, idx in sel.items():
+            if idx is not None:
+                key[self.axis_index(name)] = idx
+        return tuple(key)
+
+    def select(self, **sel):
+        """Read by axis name, e.g. select(echo=slice(0, 4), coil=0, z=slice(10, 20))"""
+        return self[self._key(**sel)]
+
+    def magnitude(self, **sel):
+        """Magnitude of a selection (see select), computed slab by slab and cached on the accessor"""
+        key = repr(sorted(sel.items()))
+        if key not in self._mag_cache:
+            if ('z' in self.axes) and (sel.get('z') is None):
+                kept = [name for name in self.axes if not isinstance(sel.get(name), (int, np.integer))]
+                zi = kept.index('z')
+                mag = None
+                for z0, z1, block in self.iter_slabs(self.chunk_aligned_size('z', 16), **sel):
+                    if mag is None:
+                        mag_shape = list(block.shape)
+                        mag_shape[zi] = self.shape[self.axis_index('z')]
+                        mag = np.empty(mag_shape, dtype=np.abs(block.ravel()[:1]).dtype)
+                    idx = [slice(None)] * block.ndim
+                    idx[zi] = slice(z0, z1)
+                    mag[tuple(idx)] = np.abs(block)
+            else:
+                mag = np.abs(self.select(**sel))
+            self._mag_cache[key] = mag
+        return self._mag_cache[key]
+
+    def clear_cache(self):
+        self._mag_cache.clear()
+
+    def chunk_aligned_size(self, axis, size=None):
+        """Block size along axis rounded to a whole number of HDF5 chunks"""
+        ai = self.axis_index(axis) if isinstance(axis, str) else axis
+        step = self.chunks[ai] if self.chunks is not None else 1
+        if size is None:
+            return step
+        return max(step, (int(size) // step) * step)
+
+    def iter_blocks(self, axis, size=None, **sel):
+        """Iterate over chunk-aligned blocks along one axis
+
+        @param axis :: axis name (or index)
+        @param size :: requested block length (rounded down to a multiple of the chunk length)
+        @param sel :: fixed selection on the other axes (see select)
+
+        @return generator of (start, stop, block)
+        """
+        ai = self.axis_index(axis) if isinstance(axis, str) else axis
+        step = self.chunk_aligned_size(ai, size)
+        key = list(self._key(**sel))
+        if key[ai] != slice(None):
+            raise Exception('Cannot iterate over an axis that is also selected')
+
+        for i0 in range(0, self.shape[ai], step):
+            i1 = min(i0 + step, self.shape[ai])
+            key[ai] = slice(i0, i1)
+            yield i0, i1, self[tuple(key)]
+
+    def iter_slabs(self, slab_size=None, **sel):
+        """Iterate over chunk-aligned z slabs (see iter_blocks)"""
+        return self.iter_blocks('z', slab_size, **sel)
+
+    def iter_echoes(self, **sel):
+        """Iterate over echoes, yielding (echo index, volume)"""
+        for e0, e1, block in self.iter_blocks('echo', None, **sel):
+            for ei in range(e1 - e0):
+                yield e0 + ei, block[ei]
+
+    def memmap(self):
+        """Memory-mapped complex view of an uncompressed, contiguous dataset (zero copy)"""
+        offset = self._ds.id.get_offset()
+        if (self.chunks is not None) or (offset is None):
+            raise Exception('Only contiguous (unchunked, uncompressed) datasets can be memory mapped')
+        return np.memmap(self.fname, dtype=self.dtype, mode='r', offset=offset, shape=self.shape)
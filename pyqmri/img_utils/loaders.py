@@ -2,11 +2,266 @@ __author__ = 'Dharshan Chandramohan'
 
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
 
-def load_DICOM_from_dcm_list(dcmlist):
-    pass
+from .dicom_index import DICOMIndex
 
-def load_DICOM_from_ordered_dir(dirname):
-    pass
+def load_ute_list(fname, scale=1.0):
+    """Read the echo times from a multi-echo TE list file (e.g., multi_utes.dat)
+
+    File layout: a header line (file name), a line ending with the number of
+    echoes, then one echo time per line.
+
+    @param scale :: multiplier applied to each echo time (e.g., 1e-6 for us -> s)
+    @return utes :: numpy array of echo times
+    """
+    with open(fname, 'r') as utes_file:
+        ute_info = utes_file.readlines()
+        ute_info.pop(0)
+        num_utes = int(ute_info.pop(0).split()[-1])
+
+        utes = np.array([float(ute_info[ii]) for ii in range(num_utes)])
+
+    return utes * scale
+
+def _pixel_data_layout(ds):
+    """Byte offset, numpy dtype & stored bits of natively encoded (uncompressed, single sample) pixel data
+
+    @return offset, dtype, bits :: (None, None, None) if the pixel data has to be decoded by pydicom
+    """
+    elem = ds.get_item('PixelData', keep_deferred=True)
+    tsyntax = getattr(ds, 'file_meta', {}).get('TransferSyntaxUID')
+    bits_allocated = int(ds.get('BitsAllocated', 0))
+    bits_stored = int(ds.get('BitsStored', bits_allocated) or bits_allocated)
+    if ((elem is None) or (tsyntax is None) or tsyntax.is_compressed
+        or (getattr(elem, 'value_tell', None) is None) or (elem.length == 0xFFFFFFFF)
+        or (int(ds.get('SamplesPerPixel', 1)) != 1) or (int(ds.get('NumberOfFrames', 1) or 1) != 1)
+        or (bits_allocated not in (8, 16, 32)) or not (0 < bits_stored <= bits_allocated)
+        or (int(ds.get('HighBit', bits_stored - 1)) != bits_stored - 1)):
+        return None, None, None
+
+    dtype = '{:s}{:s}{:d}'.format('<' if tsyntax.is_little_endian else '>',
+                                  'i' if int(ds.get('PixelRepresentation', 0)) else 'u',
+                                  bits_allocated // 8)
+    return int(elem.value_tell), dtype, bits_stored
+
+def _read_DICOM_header(fname):
+    """Read the sorting keys & geometry of one DICOM file (pixel data deferred, not read)
+
+    @return hdr :: dict, or None if fname is not a DICOM file
+    """
+    try:
+        ds = pydicom.dcmread(fname, defer_size=1024)
+    except (InvalidDicomError, IsADirectoryError):
+        return None
+    if 'Rows' not in ds:
+        return None
+
+    hdr = {
+        'fname' : fname,
+        'TE' : float(ds.get('EchoTime', 0.0) or 0.0),
+        'TR' : float(ds.get('RepetitionTime', 0.0) or 0.0),
+        'FA' : float(ds.get('FlipAngle', 0.0) or 0.0),
+        'rows' : int(ds.Rows),
+        'cols' : int(ds.Columns),
+        'pixel_spacing' : tuple(float(pp) for pp in ds.get('PixelSpacing', (1.0, 1.0))),
+        'slice_thickness' : float(ds.get('SliceThickness', 0.0) or 0.0),
+        'instance' : int(ds.get('InstanceNumber', 0) or 0),
+    }
+    hdr['pixel_offset'], hdr['pixel_dtype'], hdr['pixel_bits'] = _pixel_data_layout(ds)
+
+    # position along the slice normal (fall back to SliceLocation / InstanceNumber)
+    if ('ImagePositionPatient' in ds) and ('ImageOrientationPatient' in ds):
+        iop = np.array(ds.ImageOrientationPatient, dtype=np.float64)
+        hdr['slice_pos'] = float(np.dot(np.cross(iop[:3], iop[3:]),
+                                        np.array(ds.ImagePositionPatient, dtype=np.float64)))
+    elif 'SliceLocation' in ds:
+        hdr['slice_pos'] = float(ds.SliceLocation)
+    else:
+        hdr['slice_pos'] = float(hdr['instance'])
+
+    return hdr
+
+def _sort_DICOM_headers(headers):
+    """Group headers into volumes by (flip angle, echo time) and sort each volume by slice position
+
+    @return vol_keys :: sorted list of (FA, TE)
+    @return layout :: layout[vi][zi] = header of volume vi, slice zi
+    """
+    groups = {}
+    for hdr in headers:
+        groups.setdefault((hdr['FA'], hdr['TE']), []).append(hdr)
+
+    vol_keys = sorted(groups)
+    layout = [sorted(groups[kk], key=lambda hdr: (hdr['slice_pos'], hdr['instance'])) for kk in vol_keys]
+
+    if len(set(len(vv) for vv in layout)) != 1:
+        raise Exception('Unequal number of slices per echo/flip angle: {:s}'.format(
+            str({kk: len(vv) for kk, vv in zip(vol_keys, layout)})))
+    if len(set((hdr['rows'], hdr['cols']) for hdr in headers)) != 1:
+        raise Exception('Inconsistent image size within the series')
+
+    return vol_keys, layout
+
+def _acquisition_params(vol_keys, layout):
+    hdr0 = layout[0][0]
+    slice_pos = np.array([hdr['slice_pos'] for hdr in layout[0]])
+
+    dy, dx = hdr0['pixel_spacing']
+    if slice_pos.size > 1:
+        dz = float(np.median(np.diff(slice_pos)))
+    else:
+        dz = hdr0['slice_thickness']
+
+    TR = np.unique([hdr['TR'] for vv in layout for hdr in vv])
+    return {
+        'TE' : np.array([kk[1] for kk in vol_keys]),
+        'FA' : np.array([kk[0] for kk in vol_keys]),
+        'TR' : TR[0] if TR.size == 1 else TR,
+        'spacing' : (dx, dy, dz),
+        'slice_pos' : slice_pos,
+        'filenames' : [[hdr['fname'] for hdr in vv] for vv in layout],
+    }
+
+def _read_DICOM_headers(dcmlist, pool, index=None):
+    if index is None:
+        headers = pool.map(_read_DICOM_header, dcmlist)
+    else:
+        headers = index.headers(dcmlist, _read_DICOM_header, map_fn=pool.map)
+
+    headers = [hdr for hdr in headers if hdr is not None]
+    if not headers:
+        raise Exception('No DICOM images found')
+    return headers
+
+def _read_pixels(hdr):
+    # headers indexed before 'pixel_bits' was recorded are decoded by pydicom
+    if (hdr['pixel_offset'] is None) or (hdr.get('pixel_bits') is None):
+        return pydicom.dcmread(hdr['fname']).pixel_array
+    arr = np.fromfile(hdr['fname'], dtype=hdr['pixel_dtype'], count=hdr['rows'] * hdr['cols'],
+                      offset=hdr['pixel_offset']).reshape((hdr['rows'], hdr['cols']))
+
+    # BitsStored < BitsAllocated: drop the unused high bits (unsigned) or sign extend (signed), like pydicom
+    arr = arr.astype(arr.dtype.newbyteorder('='), copy=False)
+    n_unused = 8 * arr.dtype.itemsize - hdr['pixel_bits']
+    if n_unused > 0:
+        if arr.dtype.kind == 'u':
+            arr &= (1 << hdr['pixel_bits']) - 1
+        else:
+            arr = (arr << n_unused) >> n_unused
+    return arr
+
+def _open_index(index):
+    if (index is None) or isinstance(index, DICOMIndex):
+        return index, False
+    return DICOMIndex(None if index is True else index), True
+
+def load_DICOM_params(dcmlist, n_threads=None, index=None):
+    """Read only the acquisition parameters / geometry of a DICOM series (see load_DICOM_from_dcm_list)"""
+    index, owned = _open_index(index)
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            headers = _read_DICOM_headers(dcmlist, pool, index)
+    finally:
+        if owned:
+            index.close()
+
+    return _acquisition_params(*_sort_DICOM_headers(headers))
+
+def load_DICOM_from_dcm_list(dcmlist, n_threads=None, dtype=None, index=None):
+    """Load a (multi-echo and/or multi-flip angle) DICOM series into one array
+
+    Headers are read in parallel without pixel data, sorted by flip angle, echo
+    time and slice position, and the pixel data is then decoded on a thread
+    pool straight into a preallocated [echo, z, y, x] array (one 'echo' entry
+    per unique (flip angle, echo time) pair). Files that are not DICOM are skipped.
+    Uncompressed slices are read straight from the offset of their pixel data
+    (unused high bits masked / sign extended as pydicom does); everything else
+    is decoded by pydicom.
+
+    With an index (see dicom_index.DICOMIndex) the parsed headers, including
+    the pixel data offset, are kept on disk: reopening a series only parses
+    new or modified files.
+
+    @param dcmlist :: list of DICOM file names
+    @param n_threads :: number of threads (default: ThreadPoolExecutor default)
+    @param dtype :: array dtype (default: dtype of the stored pixel data)
+    @param index :: None (no index), True (central index), path of an index file, or a DICOMIndex
+
+    @return vol :: image array [echo, z, y, x]
+    @return params :: dict of acquisition parameters
+      'TE' :: echo time of each volume (ms)
+      'FA' :: flip angle of each volume (degrees)
+      'TR' :: repetition time (ms)
+      'spacing' :: voxel spacing (dx, dy, dz) in mm
+      'slice_pos' :: slice positions along the slice normal (mm)
+      'filenames' :: filenames[echo][z]
+    """
+    index, owned = _open_index(index)
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            vol_keys, layout = _sort_DICOM_headers(_read_DICOM_headers(dcmlist, pool, index))
+            params = _acquisition_params(vol_keys, layout)
+
+            first = _read_pixels(layout[0][0])
+            vol = np.empty((len(layout), len(layout[0])) + first.shape,
+                           dtype=first.dtype if dtype is None else dtype)
+
+            def decode(vi_zi):
+                vi, zi = vi_zi
+                vol[vi, zi] = _read_pixels(layout[vi][zi])
+
+            list(pool.map(decode, np.ndindex(vol.shape[:2])))
+    finally:
+        if owned:
+            index.close()
+
+    return vol, params
+
+def load_DICOM_from_ordered_dir(dirname, n_threads=None, dtype=None, index=None):
+    """Load every DICOM file in a directory (see load_DICOM_from_dcm_list)"""
+    dcmlist = [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname))
+               if not fname.startswith('.pyqmri_index')]
+    return load_DICOM_from_dcm_list(dcmlist, n_threads=n_threads, dtype=dtype, index=index)
+
+def _iter_slabs(layout, slab_size, n_threads, dtype):
+    n_vol, n_z = len(layout), len(layout[0])
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for z0 in range(0, n_z, slab_size):
+            z1 = min(z0 + slab_size, n_z)
+            first = _read_pixels(layout[0][z0])
+            slab = np.empty((n_vol, z1 - z0) + first.shape, dtype=first.dtype if dtype is None else dtype)
+
+            def decode(vi_zi):
+                vi, zi = vi_zi
+                slab[vi, zi] = _read_pixels(layout[vi][z0 + zi])
+
+            list(pool.map(decode, np.ndindex(slab.shape[:2])))
+            yield z0, z1, slab
+
+def iter_DICOM_slabs(dcmlist, slab_size=8, n_threads=None, dtype=None, index=None):
+    """Read a DICOM series slab by slab (see load_DICOM_from_dcm_list)
+
+    The headers are read (or looked up in the index) once, when this is
+    called, so the index is only used from the calling thread and the
+    returned generator can be consumed on another one (e.g., streaming.prefetch).
+    Each slab's pixel data is then decoded on demand, so only one slab is held
+    in memory. load_DICOM_params gives the matching acquisition parameters.
+
+    @param slab_size :: number of slices per slab
+
+    @return generator of (z0, z1, slab), slab :: [echo, z1 - z0, y, x]
+    """
+    index, owned = _open_index(index)
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            vol_keys, layout = _sort_DICOM_headers(_read_DICOM_headers(dcmlist, pool, index))
+    finally:
+        if owned:
+            index.close()
+
+    return _iter_slabs(layout, slab_size, n_threads, dtype)
@@ -0,0 +1,277 @@
+"""
+Streaming writers for parameter maps
+
+Each writer takes the fitted maps slab by slab (write_slab(z0, maps), e.g. as
+the sink of parameter_mapping.streaming.fit_streaming) and writes them
+straight to disk, so whole-volume maps never have to be held in memory.
+Maps are [z, y, x] arrays given in the order of map_names (or as a dict).
+
+    HDF5MapWriter   :: one chunked, compressed dataset per map
+    NIfTIMapWriter  :: one NIfTI-1 (.nii) file per map
+    DICOMMapWriter  :: one derived DICOM series per map, geometry copied from the source series
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import struct
+
+import numpy as np
+import h5py
+import pydicom
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+# Map names of the fitters' outputs, in the order they are returned
+T2STR_MAG_MAPS = ('T2str', 'K', 'N', 'status')
+T2STR_CPLX_MAPS = ('T2str', 'K', 'df_Hz', 'df_ppm', 'phi', 'status')
+T1_MAPS = ('T1', 'M0')
+
+def DICOM_affine(fnames, spacing=None):
+    """Voxel [x, y, z] -> patient (LPS, mm) affine of a sorted DICOM slice list
+
+    @param fnames :: file names of the slices, sorted by position (e.g., loader params['filenames'][0])
+    @param spacing :: (dx, dy, dz) (default: from the headers)
+    """
+    ds0 = pydicom.dcmread(fnames[0], stop_before_pixels=True)
+    iop = np.array(ds0.ImageOrientationPatient, dtype=np.float64)
+    ipp0 = np.array(ds0.ImagePositionPatient, dtype=np.float64)
+
+    if spacing is None:
+        dy, dx = [float(pp) for pp in ds0.PixelSpacing]
+        if len(fnames) > 1:
+            ipp1 = np.array(pydicom.dcmread(fnames[-1], stop_before_pixels=True).ImagePositionPatient,
+                            dtype=np.float64)
+            dz = np.linalg.norm(ipp1 - ipp0) / (len(fnames) - 1)
+        else:
+            dz = float(ds0.get('SliceThickness', 1.0))
+    else:
+        dx, dy, dz = spacing
+
+    affine = np.eye(4)
+    affine[:3, 0] = iop[:3] * dx
+    affine[:3, 1] = iop[3:] * dy
+    affine[:3, 2] = np.cross(iop[:3], iop[3:]) * dz
+    affine[:3, 3] = ipp0
+    return affine
+
+class MapWriter(object):
+    """Base class: bookkeeping of map names, dtypes & the slab interface"""
+    def __init__(self, spatial_shape, map_names, dtypes=None):
+        self.spatial_shape = tuple(spatial_shape)
+        self.map_names = tuple(map_names)
+        self.dtypes = None if dtypes is None else [np.dtype(dt) for dt in dtypes]
+        self._opened = False
+
+    def _as_list(self, maps):
+        if isinstance(maps, dict):
+            maps = [maps[name] for name in self.map_names]
+        if len(maps) != len(self.map_names):
+            raise Exception('Expected {:d} maps ({:s}), got {:d}'.format(
+                len(self.map_names), ', '.join(self.map_names), len(maps)))
+        return [np.asarray(mm) for mm in maps]
+
+    def write_slab(self, z0, maps):
+        maps = self._as_list(maps)
+        if not self._opened:
+            if self.dtypes is None:
+                self.dtypes = [mm.dtype for mm in maps]
+            self._open()
+            self._opened = True
+
+        for mi, mm in enumerate(maps):
+            if mm.shape[-2:] != self.spatial_shape[-2:] or (z0 + mm.shape[0] > self.spatial_shape[0]):
+                raise Exception('Slab of shape {:s} at z = {:d} does not fit maps of shape {:s}'.format(
+                    str(mm.shape), z0, str(self.spatial_shape)))
+            self._write(mi, z0, mm)
+
+    def __call__(self, z0, maps):
+        self.write_slab(z0, maps)
+
+    def write_volume(self, maps):
+        """Write whole-volume maps (e.g., the output of generateT2StarMap)"""
+        self.write_slab(0, maps)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class HDF5MapWriter(MapWriter):
+    """Parameter maps as datasets of one HDF5 file, chunked by slab and compressed
+
+    @param fname :: output file
+    @param spatial_shape :: (nz, ny, nx)
+    @param map_names :: dataset names (e.g., T2STR_MAG_MAPS)
+    @param dtypes :: dataset dtypes (default: dtypes of the first slab)
+    @param spacing :: (dx, dy, dz), stored as an attribute of the file
+    @param meta :: dict of extra file attributes (e.g., echo times)
+    @param slab_size :: number of slices per chunk
+    """
+    def __init__(self, fname, spatial_shape, map_names, dtypes=None, spacing=None, meta=None,
+                 slab_size=8, compression='gzip'):
+        MapWriter.__init__(self, spatial_shape, map_names, dtypes)
+        self.fname = fname
+        self.slab_size = slab_size
+        self.compression = compression
+        self._file = h5py.File(fname, 'w')
+        if spacing is not None:
+            self._file.attrs['spacing'] = np.asarray(spacing, dtype=np.float64)
+        for name, val in (meta or {}).items():
+            self._file.attrs[name] = val
+
+    def _open(self):
+        chunks = (min(self.slab_size, self.spatial_shape[0]),) + self.spatial_shape[1:]
+        self._datasets = [self._file.create_dataset(name, shape=self.spatial_shape, dtype=dt, chunks=chunks,
+                                                    compression=self.compression)
+                          for name, dt in zip(self.map_names, self.dtypes)]
+
+    def _write(self, mi, z0, mm):
+        self._datasets[mi][z0:z0 + mm.shape[0]] = mm
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+# NIfTI-1 single file (.nii) header: 348 bytes + 4 byte extension flag
+_NIFTI_HEADER = struct.Struct('<i10s18sihcc8h3f4h8f3fhcc2f2f2i80s24s2h6f12f16s4s')
+_NIFTI_VOX_OFFSET = 352
+_NIFTI_DATATYPES = {
+    np.dtype(np.uint8) : 2,
+    np.dtype(np.int16) : 4,
+    np.dtype(np.int32) : 8,
+    np.dtype(np.float32) : 16,
+    np.dtype(np.float64) : 64,
+    np.dtype(np.int8) : 256,
+    np.dtype(np.uint16) : 512,
+    np.dtype(np.uint32) : 768,
+}
+
+def _nifti_header(shape_xyz, dtype, affine, descrip=''):
+    if dtype not in _NIFTI_DATATYPES:
+        raise Exception('NIfTI output does not support dtype {:s}'.format(str(dtype)))
+
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    dim = [3] + list(shape_xyz) + [1] * 4
+    pixdim = [1.0] + list(zooms) + [0.0] * 4
+    return _NIFTI_HEADER.pack(
+        348, b'', b'', 0, 0, b'r', b'\x00', *dim,
+        0.0, 0.0, 0.0, 0, _NIFTI_DATATYPES[dtype], dtype.itemsize * 8, 0, *pixdim,
+        float(_NIFTI_VOX_OFFSET), 1.0, 0.0, 0, b'\x00', b'\x02',   # units: mm
+        0.0, 0.0, 0.0, 0.0, 0, 0, descrip.encode('ascii')[:79], b'',
+        0, 2,                                                      # sform: aligned anatomy
+        0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+        *[float(vv) for vv in affine[:3].ravel()], b'', b'n+1\x00') + b'\x00' * 4
+
+class NIfTIMapWriter(MapWriter):
+    """Parameter maps as NIfTI-1 files (<prefix>_<map name>.nii), written through a memory map
+
+    A C-ordered [z, y, x] map has the memory layout of NIfTI's x-fastest
+    [x, y, z] array, so slabs are copied into the file without reordering.
+
+    @param prefix :: output path prefix
+    @param affine :: voxel [x, y, z] -> patient affine in LPS (e.g., DICOM_affine), converted to RAS;
+                     default: diag(spacing)
+    @param spacing :: (dx, dy, dz), used when no affine is given
+    """
+    def __init__(self, prefix, spatial_shape, map_names, dtypes=None, affine=None, spacing=(1.0, 1.0, 1.0)):
+        MapWriter.__init__(self, spatial_shape, map_names, dtypes)
+        self.prefix = prefix
+        if affine is None:
+            affine = np.diag(list(spacing) + [1.0])
+        self.affine = np.diag([-1.0, -1.0, 1.0, 1.0]).dot(affine)   # LPS -> RAS
+        self.fnames = ['{:s}_{:s}.nii'.format(prefix, name) for name in self.map_names]
+
+    def _open(self):
+        self._mmaps = []
+        nz, ny, nx = self.spatial_shape
+        for fname, name, dt in zip(self.fnames, self.map_names, self.dtypes):
+            dt = np.dtype(np.uint8) if np.dtype(dt).kind == 'b' else np.dtype(dt).newbyteorder('=')
+            with open(fname, 'wb') as nii:
+                nii.write(_nifti_header((nx, ny, nz), dt, self.affine, descrip=name))
+                nii.truncate(_NIFTI_VOX_OFFSET + nx * ny * nz * dt.itemsize)
+            self._mmaps.append(np.memmap(fname, dtype=dt.newbyteorder('<'), mode='r+', offset=_NIFTI_VOX_OFFSET,
+                                         shape=self.spatial_shape))
+
+    def _write(self, mi, z0, mm):
+        self._mmaps[mi][z0:z0 + mm.shape[0]] = mm
+
+    def close(self):
+        if self._opened:
+            for mmap in self._mmaps:
+                mmap.flush()
+            self._mmaps = []
+
+class DICOMMapWriter(MapWriter):
+    """Parameter maps as derived DICOM series (one series per map, one file per slice)
+
+    Each slice is written as a copy of the matching source slice header
+    (geometry, patient & study), with a new series/instance UID, the map name
+    as series description and the map stored as 16-bit pixel data with a
+    per-slice RescaleSlope/RescaleIntercept.
+
+    @param out_dir :: output directory (one subdirectory per map)
+    @param source_fnames :: source slice files sorted by z (e.g., loader params['filenames'][0])
+    """
+    def __init__(self, out_dir, source_fnames, map_names, dtypes=None, series_number_offset=1000):
+        ds0 = pydicom.dcmread(source_fnames[0], stop_before_pixels=True)
+        spatial_shape = (len(source_fnames), int(ds0.Rows), int(ds0.Columns))
+        MapWriter.__init__(self, spatial_shape, map_names, dtypes)
+
+        self.out_dir = out_dir
+        self.source_fnames = list(source_fnames)
+        self.series_uids = [generate_uid() for name in self.map_names]
+        base_series = int(ds0.get('SeriesNumber', 0) or 0)
+        self.series_numbers = [base_series + series_number_offset + mi for mi in range(len(self.map_names))]
+
+    def _open(self):
+        for name in self.map_names:
+            os.makedirs(os.path.join(self.out_dir, name), exist_ok=True)
+
+    def _write(self, mi, z0, mm):
+        name = self.map_names[mi]
+        for zi in range(mm.shape[0]):
+            src = pydicom.dcmread(self.source_fnames[z0 + zi], stop_before_pixels=True)
+            ds = self._derived_slice(src, mi, mm[zi])
+            ds.save_as(os.path.join(self.out_dir, name, '{:s}_{:04d}.dcm'.format(name, z0 + zi)),
+                       enforce_file_format=True)
+
+    def _derived_slice(self, ds, mi, img):
+        img = np.nan_to_num(np.asarray(img, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+        if np.issubdtype(self.dtypes[mi], np.integer) or (self.dtypes[mi].kind == 'b'):
+            slope, intercept = 1.0, 0.0
+        else:
+            lo, hi = img.min(), img.max()
+            intercept = lo
+            slope = (hi - lo) / 65535.0 if hi > lo else 1.0
+        pix = np.round((img - intercept) / slope).astype(np.int32)
+        signed = pix.min() < 0
+        pix = pix.astype(np.int16 if signed else np.uint16)
+
+        for tag in ('PixelData', 'LargestImagePixelValue', 'SmallestImagePixelValue',
+                    'WindowCenter', 'WindowWidth'):
+            if tag in ds:
+                delattr(ds, tag)
+
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.SeriesInstanceUID = self.series_uids[mi]
+        ds.SeriesNumber = self.series_numbers[mi]
+        ds.SeriesDescription = self.map_names[mi]
+        ds.ImageType = ['DERIVED', 'SECONDARY', self.map_names[mi].upper()]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1 if signed else 0
+        ds.RescaleSlope = '{:.10g}'.format(slope)
+        ds.RescaleIntercept = '{:.10g}'.format(intercept)
+        ds.PixelData = pix.tobytes()
+        ds['PixelData'].VR = 'OW'
+        return ds
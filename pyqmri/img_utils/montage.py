@@ -0,0 +1,201 @@
+"""
+Headless montage / ROI outline rendering for QA reports
+
+Everything is rendered into numpy image arrays (uint8 gray or RGB) and
+written with matplotlib.image.imsave, so no figures (or display) are
+involved. ROI overlays are drawn as outlines of the 2-D slice of each mask
+that is shown, never as full-volume RGBA overlays. render_reports renders
+many reports on a process pool.
+
+Volumes are [z, y, x] (complex, {real, imag} records or magnitude); ROI
+masks are [x, y, z] as computed by the phantom classes.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from . import view_utils as vu
+
+# Outline colors (RGB), cycled over ROIs
+ROI_COLORS = (
+    (255, 0, 0), (0, 255, 0), (0, 128, 255), (255, 255, 0), (255, 0, 255),
+    (0, 255, 255), (255, 128, 0), (128, 0, 255), (0, 255, 128), (255, 0, 128),
+)
+
+def window_uint8(img, lo=None, hi=None, pct=(0.5, 99.5)):
+    """Window a real image (or stack) to uint8 (default window: percentiles pct)"""
+    img = np.asarray(img, dtype=np.float32)
+    if (lo is None) or (hi is None):
+        p_lo, p_hi = np.percentile(img, pct)
+        lo = p_lo if lo is None else lo
+        hi = p_hi if hi is None else hi
+    scale = 255.0 / (hi - lo) if hi > lo else 0.0
+    return np.clip((img - lo) * scale, 0.0, 255.0).astype(np.uint8)
+
+def tile_slices(slices, grid=None, pad=2, fill=0):
+    """Tile 2-D images (gray or RGB, possibly of different sizes) into one image
+
+    @param slices :: list of [rows, cols] or [rows, cols, 3] arrays
+    @param grid :: (n_rows, n_cols) (default: as square as possible)
+    @param pad :: padding (pixels) between tiles
+    """
+    n = len(slices)
+    if grid is None:
+        n_cols = int(np.ceil(np.sqrt(n)))
+        grid = (int(np.ceil(n / float(n_cols))), n_cols)
+    n_rows, n_cols = grid
+    if n > n_rows * n_cols:
+        raise Exception('{:d} slices do not fit a {:d}x{:d} grid'.format(n, n_rows, n_cols))
+
+    # each grid row / column is as large as its largest tile
+    heights = np.zeros(n_rows, dtype=int)
+    widths = np.zeros(n_cols, dtype=int)
+    for si, sl in enumerate(slices):
+        heights[si // n_cols] = max(heights[si // n_cols], sl.shape[0])
+        widths[si % n_cols] = max(widths[si % n_cols], sl.shape[1])
+    row0 = pad + np.concatenate(([0], np.cumsum(heights + pad)))
+    col0 = pad + np.concatenate(([0], np.cumsum(widths + pad)))
+
+    out = np.full((row0[-1], col0[-1]) + slices[0].shape[2:], fill, dtype=slices[0].dtype)
+    for si, sl in enumerate(slices):
+        r0, c0 = row0[si // n_cols], col0[si % n_cols]
+        out[r0:r0 + sl.shape[0], c0:c0 + sl.shape[1]] = sl
+    return out
+
+def select_planes(n_planes, n_tiles):
+    """Evenly spaced plane indices (at most n_tiles)"""
+    if n_planes <= n_tiles:
+        return np.arange(n_planes)
+    return np.unique(np.linspace(0, n_planes - 1, n_tiles).round().astype(int))
+
+def montage(vol, axis=0, n_tiles=20, grid=None, pad=2, pct=(0.5, 99.5)):
+    """Tile evenly spaced planes of a volume into one uint8 image
+
+    @param vol :: [z, y, x] volume (complex, records or magnitude)
+    @param axis :: axis the planes are taken along
+
+    @return img :: uint8 image
+    @return planes :: indices of the tiled planes
+    """
+    mag = vu.magnitude(vol)
+    planes = select_planes(mag.shape[axis], n_tiles)
+    stack = window_uint8(np.take(mag, planes, axis=axis), pct=pct)
+    return tile_slices([np.take(stack, pi, axis=axis) for pi in range(len(planes))], grid=grid, pad=pad), planes
+
+def mask_outline(mask2d):
+    """Boundary pixels of a 2-D mask (pixels in the mask with a 4-neighbour outside it)"""
+    mask2d = np.asarray(mask2d) > 0
+    padded = np.pad(mask2d, 1, mode='constant')
+    interior = (padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:])
+    return mask2d & ~interior
+
+def overlay_outlines(img, masks, colors=ROI_COLORS):
+    """Draw the outlines of 2-D masks onto a uint8 gray (or RGB) image
+
+    @return rgb :: [rows, cols, 3] uint8
+    """
+    rgb = np.repeat(img[..., None], 3, axis=-1) if img.ndim == 2 else img.copy()
+    for mi, mask2d in enumerate(masks):
+        rgb[mask_outline(mask2d)] = colors[mi % len(colors)]
+    return rgb
+
+def roi_voxel_center(roi, spacing):
+    """ROI center (mm) -> voxel indices (x, y, z)"""
+    dx, dy, dz = spacing
+    return int(roi['cx'] / dx), int(roi['cy'] / dy), int(roi['cz'] / dz)
+
+def roi_orthoviews(mag_xyz, roi, spacing, color=ROI_COLORS[0], window=None):
+    """Three orthogonal planes through an ROI center with the ROI outline
+
+    @param mag_xyz :: magnitude volume as [x, y, z] (e.g., mag.T for a [z, y, x] volume, a view)
+    @param window :: (lo, hi) intensity window (default: percentiles of each plane)
+
+    @return views :: [x plane ([y, z]), y plane ([x, z]), z plane ([x, y])] RGB uint8 images
+    """
+    lo, hi = (None, None) if window is None else window
+    cx, cy, cz = roi_voxel_center(roi, spacing)
+    views = []
+    for sel in ((cx, slice(None), slice(None)), (slice(None), cy, slice(None)), (slice(None), slice(None), cz)):
+        plane = window_uint8(mag_xyz[sel], lo=lo, hi=hi)
+        views.append(overlay_outlines(plane, [roi['mask'][sel]], colors=(color,)))
+    return views
+
+def render_roi_report(vol, roi_info, spacing, n_tiles=20, pad=4):
+    """Report image: z-plane montage with all ROI outlines, then one row of orthogonal views per ROI
+
+    @param vol :: [z, y, x] volume (complex, records or magnitude)
+    @param roi_info :: list of ROI dicts ('mask' [x, y, z], 'cx', 'cy', 'cz' in mm)
+    @param spacing :: (dx, dy, dz) in mm
+
+    @return img :: RGB uint8 image
+    """
+    mag = vu.magnitude(vol)
+    window = tuple(np.percentile(mag, (0.5, 99.5)))
+
+    planes = select_planes(mag.shape[0], n_tiles)
+    tiles = []
+    for zi in planes:
+        plane = window_uint8(mag[zi], *window)
+        tiles.append(overlay_outlines(plane, [np.asarray(roi['mask'][:, :, zi]).T for roi in roi_info]))
+    overview = tile_slices(tiles, pad=pad)
+
+    mag_xyz = mag.T
+    roi_rows = []
+    for ri, roi in enumerate(roi_info):
+        views = roi_orthoviews(mag_xyz, roi, spacing, color=ROI_COLORS[ri % len(ROI_COLORS)], window=window)
+        roi_rows.append(tile_slices(views, grid=(1, 3), pad=pad))
+
+    # ROI rows in as many columns as fit the width of the overview
+    n_cols = max(1, min(len(roi_rows), overview.shape[1] // roi_rows[0].shape[1]))
+    details = tile_slices(roi_rows, grid=(int(np.ceil(len(roi_rows) / float(n_cols))), n_cols), pad=0)
+    return tile_slices([overview, details], grid=(2, 1), pad=0)
+
+def save_image(fname, img):
+    """Write an image array (gray uint8 or RGB) to PNG without creating a figure"""
+    mpimg.imsave(fname, img, cmap='gray' if img.ndim == 2 else None, vmin=0, vmax=255)
+    return fname
+
+def render_report(job):
+    """Render & write one report
+
+    @param job :: dict
+      'out' :: output image file
+      'volume' :: [z, y, x] array, or (loader, args) with loader a module level function returning one
+      'roi_info' :: optional list of ROI dicts (default: z-plane montage only)
+      'spacing' :: (dx, dy, dz) in mm (needed with roi_info)
+      'n_tiles' :: number of montage planes (default 20)
+
+    @return out :: output file name
+    """
+    vol = job['volume']
+    if isinstance(vol, tuple):
+        loader, args = vol
+        vol = loader(*args)
+
+    if job.get('roi_info'):
+        img = render_roi_report(vol, job['roi_info'], job['spacing'], n_tiles=job.get('n_tiles', 20))
+    else:
+        img = montage(vol, axis=0, n_tiles=job.get('n_tiles', 20))[0]
+
+    out_dir = os.path.dirname(job['out'])
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    return save_image(job['out'], img)
+
+def render_reports(jobs, n_workers=None):
+    """Render many reports on a process pool (see render_report)
+
+    Passing volumes as (loader, args) keeps the per-job pickling small: each
+    worker loads its own volume.
+
+    @param n_workers :: number of processes (1: render in this process)
+    @return outs :: output file names, in the order of jobs
+    """
+    if n_workers == 1:
+        return [render_report(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(render_report, jobs))
@@ -0,0 +1,84 @@
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+def _otsu_threshold(hist, edges):
+    """Threshold (bin edge) maximizing the between-class variance of a histogram"""
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu0 = m0 / w0
+        mu1 = (m0[-1] - m0) / w1
+        var_b = w0 * w1 * (mu0 - mu1)**2
+
+    return edges[np.nanargmax(var_b[:-1]) + 1]
+
+def select_background(mag_img, exclude_mask=None, n_bins=256, n_sigma=3.0):
+    """Select the (air) background voxels of a magnitude image from its histogram
+
+    The background is the low intensity peak of the histogram (below the Otsu
+    threshold). For magnitude noise (Rayleigh distributed) the peak position is
+    the noise standard deviation sigma; voxels below n_sigma * sigma are kept.
+    Voxels <= 0 (zero-filled borders, masked recons) carry no noise and are
+    never background.
+
+    @param mag_img :: magnitude image/volume (e.g., first echo, [z, y, x])
+    @param exclude_mask :: optional boolean map of voxels that are never background
+                           (e.g., the phantom container ROIs)
+    @param n_bins :: number of histogram bins
+    @param n_sigma :: background cut-off in units of the estimated sigma
+
+    @return bg_mask :: boolean map of background voxels
+    @return sigma :: estimated noise standard deviation (of each channel)
+    """
+    mag_img = np.asarray(mag_img)
+    with np.errstate(invalid='ignore'):
+        cand = np.isfinite(mag_img) & (mag_img > 0)
+    if exclude_mask is not None:
+        cand &= ~np.asarray(exclude_mask, dtype=bool)
+
+    vals = mag_img[cand]
+    if vals.size == 0:
+        raise Exception('No nonzero background voxels to estimate the noise from')
+    hist, edges = np.histogram(vals, bins=n_bins)
+    thresh = _otsu_threshold(hist, edges)
+
+    low = edges[1:] <= thresh
+    peak = np.argmax(np.where(low, hist, -1))
+    sigma = 0.5 * (edges[peak] + edges[peak + 1])
+
+    bg_mask = cand & (mag_img < n_sigma * sigma)
+    if not bg_mask.any():
+        raise Exception('No nonzero background voxels to estimate the noise from')
+    return bg_mask, sigma
+
+def estimate_noise_power(data, axis=0, exclude_mask=None, ref_echo=0, n_bins=256, n_sigma=3.0):
+    """Estimate the background noise power (mean squared magnitude) of a multi-echo volume
+
+    The background is selected on the reference echo (see select_background);
+    the noise power is the mean of |S|^2 over those voxels for every echo, i.e.,
+    the noise_est expected by gre_3dute.t2strw_pow_resid.
+
+    @param data :: complex or magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param axis :: echo axis of data
+    @param exclude_mask :: optional boolean map (spatial shape) of voxels that are never background
+    @param ref_echo :: echo used to select the background
+
+    @return noise_est :: noise power for each echo, shape (n_echoes,)
+    @return bg_mask :: boolean map of background voxels
+    """
+    data = np.moveaxis(np.asarray(data), axis, 0)
+    bg_mask, sigma = select_background(np.abs(data[ref_echo]), exclude_mask=exclude_mask,
+                                       n_bins=n_bins, n_sigma=n_sigma)
+
+    bg = np.abs(data[:, bg_mask]).astype(np.float64)
+    noise_est = np.mean(bg * bg, axis=1)
+
+    # the reference echo was cut off at n_sigma * sigma: undo the (Rayleigh) truncation bias
+    hc2 = 0.5 * n_sigma * n_sigma
+    noise_est[ref_echo] /= 1.0 - hc2 * np.exp(-hc2) / (1.0 - np.exp(-hc2))
+
+    return noise_est, bg_mask
@@ -0,0 +1,213 @@
+"""
+Multi-resolution preview pyramid and projection cache
+
+A PreviewPyramid holds, lazily, the magnitude of a volume at full resolution
+and at successive 2x (block mean) downsamplings, plus per-axis maximum and
+mean intensity projections of each level. Everything is computed on first
+access from the magnitude (computed once), kept in an LRU cache with a
+memory budget shared by all pyramids, and optionally persisted as .npy files
+next to the volume cache so a later session memory maps it back instantly.
+
+    pyr = PreviewPyramid(vol.magnitude(echo=0, coil=0), key=cache_key)
+    img = pyr.slice(0, 80, max_size=256)        # z plane 80, coarsest level >= 256 px
+    xv, yv, zv = pyr.orthoviews(cx, cy, cz)
+    mip = pyr.projection(0, 'max', level=1)
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import view_utils as vu
+from .montage import window_uint8, tile_slices
+
+def default_budget():
+    """Memory budget of the shared preview cache ($PYQMRI_PREVIEW_BUDGET_MB, default 1024 MB)"""
+    return int(float(os.environ.get('PYQMRI_PREVIEW_BUDGET_MB', 1024)) * 2**20)
+
+def default_persist_dir():
+    """Persisted previews live next to the volume cache ($PYQMRI_CACHE/previews)"""
+    root = os.environ.get('PYQMRI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pyqmri'))
+    return os.path.join(root, 'previews')
+
+class LRUArrayCache(object):
+    """Thread-safe LRU cache of arrays with a total size budget (bytes)"""
+    def __init__(self, budget=None):
+        self.budget = default_budget() if budget is None else budget
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            arr = self._items.get(key)
+            if arr is not None:
+                self._items.move_to_end(key)
+            return arr
+
+    def put(self, key, arr):
+        # memory mapped arrays cost (almost) no memory
+        size = 0 if isinstance(arr, np.memmap) else arr.nbytes
+        with self._lock:
+            if key in self._items:
+                old = self._items.pop(key)
+                self.nbytes -= 0 if isinstance(old, np.memmap) else old.nbytes
+            self._items[key] = arr
+            self.nbytes += size
+            while (self.nbytes > self.budget) and (len(self._items) > 1):
+                old_key, old = self._items.popitem(last=False)
+                self.nbytes -= 0 if isinstance(old, np.memmap) else old.nbytes
+        return arr
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+# shared by all keyed pyramids unless one is given
+_shared_cache = LRUArrayCache()
+
+# keys of keyless pyramids (never reused, unlike id())
+_mem_tokens = itertools.count()
+
+def shared_cache():
+    return _shared_cache
+
+def downsample2(mag):
+    """2x block mean over the last three (spatial) axes (odd trailing voxels are dropped)"""
+    nz, ny, nx = [max(nn // 2, 1) for nn in mag.shape[-3:]]
+    lead = mag.shape[:-3]
+    trimmed = mag[..., :2 * nz if mag.shape[-3] > 1 else 1,
+                       :2 * ny if mag.shape[-2] > 1 else 1,
+                       :2 * nx if mag.shape[-1] > 1 else 1]
+    fz, fy, fx = [2 if nn > 1 else 1 for nn in mag.shape[-3:]]
+    blocks = trimmed.reshape(lead + (nz, fz, ny, fy, nx, fx))
+    return blocks.mean(axis=(-5, -3, -1), dtype=np.float32)
+
+class PreviewPyramid(object):
+    """Lazily built magnitude pyramid & projections of one volume
+
+    @param source :: [..., z, y, x] volume (complex, records, magnitude), an accessor
+                     with a cached magnitude, or a function returning the magnitude
+    @param key :: identifier of the volume (e.g., a volume cache key); needed to persist,
+                  default: memory-only entries in a private cache
+    @param n_levels :: number of levels (default: down to min_size voxels along the largest axis)
+    @param cache :: LRUArrayCache (default: the shared cache, or a private one without key)
+    @param persist :: store computed items as .npy files (needs key)
+    @param persist_dir :: directory of persisted items (default: default_persist_dir())
+    """
+    def __init__(self, source, key=None, n_levels=None, min_size=32, cache=None,
+                 persist=False, persist_dir=None):
+        self._source = source
+        self.key = key if key is not None else 'mem-{:d}'.format(next(_mem_tokens))
+        if cache is None:
+            cache = _shared_cache if key is not None else LRUArrayCache()
+        self.cache = cache
+        self.persist = persist and (key is not None)
+        self.persist_dir = default_persist_dir() if persist_dir is None else persist_dir
+        self.min_size = min_size
+        self._n_levels = n_levels
+        self._shape = None
+        self._lock = threading.RLock()
+
+    def _item(self, name, build):
+        ckey = (self.key, name)
+        arr = self.cache.get(ckey)
+        if arr is not None:
+            return arr
+
+        with self._lock:
+            arr = self.cache.get(ckey)
+            if arr is not None:
+                return arr
+
+            fname = os.path.join(self.persist_dir, '{:s}_{:s}.npy'.format(self.key, name))
+            if self.persist and os.path.exists(fname):
+                arr = np.load(fname, mmap_mode='r')
+            else:
+                arr = build()
+                if self.persist:
+                    os.makedirs(self.persist_dir, exist_ok=True)
+                    tmp_fname = fname + '.{:d}.tmp.npy'.format(os.getpid())
+                    np.save(tmp_fname, arr)
+                    os.replace(tmp_fname, fname)
+            return self.cache.put(ckey, arr)
+
+    def _magnitude(self):
+        mag = self._source() if callable(self._source) else vu.magnitude(self._source)
+        return np.asarray(mag, dtype=np.float32)
+
+    @property
+    def shape(self):
+        """Full resolution shape"""
+        if self._shape is None:
+            self._shape = self.level(0).shape
+        return self._shape
+
+    @property
+    def n_levels(self):
+        if self._n_levels is None:
+            largest = max(self.shape[-3:])
+            self._n_levels = 1 + max(0, int(np.floor(np.log2(max(largest / float(self.min_size), 1.0)))))
+        return self._n_levels
+
+    def level(self, lvl):
+        """Magnitude at level lvl (0: full resolution, each level halves every spatial axis)"""
+        if lvl == 0:
+            return self._item('L0', self._magnitude)
+        if lvl >= self.n_levels:
+            raise Exception('Level {:d} requested, pyramid has {:d} levels'.format(lvl, self.n_levels))
+        return self._item('L{:d}'.format(lvl), lambda: downsample2(self.level(lvl - 1)))
+
+    def projection(self, axis, kind='max', level=0):
+        """Maximum ('max') or mean ('mean') intensity projection along a spatial axis (0: z, 1: y, 2: x)"""
+        if kind not in ('max', 'mean'):
+            raise Exception("Projection kind should be 'max' or 'mean'")
+        red = np.max if kind == 'max' else np.mean
+
+        def build():
+            mag = self.level(level)
+            return red(mag, axis=mag.ndim - 3 + axis).astype(np.float32)
+
+        return self._item('{:s}{:d}_L{:d}'.format(kind, axis, level), build)
+
+    def level_for(self, max_size):
+        """Coarsest level whose in-plane size is still >= max_size (or the full resolution)"""
+        if max_size is None:
+            return 0
+        largest = max(self.shape[-3:])
+        lvl = int(np.floor(np.log2(max(largest / float(max_size), 1.0))))
+        return min(lvl, self.n_levels - 1)
+
+    def slice(self, axis, index, level=None, max_size=None):
+        """Plane through full resolution index along a spatial axis (0: z, 1: y, 2: x)
+
+        @param level :: pyramid level (default: chosen from max_size)
+        @param max_size :: display size (pixels) the plane is needed at
+        """
+        lvl = self.level_for(max_size) if level is None else level
+        mag = self.level(lvl)
+        ai = mag.ndim - 3 + axis
+        return np.take(mag, min(index >> lvl, mag.shape[ai] - 1), axis=ai)
+
+    def orthoviews(self, cx, cy, cz, level=None, max_size=None):
+        """z, y and x planes through the full resolution voxel (cx, cy, cz)"""
+        return [self.slice(0, cz, level, max_size), self.slice(1, cy, level, max_size),
+                self.slice(2, cx, level, max_size)]
+
+    def render_orthoviews(self, cx, cy, cz, level=None, max_size=256, mip=False):
+        """Orthogonal planes (or MIPs) tiled into one uint8 image, windowed on the level's range"""
+        lvl = self.level_for(max_size) if level is None else level
+        if mip:
+            views = [self.projection(axis, 'max', lvl) for axis in range(3)]
+        else:
+            views = self.orthoviews(cx, cy, cz, level=lvl)
+        lo, hi = np.percentile(self.level(min(lvl + 1, self.n_levels - 1)), (0.5, 99.5))
+        return tile_slices([window_uint8(vv, lo, hi) for vv in views], grid=(1, 3))
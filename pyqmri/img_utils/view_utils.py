@@ -3,52 +3,93 @@ __author__ = "Dharshan Chandramohan"
 import numpy as np
 import matplotlib.pyplot as plt
 
+def magnitude(data, pairs=False):
+    """Magnitude of complex image data, computed on the whole array at once
+
+    @param data :: complex array, array of {real, imag} records, real array
+                   (returned as |data|), or a volume accessor with a cached
+                   magnitude (e.g., h5_volume.ReconVolume)
+    @param pairs :: data is real with (real, imag) pairs along the last axis
+
+    @return mag :: magnitude array
+    """
+    if hasattr(data, 'magnitude'):
+        return data.magnitude()
+
+    data = np.asarray(data)
+    if data.dtype.names is not None:
+        f_re, f_im = data.dtype.names[:2]
+        return np.hypot(data[f_re], data[f_im])
+    if pairs:
+        return np.hypot(data[..., 0], data[..., 1])
+    return np.abs(data)
+
+def normalize_magnitude(mag, dtype=np.int64):
+    """Scale a magnitude array to the full range of an integer dtype ([0, 1] for floats)"""
+    mag = np.asarray(mag, dtype=np.float64)
+    peak = np.max(mag)
+    if not np.issubdtype(dtype, np.integer):
+        return (mag / peak if peak > 0 else mag).astype(dtype)
+
+    # largest float64 that still fits in dtype (2**63 - 1 itself rounds up to 2**63)
+    top = np.nextafter(float(np.iinfo(dtype).max) + 1.0, 0.0)
+    scale = top / peak if peak > 0 else 0.0
+    return np.minimum(scale * mag, top).astype(dtype)
+
+def norm_mag_volume(data, pairs=False, dtype=np.int64):
+    """Magnitude of a whole volume (or slice stack) scaled to the range of dtype"""
+    return normalize_magnitude(magnitude(data, pairs=pairs), dtype=dtype)
+
 def norm_mag_slice(cplx_data_3d, slice_num, axis):
-    nz, ny, nx = cplx_data_3d.shape
+    """Scaled magnitude of one plane of a [z, y, x] volume
+
+    cplx_data_3d may be complex, {real, imag} records, (real, imag) pairs
+    along a 4th axis, or an already computed (real) magnitude volume.
+
+    @param axis :: 0 (x = slice_num), 1 (y = slice_num) or 2 (z = slice_num)
+    @return row_axis, col_axis, scl_slice :: scl_slice is [y, z], [x, z] or [x, y]
+    """
+    if hasattr(cplx_data_3d, 'magnitude'):
+        cplx_data_3d = cplx_data_3d.magnitude()
+    pairs = (cplx_data_3d.ndim == 4) and (cplx_data_3d.shape[-1] == 2)
 
     if axis == 0:
-        ipnr, ipnc = (ny,nz)
         cplx_data_slice = cplx_data_3d[:, :, slice_num]
     elif axis == 1:
-        ipnr, ipnc = (nx,nz)
         cplx_data_slice = cplx_data_3d[:, slice_num, :]
     elif axis == 2:
-        ipnr, ipnc = (nx, ny)
         cplx_data_slice = cplx_data_3d[slice_num, :, :]
+    else:
+        raise Exception('axis should be 0, 1 or 2')
 
-    row_axis = np.arange(ipnr)
-    col_axis = np.arange(ipnc)
-    mag_slice = np.ndarray((ipnr, ipnc), dtype=np.float)
-    scl_slice = np.ndarray((ipnr, ipnc), dtype=np.int64)
+    scl_slice = norm_mag_volume(cplx_data_slice, pairs=pairs).T
+    return np.arange(scl_slice.shape[0]), np.arange(scl_slice.shape[1]), scl_slice
 
-    for row_i in row_axis:
-        for col_i in col_axis:
-            mag_slice[row_i, col_i] = np.float(np.abs(np.complex(
-                *cplx_data_slice[col_i, row_i]
-            )))
+def mask_rgba(mask2d, alpha=0.4, color=(0.0, 1.0, 0.0)):
+    """RGBA overlay (float32) of a 2-D mask slice for imshow"""
+    mask2d = np.asarray(mask2d, dtype=np.float32)
+    rgba = np.zeros(mask2d.shape + (4,), dtype=np.float32)
+    rgba[..., :3] = color
+    rgba[..., 3] = alpha * mask2d
+    return rgba
 
-    scale = (2**63 - 1)/np.max(mag_slice)
-    for row_i in row_axis:
-        for col_i in col_axis:
-            scl_slice[row_i, col_i] = np.int64(
-                scale * mag_slice[row_i, col_i]
-            )
-
-    return row_axis, col_axis, scl_slice
+def _preview_grid(grid, figsize, n_planes):
+    n_axes = grid[0] * grid[1]
+    fig, ax = plt.subplots(grid[0], grid[1], figsize=figsize, squeeze=False)
+    prev_planes = np.arange(0, n_planes, int(np.ceil(n_planes/n_axes)))[:n_axes]
+    for aa in ax.flat[len(prev_planes):]:
+        aa.axis('off')
+    return fig, ax.flat, prev_planes
 
 def preview_volume_mag_DICOM(vol3d, axis=2):
     pass
 
 def preview_volume_DICOM(vol3d, axis=2, figsize=(20.0,20.0), grid=(5, 4)):
-    n_axes = grid[0] * grid[1]
-    n_planes = vol3d.shape[axis]
-
-    fig, ax = plt.subplots(grid[0], grid[1], figsize=figsize)
-    prev_planes = np.arange(0, n_planes, int(np.ceil(n_planes/n_axes)))
+    fig, ax, prev_planes = _preview_grid(grid, figsize, vol3d.shape[axis])
 
     for pl, sli in enumerate(prev_planes):
-        aa = ax[int(pl/4)][int(pl%4)]
-        aa.imshow(vol3d[:,:,sli])
+        aa = ax[pl]
+        aa.imshow(np.take(vol3d, sli, axis=axis))
         aa.set_title('Sl #{:d}'.format(sli))
 
     fig.tight_layout()
@@ -56,16 +97,28 @@ def preview_volume_DICOM(vol3d, axis=2, figsize=(20.0,20.0), grid=(5, 4)):
 
     return fig
 
-def preview_volume_cplx(vol3d, axis=2, figsize=(20.0, 20.0), grid=(5, 4)):
-    n_axes = grid[0] * grid[1]
-    n_planes = vol3d.shape[2 - axis] # kludge for z, y, x order...
-    
-    fig, ax = plt.subplots(grid[0], grid[1], figsize=figsize)
-    prev_planes = np.arange(0, n_planes, int(np.ceil(n_planes/n_axes)))
+def preview_volume_cplx(vol3d, axis=2, figsize=(20.0, 20.0), grid=(5, 4), max_size=None):
+    """Grid of planes of a [z, y, x] volume
+
+    @param vol3d :: complex / records / pairs volume, or a preview_cache.PreviewPyramid of one
+                    (keep the pyramid to browse the volume again without recomputing anything)
+    @param axis :: 0 (x planes), 1 (y planes) or 2 (z planes)
+    @param max_size :: display size (pixels) of the planes: use the coarsest pyramid level >= max_size
+    """
+    from .preview_cache import PreviewPyramid
+
+    # magnitude of the whole volume once (in the pyramid), then slice it
+    if isinstance(vol3d, PreviewPyramid):
+        pyramid = vol3d
+    else:
+        pyramid = PreviewPyramid(lambda: magnitude(vol3d, pairs=(np.ndim(vol3d) == 4)))
+    n_planes = pyramid.shape[2 - axis] # kludge for z, y, x order...
+    fig, ax, prev_planes = _preview_grid(grid, figsize, n_planes)
 
     for pl, sli in enumerate(prev_planes):
-        rr, cc, imslice = norm_mag_slice(vol3d, sli, axis)
-        aa = ax[int(pl/4)][int(pl%4)]
+        imslice = normalize_magnitude(pyramid.slice(2 - axis, sli, max_size=max_size)).T
+        rr, cc = np.arange(imslice.shape[0]), np.arange(imslice.shape[1])
+        aa = ax[pl]
         aa.pcolormesh(rr, cc, imslice)
         aa.set_title('Sl #{:d}'.format(sli))
 
@@ -75,8 +128,6 @@ def preview_volume_cplx(vol3d, axis=2, figsize=(20.0, 20.0), grid=(5, 4)):
     return fig
 
 # Misc: there's nowhere else to put this but I find it useful
-from IPython.display import clear_output
-
 class SimpleProgress(object):
     def __init__(self, bar_length=50):
         self.bar_length = bar_length
@@ -91,6 +142,9 @@ class SimpleProgress(object):
         if progress >= 1:
             progress = 1
 
+        # imported here so the module also works headless (without IPython)
+        from IPython.display import clear_output
+
         block = int(round(self.bar_length * progress))
         clear_output(wait = True)
 
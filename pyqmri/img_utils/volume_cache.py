@@ -0,0 +1,193 @@
+"""
+Content-addressed cache of converted image volumes
+
+Converted volumes (complex recons from .mat files, DICOM series) are stored
+as HDF5 files named by a hash of their source files and conversion options.
+Complex data is kept as complex64, chunked by slab and gzip compressed by
+default; acquisition metadata (echo times, spacing, coil count, ...) is
+stored as attributes. Volumes stored uncompressed can be memory mapped.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import h5py
+
+from .h5_volume import ReconVolume
+
+def default_cache_dir():
+    """Volume cache directory ($PYQMRI_CACHE/volumes, default ~/.cache/pyqmri/volumes)"""
+    root = os.environ.get('PYQMRI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pyqmri'))
+    return os.path.join(root, 'volumes')
+
+def _option_to_json(val):
+    # arrays by value: str() elides the middle of large arrays
+    if hasattr(val, 'tolist'):
+        return val.tolist()
+    return str(val)
+
+def source_key(sources, hash_content=False, **options):
+    """Cache key of a converted volume
+
+    @param sources :: file name or list of file names the volume is converted from
+    @param hash_content :: hash the file contents (default: path, size & mtime, which is much faster)
+    @param options :: conversion options that change the result (dataset, dtype, ...)
+
+    @return key :: hex digest
+    """
+    sources = [sources] if isinstance(sources, str) else sorted(sources)
+    digest = hashlib.sha1()
+    for fname in sources:
+        if hash_content:
+            with open(fname, 'rb') as src:
+                for block in iter(lambda: src.read(1 << 22), b''):
+                    digest.update(block)
+        else:
+            st = os.stat(fname)
+            digest.update('{:s}:{:d}:{:d};'.format(os.path.abspath(fname), st.st_size,
+                                                   st.st_mtime_ns).encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True, default=_option_to_json).encode('utf-8'))
+    return digest.hexdigest()[:24]
+
+def _store_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'c':
+        return np.dtype(np.complex64)
+    if dtype.kind == 'f':
+        return np.dtype(np.float32)
+    return dtype
+
+def _default_chunks(shape, slab_size=8):
+    """One chunk per slab of full slices (z is the third-from-last axis)"""
+    if len(shape) < 3:
+        return True
+    return (1,) * (len(shape) - 3) + (min(slab_size, shape[-3]), shape[-2], shape[-1])
+
+def _meta_to_attr(val):
+    if isinstance(val, (dict, list, tuple)) and not isinstance(val, np.ndarray):
+        try:
+            arr = np.asarray(val)
+            if arr.dtype.kind in 'biuf':
+                return arr
+        except ValueError:
+            pass
+        return 'json:' + json.dumps(val, default=str)
+    return val
+
+def _attr_to_meta(val):
+    if isinstance(val, bytes):
+        val = val.decode('utf-8')
+    if isinstance(val, str) and val.startswith('json:'):
+        return json.loads(val[5:])
+    return val
+
+class VolumeCache(object):
+    def __init__(self, cache_dir=None):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{:s}.h5'.format(key))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data, meta=None, compression='gzip', compression_opts=4, store_dtype=None):
+        """Store a volume (written to a temporary file and renamed, so readers never see partial entries)
+
+        @param data :: array (complex data is stored as complex64, real floats as float32)
+        @param meta :: dict of metadata (numbers, arrays, strings; other values are stored as JSON)
+        @param compression :: 'gzip', 'lzf' or None (None stores a contiguous dataset that can be memory mapped)
+        @param store_dtype :: override the storage dtype
+        """
+        data = np.asarray(data)
+        dtype = _store_dtype(data.dtype) if store_dtype is None else np.dtype(store_dtype)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self.path(key)
+        tmp_fname = fname + '.{:d}.tmp'.format(os.getpid())
+        with h5py.File(tmp_fname, 'w') as hf:
+            if compression is None:
+                ds = hf.create_dataset('data', data=data.astype(dtype, copy=False))
+            else:
+                ds = hf.create_dataset('data', data=data.astype(dtype, copy=False),
+                                       chunks=_default_chunks(data.shape), shuffle=True,
+                                       compression=compression,
+                                       compression_opts=compression_opts if compression == 'gzip' else None)
+            for name, val in (meta or {}).items():
+                ds.attrs[name] = _meta_to_attr(val)
+        os.replace(tmp_fname, fname)
+        return fname
+
+    def meta(self, key):
+        with h5py.File(self.path(key), 'r') as hf:
+            return {name: _attr_to_meta(val) for name, val in hf['data'].attrs.items()}
+
+    def get(self, key, mmap=False):
+        """Load a cached volume
+
+        @param mmap :: memory map the data (entries stored with compression=None only)
+
+        @return data, meta :: or None if the key is not cached
+        """
+        if key not in self:
+            return None
+
+        meta = self.meta(key)
+        with ReconVolume(self.path(key), dataset='data') as vol:
+            data = vol.memmap() if mmap else vol[()]
+        return data, meta
+
+    def open(self, key):
+        """Open a cached volume lazily (see ReconVolume)"""
+        return ReconVolume(self.path(key), dataset='data')
+
+    def cached(self, key, convert, mmap=False, **put_kwargs):
+        """Load key, or run convert() -> (data, meta), store the result and return it"""
+        entry = self.get(key, mmap=mmap)
+        if entry is not None:
+            return entry
+
+        data, meta = convert()
+        self.put(key, data, meta=meta, **put_kwargs)
+        return self.get(key, mmap=mmap)
+
+def load_recon_cached(fname, dataset='imall', meta=None, cache=None, **put_kwargs):
+    """Complex recon volume from a .mat/HDF5 file, through the volume cache
+
+    @param meta :: extra metadata to store with the volume (e.g., {'TE': utes}); it is part of the
+                   cache key, so a different meta gives a separate entry
+
+    @return data, meta :: data as complex64, meta including 'shape' & 'n_coils' (5-D recons)
+    """
+    cache = VolumeCache() if cache is None else cache
+
+    def convert():
+        with ReconVolume(fname, dataset=dataset) as vol:
+            data = vol[()]
+            info = {'source' : os.path.abspath(fname), 'axes' : list(vol.axes),
+                    'shape' : list(data.shape)}
+            if 'coil' in vol.axes:
+                info['n_coils'] = vol.shape[vol.axis_index('coil')]
+        info.update(meta or {})
+        return data, info
+
+    return cache.cached(source_key(fname, dataset=dataset, meta=meta or {}), convert, **put_kwargs)
+
+def load_DICOM_cached(dirname, cache=None, index=None, **put_kwargs):
+    """DICOM series (see loaders.load_DICOM_from_ordered_dir), through the volume cache
+
+    @return vol, params :: params as returned by the loader ('TE', 'FA', 'TR', 'spacing', ...)
+    """
+    from .loaders import load_DICOM_from_ordered_dir
+
+    cache = VolumeCache() if cache is None else cache
+    fnames = [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname))
+              if not fname.startswith('.pyqmri_index')]
+
+    def convert():
+        return load_DICOM_from_ordered_dir(dirname, index=index)
+
+    return cache.cached(source_key(fnames, loader='dicom'), convert, **put_kwargs)
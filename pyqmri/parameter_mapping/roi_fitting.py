@@ -0,0 +1,95 @@
+"""
+ROI-restricted voxelwise fitting
+
+Only the voxels inside the phantom container ROIs (roi_info from
+MaterialsPhantom_Mk*.compute_rois) are gathered into a compact
+(n_voxels, n_echoes) matrix, fit in one batch, and the results are
+scattered back to each ROI.
+
+Note: ROI masks are indexed [x, y, z], image volumes [..., z, y, x].
+"""
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+def roi_voxel_indices(roi, spatial_shape):
+    """Flat indices (into a [z, y, x] volume of spatial_shape) of the voxels in an ROI mask"""
+    mask = roi['mask']
+    if hasattr(mask, 'ravel_index'):
+        # SparseMask: indices from the bounding box only
+        if tuple(mask.shape[::-1]) != tuple(spatial_shape):
+            raise Exception('ROI mask shape {:s} does not match the volume {:s}'.format(
+                str(mask.shape), str(spatial_shape)))
+        return mask.ravel_index(order=(2, 1, 0))
+    xi, yi, zi = np.nonzero(mask)
+    return np.ravel_multi_index((zi, yi, xi), spatial_shape)
+
+def roi_union_mask(roi_info, spatial_shape):
+    """Boolean [z, y, x] map of all voxels inside any ROI (e.g., exclude_mask for the noise estimate)"""
+    union = np.zeros(int(np.prod(spatial_shape)), dtype=bool)
+    for roi in roi_info:
+        union[roi_voxel_indices(roi, spatial_shape)] = True
+    return union.reshape(spatial_shape)
+
+def gather_roi_voxels(data, roi_info, axis=0):
+    """Collect the signal of every ROI voxel into one compact matrix
+
+    @param data :: images, echoes (or flip angles) along `axis`, spatial axes [z, y, x] last
+    @param roi_info :: list of ROI dicts with a 'mask' entry
+    @param axis :: echo axis of data
+
+    @return sig :: (n_voxels, n_echoes) signal matrix (all ROIs concatenated)
+    @return labels :: (n_voxels,) index of the ROI each row belongs to
+    @return flat_idx :: (n_voxels,) flat [z, y, x] index of each row
+    """
+    data = np.moveaxis(np.asarray(data), axis, 0)
+    spatial_shape = data.shape[-3:]
+    flat = data.reshape(data.shape[0], -1)
+
+    idx = [roi_voxel_indices(roi, spatial_shape) for roi in roi_info]
+    labels = np.concatenate([np.full(ii.size, ci, dtype=np.int32) for ci, ii in enumerate(idx)])
+    flat_idx = np.concatenate(idx).astype(np.int64)
+
+    sig = flat[:, flat_idx].T
+    return sig, labels, flat_idx
+
+def fit_rois(fit_fn, data, roi_info, fit_args=(), fit_kwargs=None, axis=0,
+             param_names=None, key='fit'):
+    """Fit only the ROI voxels of a volume in one batch and store the results per ROI
+
+    fit_fn is one of the batched voxelwise fitters (e.g., batch_fit.fit_t2str_mag,
+    varpro.fit_biexp_varpro, gre_3dute.calc_VFA_T1_linear); it is called as
+    fit_fn(sig, *fit_args, **fit_kwargs) with sig shaped (n_echoes, n_voxels).
+
+    @param fit_fn :: batched voxelwise fitting function
+    @param data :: images, echoes along `axis`, spatial axes [z, y, x] last
+    @param roi_info :: list of ROI dicts with a 'mask' entry (results are added to each)
+    @param fit_args :: extra positional arguments (e.g., echo times)
+    @param fit_kwargs :: extra keyword arguments
+    @param axis :: echo axis of data
+    @param param_names :: names of the maps returned by fit_fn (default: 0, 1, ...)
+    @param key :: ROI dict entry the results are stored under
+
+    roi[key] = {name: per-voxel values, ..., 'flat_idx': [z, y, x] flat voxel indices}
+
+    @return results :: tuple of the fit outputs for all gathered voxels
+    @return labels :: ROI index of each voxel
+    """
+    fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+    sig, labels, flat_idx = gather_roi_voxels(data, roi_info, axis=axis)
+
+    results = fit_fn(sig.T, *fit_args, **fit_kwargs)
+    if not isinstance(results, tuple):
+        results = (results,)
+    if param_names is None:
+        param_names = range(len(results))
+
+    for ci, roi in enumerate(roi_info):
+        sel = labels == ci
+        roi[key] = {'flat_idx' : flat_idx[sel]}
+        for pname, res in zip(param_names, results):
+            res = np.asarray(res)
+            # per-voxel outputs are split by ROI, anything else (e.g., noise_est) is shared
+            roi[key][pname] = res[sel] if res.shape == labels.shape else res
+
+    return results, labels
@@ -0,0 +1,321 @@
+"""
+Process-pool scheduler for voxelwise parameter mapping
+
+Volumes are copied once into shared memory; worker processes attach to them,
+fit their z-slab (or chunk of voxels) and write the parameter maps straight
+into shared output arrays, so the echo stack is never pickled per task.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Output dtypes of pyqmri.signal_models.batch_fit.fit_t2str_mag (T2str, K, N, status)
+T2STR_MAG_OUT = (np.float64, np.float64, np.float64, np.int8)
+
+# per-process views of the shared arrays (set by _init_worker)
+_worker_state = {}
+
+def _new_shared(shape, dtype, fill=None):
+    """Allocate a shared array (copying fill into it, or zeroed) -> (block, spec)"""
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    np.ndarray(shape, dtype=dtype, buffer=shm.buf)[...] = 0 if fill is None else fill
+    return shm, (shm.name, tuple(shape), dtype.str)
+
+def _to_shared(arr):
+    """Copy an array into a new shared memory block -> (block, spec)"""
+    arr = np.asarray(arr)
+    return _new_shared(arr.shape, arr.dtype, fill=arr)
+
+def _attach(spec):
+    """Attach to a shared array created by the parent process"""
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # python < 3.13: the parent owns (and unlinks) the block
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _init_worker(in_specs, map_specs, out_specs):
+    blocks = []
+    views = {}
+    for key, specs in (('in', in_specs), ('out', out_specs)):
+        views[key] = []
+        for spec in specs:
+            shm, arr = _attach(spec)
+            blocks.append(shm)
+            views[key].append(arr)
+
+    views['maps'] = {}
+    for mname, spec in map_specs.items():
+        shm, arr = _attach(spec)
+        blocks.append(shm)
+        views['maps'][mname] = arr
+
+    _worker_state['blocks'] = blocks
+    _worker_state.update(views)
+
+def _chunk_view(arr, chunk, n_spatial):
+    """Select a chunk from the trailing (spatial) axes of arr"""
+    mode, i0, i1 = chunk
+    lead = arr.shape[:arr.ndim - n_spatial]
+    if mode == 'slab':
+        return arr[(Ellipsis, slice(i0, i1)) + (slice(None),) * (n_spatial - 1)]
+    else:
+        return arr.reshape(lead + (-1,))[..., i0:i1]
+
+def _fit_chunk(fit_fn, fit_args, fit_kwargs, chunk, n_spatial, state=None):
+    state = _worker_state if state is None else state
+
+    vols = [_chunk_view(vv, chunk, n_spatial) for vv in state['in']]
+    kwargs = dict(fit_kwargs)
+    for mname, mm in state['maps'].items():
+        kwargs[mname] = _chunk_view(mm, chunk, n_spatial)
+
+    result = fit_fn(*vols, *fit_args, **kwargs)
+    if not isinstance(result, tuple):
+        result = (result,)
+
+    for out, res in zip(state['out'], result):
+        _chunk_view(out, chunk, n_spatial)[...] = res
+
+    return chunk
+
+def _plan_chunks(spatial_shape, chunk, chunk_size, n_workers):
+    if chunk == 'slab':
+        n = spatial_shape[0]
+    elif chunk == 'voxel':
+        n = int(np.prod(spatial_shape))
+    else:
+        raise Exception("Chunk type (chunk) should be 'slab' or 'voxel'")
+
+    if not chunk_size:
+        # a few chunks per worker keeps the pool busy when chunks finish unevenly
+        chunk_size = max(1, int(np.ceil(n / (4 * n_workers))))
+
+    return [(chunk, i0, min(i0 + chunk_size, n)) for i0 in range(0, n, chunk_size)]
+
+def map_volume(fit_fn, volumes, out_dtypes, fit_args=(), fit_kwargs=None, fit_maps=None,
+               n_workers=None, chunk='slab', chunk_size=None, n_spatial=3):
+    """Run a voxelwise fit over a volume in parallel z-slabs (or voxel chunks)
+
+    fit_fn is called as fit_fn(*volume_chunks, *fit_args, **fit_kwargs, **fit_map_chunks)
+    and must return one array (or a tuple of arrays) with the spatial shape of
+    the chunk, e.g. pyqmri.signal_models.batch_fit.fit_t2str_mag. It has to be
+    importable (module level) so that it can be sent to the worker processes.
+
+    @param fit_fn :: voxelwise fitting function
+    @param volumes :: input volume(s), spatial axes last (e.g., [echo, z, y, x])
+    @param out_dtypes :: dtype of each output map returned by fit_fn
+    @param fit_args :: extra positional arguments (shared, e.g., echo times)
+    @param fit_kwargs :: extra keyword arguments (shared)
+    @param fit_maps :: keyword arguments that are maps with the spatial shape (e.g., mask);
+                       they are shared and chunked like the volumes
+    @param n_workers :: number of worker processes (default: all cores; 1 runs in-process)
+    @param chunk :: 'slab' (ranges of z) or 'voxel' (ranges of the flattened spatial axes;
+                    fit_fn then receives [..., n_voxels] arrays)
+    @param chunk_size :: number of slices (or voxels) per chunk
+    @param n_spatial :: number of trailing spatial axes
+
+    @return maps :: tuple of output maps (spatial shape)
+    """
+    if isinstance(volumes, np.ndarray):
+        volumes = (volumes,)
+    fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+    fit_maps = {} if fit_maps is None else fit_maps
+    n_workers = os.cpu_count() if not n_workers else n_workers
+
+    spatial_shape = tuple(np.shape(volumes[0])[-n_spatial:])
+    chunks = _plan_chunks(spatial_shape, chunk, chunk_size, n_workers)
+
+    if n_workers == 1:
+        state = {
+            'in': [np.ascontiguousarray(vv) for vv in volumes],
+            'maps': {mname: np.ascontiguousarray(mm) for mname, mm in fit_maps.items()},
+            'out': [np.zeros(spatial_shape, dtype=dt) for dt in out_dtypes],
+        }
+        for cc in chunks:
+            _fit_chunk(fit_fn, fit_args, fit_kwargs, cc, n_spatial, state=state)
+        return tuple(state['out'])
+
+    blocks = []
+    try:
+        in_specs = []
+        for vv in volumes:
+            shm, spec = _to_shared(vv)
+            blocks.append(shm)
+            in_specs.append(spec)
+
+        map_specs = {}
+        for mname, mm in fit_maps.items():
+            shm, spec = _to_shared(mm)
+            blocks.append(shm)
+            map_specs[mname] = spec
+
+        out_specs = []
+        out_blocks = []
+        for dt in out_dtypes:
+            shm, spec = _new_shared(spatial_shape, dt)
+            blocks.append(shm)
+            out_blocks.append(shm)
+            out_specs.append(spec)
+
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(in_specs, map_specs, out_specs)) as pool:
+            futures = [pool.submit(_fit_chunk, fit_fn, fit_args, fit_kwargs, cc, n_spatial)
+                       for cc in chunks]
+            for ff in futures:
+                ff.result()
+
+        maps = tuple(np.array(np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=shm.buf))
+                     for shm, spec in zip(out_blocks, out_specs))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return maps
+
+class SlabPool(object):
+    """Worker processes & shared buffers reused over a stream of slabs
+
+    map_volume starts a process pool (and copies the volume into shared
+    memory) per call; a stream of slabs (see streaming.fit_streaming) instead
+    starts the pool once, sized by its first slab, and copies each slab into
+    the same shared buffers. Shorter slabs (e.g., the last one) use the first
+    slices of the buffers; a slab that does not fit restarts the pool.
+
+    Usage:
+        with SlabPool(fit_t2str_mag, T2STR_MAG_OUT, fit_args=(utes,), n_workers=8) as slab_pool:
+            for z0, z1, slab in source:
+                maps = slab_pool.map(np.abs(slab))
+
+    @param fit_fn :: voxelwise fitting function (see map_volume)
+    @param out_dtypes :: dtype of each output map returned by fit_fn
+    @param fit_args :: extra positional arguments (shared, e.g., echo times)
+    @param fit_kwargs :: extra keyword arguments (shared)
+    @param n_workers :: number of worker processes (default: all cores; 1 runs in-process)
+    @param chunk_size :: number of slices per chunk
+    @param n_spatial :: number of trailing spatial axes
+    """
+    def __init__(self, fit_fn, out_dtypes, fit_args=(), fit_kwargs=None, n_workers=None,
+                 chunk_size=None, n_spatial=3):
+        self.fit_fn = fit_fn
+        self.out_dtypes = tuple(out_dtypes)
+        self.fit_args = fit_args
+        self.fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+        self.n_workers = os.cpu_count() if not n_workers else n_workers
+        self.chunk_size = chunk_size
+        self.n_spatial = n_spatial
+        self._pool = None
+        self._blocks = []
+        self._layout = None
+        self._state = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _slab_index(self, nz):
+        return (Ellipsis, slice(0, nz)) + (slice(None),) * (self.n_spatial - 1)
+
+    def _buffer_shape(self, arr):
+        """Shape of the shared buffer that holds arr, with the z extent left out"""
+        shape = np.shape(arr)
+        return shape[:len(shape) - self.n_spatial] + shape[len(shape) - self.n_spatial + 1:]
+
+    def _describe(self, volumes, fit_maps):
+        return ([(self._buffer_shape(vv), np.asarray(vv).dtype.str) for vv in volumes],
+                sorted((mname, self._buffer_shape(mm), np.asarray(mm).dtype.str)
+                       for mname, mm in fit_maps.items()))
+
+    def _start(self, volumes, fit_maps, layout, nz):
+        self.close()
+        z_axis = -self.n_spatial
+
+        def z_shape(arr):
+            shape = list(np.shape(arr))
+            shape[len(shape) + z_axis] = nz
+            return tuple(shape)
+
+        in_specs = []
+        for vv in volumes:
+            shm, spec = _new_shared(z_shape(vv), np.asarray(vv).dtype)
+            self._blocks.append(shm)
+            in_specs.append(spec)
+
+        map_specs = {}
+        for mname, mm in fit_maps.items():
+            shm, spec = _new_shared(z_shape(mm), np.asarray(mm).dtype)
+            self._blocks.append(shm)
+            map_specs[mname] = spec
+
+        out_specs = []
+        spatial_shape = tuple(np.shape(volumes[0])[z_axis:])
+        for dt in self.out_dtypes:
+            shm, spec = _new_shared((nz,) + spatial_shape[1:], dt)
+            self._blocks.append(shm)
+            out_specs.append(spec)
+
+        view = lambda shm, spec: np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=shm.buf)
+        blocks = iter(self._blocks)
+        self._state = {
+            'in': [view(next(blocks), spec) for spec in in_specs],
+            'maps': {mname: view(next(blocks), spec) for mname, spec in map_specs.items()},
+            'out': [view(next(blocks), spec) for spec in out_specs],
+        }
+        self._layout = (layout, nz)
+        self._pool = ProcessPoolExecutor(max_workers=self.n_workers,
+                                         initializer=_init_worker,
+                                         initargs=(in_specs, map_specs, out_specs))
+
+    def map(self, volumes, fit_maps=None):
+        """Fit one slab (see map_volume) -> tuple of output maps (spatial shape of the slab)"""
+        if isinstance(volumes, np.ndarray):
+            volumes = (volumes,)
+        fit_maps = {} if fit_maps is None else fit_maps
+
+        if self.n_workers == 1:
+            return map_volume(self.fit_fn, volumes, self.out_dtypes, fit_args=self.fit_args,
+                              fit_kwargs=self.fit_kwargs, fit_maps=fit_maps, n_workers=1,
+                              chunk_size=self.chunk_size, n_spatial=self.n_spatial)
+
+        spatial_shape = tuple(np.shape(volumes[0])[-self.n_spatial:])
+        nz = spatial_shape[0]
+        layout = self._describe(volumes, fit_maps)
+        if (self._pool is None) or (layout != self._layout[0]) or (nz > self._layout[1]):
+            self._start(volumes, fit_maps, layout, nz)
+
+        sli = self._slab_index(nz)
+        for buf, vv in zip(self._state['in'], volumes):
+            buf[sli] = vv
+        for mname, mm in fit_maps.items():
+            self._state['maps'][mname][sli] = mm
+
+        chunks = _plan_chunks(spatial_shape, 'slab', self.chunk_size, self.n_workers)
+        futures = [self._pool.submit(_fit_chunk, self.fit_fn, self.fit_args, self.fit_kwargs, cc,
+                                     self.n_spatial)
+                   for cc in chunks]
+        for ff in futures:
+            ff.result()
+
+        return tuple(np.array(out[:nz]) for out in self._state['out'])
+
+    def close(self):
+        """Stop the worker processes and free the shared buffers"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self._state = None
+        self._layout = None
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
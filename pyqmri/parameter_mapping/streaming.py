@@ -0,0 +1,128 @@
+"""
+Streaming (slab by slab) parameter mapping
+
+Sources yield aligned (z0, z1, slab) tuples, where slab holds all echoes (and
+coils) of slices z0:z1 with z as the third-from-last axis, e.g.
+ReconVolume.iter_slabs or loaders.iter_DICOM_slabs. prefetch reads the next
+slab on a background thread while the current one is fitted, and
+fit_streaming hands each fitted slab to a sink as soon as it is done, so peak
+memory is bounded by a couple of slabs rather than by the volume.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import threading
+import queue
+
+import numpy as np
+
+from .slab_parallel import SlabPool
+
+_DONE = object()
+
+class _SourceError(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+def prefetch(source, depth=2):
+    """Iterate over source, reading up to depth items ahead on a background thread
+
+    depth=2 double-buffers: one slab is being fitted while the next is read.
+    Exceptions raised by the source are re-raised in the consumer.
+    """
+    buf = queue.Queue(maxsize=max(int(depth) - 1, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in source:
+                if not put(item):
+                    return
+        except Exception as exc:
+            put(_SourceError(exc))
+            return
+        put(_DONE)
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = buf.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _SourceError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+def fit_streaming(fit_fn, source, fit_args=(), fit_kwargs=None, fit_maps=None, sink=None,
+                  prepare=None, depth=2, n_workers=None, out_dtypes=None, n_spatial=3):
+    """Fit a volume slab by slab as it is read
+
+    Usage (T2* maps of coil 0, written as each slab finishes):
+        with ReconVolume(fname) as vol:
+            fit_streaming(fit_t2str_mag, vol.iter_slabs(coil=0), fit_args=(utes,),
+                          prepare=np.abs, sink=writer)
+
+    @param fit_fn :: fit_fn(slab, *fit_args, **fit_kwargs, **slab_maps) -> map or tuple of maps
+    @param source :: iterable of (z0, z1, slab)
+    @param fit_args :: extra positional arguments (e.g., echo times)
+    @param fit_kwargs :: extra keyword arguments
+    @param fit_maps :: dict of [z, y, x] (full volume) keyword arrays sliced per slab (e.g., {'mask': mask})
+    @param sink :: object with write_slab(z0, maps) (e.g., the map writers), or a callable sink(z0, maps)
+                  (default: maps are collected and returned)
+    @param prepare :: optional function applied to each slab before fitting (e.g., np.abs, coil combination)
+    @param depth :: number of slabs read ahead (see prefetch), 0 to read synchronously
+    @param n_workers :: fit each slab on this many processes (one slab_parallel.SlabPool for the stream)
+    @param out_dtypes :: output dtypes of fit_fn (needed with n_workers)
+    @param n_spatial :: number of trailing spatial axes of each slab
+
+    @return maps :: tuple of full-volume maps (None when a sink is given)
+    """
+    fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+    fit_maps = {} if fit_maps is None else fit_maps
+    if n_workers and (out_dtypes is None):
+        raise Exception('out_dtypes is required to fit slabs on worker processes')
+
+    if sink is None:
+        collected = []
+        write = lambda z0, maps: collected.append(maps)
+    elif hasattr(sink, 'write_slab'):
+        write = sink.write_slab
+    else:
+        write = sink
+
+    slab_pool = SlabPool(fit_fn, out_dtypes, fit_args=fit_args, fit_kwargs=fit_kwargs,
+                         n_workers=n_workers, n_spatial=n_spatial) if n_workers else None
+    slabs = prefetch(source, depth) if depth else source
+    try:
+        for z0, z1, slab in slabs:
+            if prepare is not None:
+                slab = prepare(slab)
+            slab_maps = {mname: mm[z0:z1] for mname, mm in fit_maps.items()}
+
+            if slab_pool is not None:
+                maps = slab_pool.map(slab, slab_maps)
+            else:
+                maps = fit_fn(slab, *fit_args, **dict(fit_kwargs, **slab_maps))
+
+            write(z0, maps if isinstance(maps, tuple) else (maps,))
+    finally:
+        if slab_pool is not None:
+            slab_pool.close()
+
+    if sink is not None:
+        return None
+    if not collected:
+        raise Exception('The source yielded no slabs')
+    return tuple(np.concatenate(mm, axis=-n_spatial) for mm in zip(*collected))
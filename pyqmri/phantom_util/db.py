@@ -1,5 +1,27 @@
+"""
+mongoengine documents of the phantom database
+
+Measurements reference the phantom, the sample (container) and the
+experiment they come from; experiment_date copies the experiment's
+session_date so (phantom, sample, parameter, experiment_date) queries are
+served by one compound index. A whole study (every container x parameter)
+is stored with ingest_measurements in a single bulk_write round-trip:
+
+    docs = measurements_from_stats(stats, ('T2str', 'K', 'N'), phantom_rec.containers,
+                                   experiment=exam_rec, phantom=phantom_rec)
+    ingest_measurements(docs, replace=True)
+
+Without a database server (e.g., tests), connect to an in-memory mongomock
+client instead; everything above works the same:
+
+    import mongomock
+    from mongoengine import connect
+    connect('pyqmri_test', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+"""
 __author__ = "Dharshan Chandramohan"
 
+import numpy as np
+from pymongo import InsertOne, DeleteMany
 from mongoengine import *
 
 class Phantom(Document):
@@ -57,3 +79,106 @@ class Measurement(Document):
     parameter = StringField() # OR CHOICE [?]
     value = FloatField()
     quantification_details = DictField() # basically a notes field...
+
+    phantom = ReferenceField(MaterialPhantom)
+    sample = ReferenceField(MaterialSample)
+    experiment = ReferenceField(Experiment)
+    experiment_date = DateTimeField() # experiment.session_date (filled in by clean)
+
+    meta = {
+        'indexes' : [
+            ('phantom', 'sample', 'parameter', 'experiment_date'),
+            ('experiment', 'parameter'),
+        ]
+    }
+
+    def clean(self):
+        if (self.experiment_date is None) and (self.experiment is not None):
+            self.experiment_date = getattr(self.experiment, 'session_date', None)
+
+
+# (phantom, sample, experiment, parameter) identifies a measurement for replace=True ingestion
+_MEASUREMENT_KEY = ('phantom', 'sample', 'experiment', 'parameter')
+
+def _plain(val):
+    """numpy scalars / arrays -> python values (BSON has no numpy types)"""
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+def ensure_indexes():
+    """Create the indexes of every document (also done lazily on first use of a collection)"""
+    for doc_cls in (Phantom, MaterialSample, Experiment, Measurement):
+        doc_cls.ensure_indexes()
+
+def insert_samples(labels, **fields):
+    """Create MaterialSample records for labels in one insert_many round-trip
+
+    @return samples :: saved MaterialSample documents, in the order of labels
+    """
+    samples = [MaterialSample(label=label, **fields) for label in labels]
+    for sample in samples:
+        sample.validate()
+    ids = MaterialSample.objects.insert(samples, load_bulk=False) if samples else []
+    for sample, sample_id in zip(samples, ids):
+        sample.id = sample_id
+    return samples
+
+def measurements_from_stats(stats, parameters, samples, experiment=None, phantom=None, value='mean',
+                            details=None):
+    """Unsaved Measurement documents for every container & parameter of per-container statistics
+
+    @param stats :: roi_stats.roi_statistics output, (n_containers, n_parameters) arrays
+                    ((n_containers,) for a single parameter)
+    @param parameters :: parameter names, one per map
+    @param samples :: MaterialSample of each container (e.g., phantom_info.containers)
+    @param value :: statistic stored as the measurement value (the others go to quantification_details)
+    @param details :: extra quantification_details of every measurement (e.g., {'method' : 'lm'})
+    """
+    parameters = [parameters] if isinstance(parameters, str) else list(parameters)
+    table = {name: np.asarray(vals).reshape(len(samples), len(parameters)) for name, vals in stats.items()}
+
+    docs = []
+    for ci, sample in enumerate(samples):
+        for pi, pname in enumerate(parameters):
+            qdetails = {name: _plain(vals[ci, pi]) for name, vals in table.items() if name != value}
+            qdetails.update(details or {})
+            docs.append(Measurement(parameter=pname, value=_plain(table[value][ci, pi]),
+                                    quantification_details=qdetails, phantom=phantom, sample=sample,
+                                    experiment=experiment))
+    return docs
+
+def ingest_measurements(measurements, replace=False, ordered=True):
+    """Store many Measurement documents in one bulk_write round-trip
+
+    @param measurements :: unsaved Measurement documents (validated here; their ids are set)
+    @param replace :: first delete stored measurements with the same (phantom, sample, experiment,
+                      parameter), in the same round-trip, so re-ingesting a study does not duplicate it
+    @param ordered :: stop at the first failed write (always ordered with replace, so the deletes run first)
+
+    @return result :: pymongo BulkWriteResult (None if there is nothing to write)
+    """
+    ops = []
+    sons = []
+    deleted = set()
+    for doc in measurements:
+        doc.validate()
+        son = doc.to_mongo()
+        if replace:
+            key = tuple((name, son.get(name)) for name in _MEASUREMENT_KEY)
+            if key not in deleted:
+                deleted.add(key)
+                ops.append(DeleteMany(dict(key)))
+        sons.append(son)
+
+    ops += [InsertOne(son) for son in sons]
+    if not ops:
+        return None
+    result = Measurement._get_collection().bulk_write(ops, ordered=(ordered or replace))
+
+    # pymongo added the _id of every inserted document
+    for doc, son in zip(measurements, sons):
+        doc.id = son['_id']
+    return result
@@ -0,0 +1,172 @@
+"""
+Declarative container layouts & cached ROI sets
+
+A HexGeometry describes where the containers of a phantom are as data:
+rings of containers (count, radii in units of the container radius, angle
+of the first container & angular step) and the placement order that maps
+container numbers onto ring positions. All centers are generated at once as
+one array transform of the pose (center, in-plane angle th0 and an optional
+rotation about any axis through the center).
+
+ROI sets (the masks of every container) depend only on the phantom
+geometry, the grid and the pose, so they are kept in a small LRU cache
+(ROISetCache), optionally persisted to disk so later sessions reuse them.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import roi as ru
+
+def rotation_matrix(axis, angle):
+    """Rotation (3x3) by angle (rad) about axis ((x, y, z), right-handed)"""
+    axis = np.asarray(axis, dtype=np.float64)
+    axis = axis / np.linalg.norm(axis)
+    kx, ky, kz = axis
+    K = np.array([[0.0, -kz, ky], [kz, 0.0, -kx], [-ky, kx, 0.0]])
+    return np.eye(3) + np.sin(angle) * K + (1.0 - np.cos(angle)) * K.dot(K)
+
+class HexGeometry(object):
+    """Container layout of a phantom
+
+    @param rings :: list of (n, radii, angles, step_div): n positions per radius, the k-th (k < n) at
+                    radius radii[j] (x rc) & angle angles[j] + k * pi / step_div (rad, before th0);
+                    positions are numbered ring by ring, k-major within a ring
+    @param placement_order :: container ci sits at position placement_order[ci]
+
+    The step is given as a divisor of pi so that (k * pi) / step_div is evaluated in the same order
+    as the hand-written layouts it replaces, which keeps the centers bit-identical to them.
+    """
+    def __init__(self, rings, placement_order=None):
+        radii, angles, steps = [], [], []
+        for n, ring_radii, ring_angles, step_div in rings:
+            for k in range(n):
+                for rr, aa in zip(ring_radii, ring_angles):
+                    radii.append(rr)
+                    angles.append(aa)
+                    steps.append(k * np.pi / step_div)
+
+        order = np.arange(len(radii)) if placement_order is None else np.asarray(placement_order)
+        self.rings = tuple((n, tuple(rr), tuple(aa), step_div) for n, rr, aa, step_div in rings)
+        self.placement_order = tuple(int(pp) for pp in order)
+        self.radii = np.asarray(radii, dtype=np.float64)[order]
+        self.angles = np.asarray(angles, dtype=np.float64)[order]
+        self.steps = np.asarray(steps, dtype=np.float64)[order]
+
+    @property
+    def nc(self):
+        return len(self.radii)
+
+    @property
+    def key(self):
+        return (self.rings, self.placement_order)
+
+    def centers(self, rc, cx0, cy0, cz0, th0=0.0, rot=None):
+        """Centers (mm) of all containers: (nc, 3) array of (cx, cy, cz)
+
+        @param rc :: container radius (mm)
+        @param th0 :: in-plane rotation (rad, about the phantom (z) axis)
+        @param rot :: optional 3x3 rotation (e.g., rotation_matrix(axis, angle)) about the phantom center,
+                      applied after th0; it moves the centers only (the ROI cylinders stay parallel to z)
+        """
+        thi = (th0 + self.angles) + self.steps
+        ri = self.radii * rc
+        offsets = np.stack([ri * np.cos(thi), ri * np.sin(thi), np.zeros(self.nc)], axis=-1)
+        if rot is not None:
+            offsets = offsets.dot(np.asarray(rot, dtype=np.float64).T)
+        return np.array([cx0, cy0, cz0], dtype=np.float64) + offsets
+
+def default_roi_cache_dir():
+    """Persisted ROI sets live next to the volume cache ($PYQMRI_CACHE/rois)"""
+    root = os.environ.get('PYQMRI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pyqmri'))
+    return os.path.join(root, 'rois')
+
+class ROISetCache(object):
+    """Thread-safe LRU cache of ROI sets (lists of ru.SparseMask), optionally persisted as .npz files
+
+    Cached masks are shared between callers: do not modify them in place.
+
+    @param maxsize :: number of ROI sets kept in memory
+    @param persist :: also store ROI sets on disk (and look them up there)
+    @param cache_dir :: directory of persisted ROI sets (default: default_roi_cache_dir())
+    """
+    def __init__(self, maxsize=16, persist=False, cache_dir=None):
+        self.maxsize = maxsize
+        self.persist = persist
+        self.cache_dir = default_roi_cache_dir() if cache_dir is None else cache_dir
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.cache_dir, '{:s}.npz'.format(digest))
+
+    def _load(self, key):
+        fname = self.path(key)
+        if not os.path.exists(fname):
+            return None
+        with np.load(fname) as npz:
+            shape = tuple(npz['shape'])
+            return [ru.SparseMask(shape, npz['bbox_{:d}'.format(mi)], npz['local_{:d}'.format(mi)])
+                    for mi in range(int(npz['n_masks']))]
+
+    def _save(self, key, masks):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        arrays = {'n_masks' : len(masks), 'shape' : np.asarray(masks[0].shape if masks else ())}
+        for mi, mask in enumerate(masks):
+            arrays['bbox_{:d}'.format(mi)] = np.asarray(mask.bbox, dtype=np.int64).reshape(-1, 2)
+            arrays['local_{:d}'.format(mi)] = mask.local
+        fname = self.path(key)
+        tmp_fname = fname + '.{:d}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_fname, **arrays)
+        os.replace(tmp_fname, fname)
+
+    def get(self, key):
+        with self._lock:
+            masks = self._items.get(key)
+            if masks is not None:
+                self._items.move_to_end(key)
+                return masks
+        if self.persist:
+            masks = self._load(key)
+            if masks is not None:
+                self._put(key, masks)
+        return masks
+
+    def _put(self, key, masks):
+        with self._lock:
+            self._items[key] = masks
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return masks
+
+    def put(self, key, masks):
+        if self.persist:
+            self._save(key, masks)
+        return self._put(key, masks)
+
+    def cached(self, key, build):
+        """ROI set of key, or build() it and store it"""
+        masks = self.get(key)
+        if masks is None:
+            masks = self.put(key, build())
+        return masks
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+# shared by all phantoms unless one is given
+_shared_roi_cache = ROISetCache()
+
+def shared_roi_cache():
+    return _shared_roi_cache
@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 import mongoengine as mg
 
 from . import roi as ru
+from . import geometry as geo
+from . import registration as reg
 from . import db
 from ..img_utils import view_utils as vu
 
@@ -14,12 +16,13 @@ from ..img_utils import view_utils as vu
 #  ... is this the most efficient way to do this?
 #mg.connect('prelim')
 
-# __19c_hex_geometry
-# __6x2_plus_7_config
-_MaterialsPhantom_Mk4__6x2_plus_7_placement_order = \
-    [10, 4, 12, 3, 15, 17, 5, 8, 13, 0, 7, 14, 2, 11, 9, 6, 18, 1, 16]
-_MaterialsPhantom_Mk5__6x2_plus_7_placement_order = \
-    [14, 6, 16, 5, 7, 9, 1, 12, 17, 0, 11, 18, 4, 15, 13, 2, 10, 3, 8]
+# 19c hex geometry (6x2 plus 7 config): (n, radii (x rc), angles (rad), step_div (step = pi / step_div)) rings,
+#  the center & 6 containers at 4 rc cos(30 deg) (7), then 6 opposite pairs at 2 rc & 4 rc (6x2)
+_19C_HEX_RINGS = [
+    (1, (0.0,), (0.0,), 1.0),
+    (6, (4.0 * np.cos(np.pi / 6.0),), (np.pi / 2.0,), 3.0),
+    (6, (2.0, 4.0), (0.0, np.pi), 3.0),
+]
 
 
 # BasePhantom
@@ -117,36 +120,17 @@ class MaterialsPhantom_Mk2(BasePhantom):
 
 
 
-# MP-Mk4
-class MaterialsPhantom_Mk4(BasePhantom):
-    _designation = 'MP-Mk4'
-    _container_spec = {
-        'nc' : 19,
-        'physical' : {
-            'material' : 'glass',
-            'shape' : 'cylinder'
-        },
-        'dims' : {
-            'rc' : 13.5, # (mm)
-            'hc' : 95.25 / 2.0 # (mm) [Approximate!!!]
-        }
-    }
+# Hex-packed phantoms (MP-Mk4, MP-Mk5)
+class HexPhantom(BasePhantom):
+    """Cylindrical containers (parallel to z) in a layout given by self._geometry (geo.HexGeometry)
+
+    Subclasses only declare _designation, _container_spec and _geometry.
+    """
+    _geometry = None
 
     def __init__(self, phantom_uid, container_labels=None, roi_rd_scl=0.25, roi_ht_scl=0.5, db=False):
         if db:
-            try:
-                self.phantom_info = db.MaterialPhantom.get(phantom_uid=phantom_uid)
-            except DoesNotExist:
-                if not container_labels:
-                    raise Exception('Unable to construct phantom record')
-                
-                # otherwise build the phantom record
-                self.phantom_info = db.MaterialPhantom(phantom_uid=phantom_uid)
-                for ci,clabel in enumerate(container_labels):
-                    sample_rec = db.MaterialSample(label=clabel); sample_rec.save()
-                    self.phantom_info.containers.append(sample_rec)
-                    
-                self.phantom_info.save()
+            self.phantom_info = self._phantom_record(phantom_uid, container_labels)
         
         self.nc = self._container_spec['nc']
         self.rc = self._container_spec['dims']['rc']
@@ -163,310 +147,55 @@ class MaterialsPhantom_Mk4(BasePhantom):
                     'ht' : roi_ht,
                     'rd' : roi_rd,
                 })
-        
-        for ci, clabel in enumerate(container_labels):
-            self.roi_info.append({
-                'label' : 'C{:02d}: {:s}'.format(ci, clabel),
-                'ht' : roi_ht,
-                'rd' : roi_rd,
-            })
-        
-        return
-
-    def compute_roi_centers(self, nx, ny, nz, dx, dy, dz,
-                            cz0=None, cx0=None, cy0=None, th0=0.0):
-
-        im_cx = int(nx/2) * dx
-        im_cy = int(ny/2) * dy
-        im_cz = int(nz/2) * dz
-
-        cz = im_cz if not cz0 else cz0
-
-        roi_ctrs = []
-        roi_ctrs.append((cx0, cy0, cz))
-
-        for ci in range(1,7):
-            thi = th0 + (np.pi / 2.0) + ((ci - 1) * np.pi / 3.0)
-            del_cx = 2 * (2 * self.rc * np.cos(np.pi/6.0)) * np.cos(thi)
-            del_cy = 2 * (2 * self.rc * np.cos(np.pi/6.0)) * np.sin(thi)
-
-            roi_ctrs.append((
-                cx0 + del_cx,
-                cy0 + del_cy,
-                cz
-            ))
-
-        for ci in range(7,self.nc):
-            c1 = ci - 7
-            if (c1 % 2 == 0):
-                thi = th0 + np.floor(c1/2) * np.pi / 3.0
-                del_cx = 2 * self.rc * np.cos(thi)
-                del_cy = 2 * self.rc * np.sin(thi)
-            else:
-                thi = np.pi + th0 + np.floor(c1/2) * np.pi / 3.0
-                del_cx = 4 * self.rc * np.cos(thi)
-                del_cy = 4 * self.rc * np.sin(thi)
-
-            roi_ctrs.append((
-                cx0 + del_cx,
-                cy0 + del_cy,
-                cz
-            ))
-
-        roi_ctrs = [tuple(cc) for cc in np.array(roi_ctrs)[__6x2_plus_7_placement_order]]
-        return roi_ctrs
-        
-    def compute_rois(self, nx, ny, nz, dx, dy, dz,
-                     cz0=None, cx0=None, cy0=None, th0=0.0):
-
-        # initialize cx0, cy0, cz0, th0 and/or set defaults
-        im_cx = int(nx/2) * dx
-        im_cy = int(ny/2) * dy
-        im_cz = int(nz/2) * dz
-
-        cz = cz0 if cz0 else im_cz
-        cx0 = cx0 if cx0 else im_cx
-        cy0 = cy0 if cy0 else im_cy
-
-        th0 = th0
-
-        # compute ROI centers:
-        roi_ctrs = self.compute_roi_centers(nx, ny, nz, dx, dy, dz,
-                                            cz0=cz, cx0=cx0, cy0=cy0, th0=th0)
-
-        # populate roi_info and generate masks
-        for ci, roi in enumerate(self.roi_info):
-            cx = roi_ctrs[ci][0]
-            cy = roi_ctrs[ci][1]
-            cz = roi_ctrs[ci][2]
-            
-            roi['cx'] = cx
-            roi['cy'] = cy
-            roi['cz'] = cz
-
-            roi['mask'] = ru.CylinderROI(
-                roi['cx'],
-                roi['cy'],
-                roi['cz'],
-                roi['ht'],
-                roi['rd'],
-            ).generate_mask(nx, ny, nz, dx, dy, dz)
-
-        return
-    
-    def preview_geometry_2d(self, prvw_slc, dx, dy,
-                            dcx0=0.0, # (mm)
-                            dcy0=0.0, # (mm)
-                            dth=0.0,  # (deg)
-                            hide_circles=False,
-                            slctype='mag',
-                            label_font={
-                                'color' : 'red',
-                                'fontsize' : 20,
-                                'horizontalalignment' : 'center',
-                                'verticalalignment' : 'center'
-                            }):
-        
-        cx0 = dx * int(prvw_slc.shape[0] / 2.0) + dcx0
-        cy0 = dy * int(prvw_slc.shape[1] / 2.0) + dcy0
-        dth0 = dth * np.pi / 180.0
-
-        nx = prvw_slc.shape[0]
-        ny = prvw_slc.shape[1]
-        
-        roi_ctrs = self.compute_roi_centers(nx, ny, 1,
-                                            dx, dy, 1,
-                                            cz0=0,
-                                            cx0=cx0,
-                                            cy0=cy0,
-                                            th0=dth0)
-
-        fig = plt.figure(figsize=(10.0, 10.0))
-        if not (slctype == 'mag'):
-            if (slctype == 'cplx'): # ... this needs some work
-                rr, cc, prvw_slc = vu.norm_mag_slice(prvw_slc)
-            else:
-                raise Exception("Slice type (slctype) should be 'mag' or 'cplx'")
-        
-        plt.imshow(prvw_slc)
-        
-        th = np.linspace(0.0, 2 * np.pi, 100)
-        for ci, cc in enumerate(roi_ctrs):
-            cx = cc[0]/dx
-            cy = cc[1]/dy
-            
-            plt.text(cy, cx, 'C{:02d}'.format(ci),
-                     fontdict=label_font)
-
-            if not hide_circles:
-                xx = (self.rc / dy) * np.cos(th) + cy
-                yy = (self.rc / dx) * np.sin(th) + cx
-                plt.plot(xx, yy, 'r')
-
-        return fig
-
-    def preview_geometry_3d(self, vol3d, nx, ny, nz, dx, dy, dz,
-                            cz0=None,
-                            cy0=None,
-                            cx0=None,
-                            th0=0.0,
-                            voltype='cplx',
-                            alpha=0.4):
-        
-        if (voltype not in ('cplx', 'mag')):
-            raise Exception("Volume type (voltype) should be 'mag' or 'cplx'")
-        
-        # get ready for some "one line" magic (if it works!)
-        prvw_slc_gen = vu.norm_mag_slice if (voltype=='cplx') else (lambda vol, slc, ax: {
-            0: (np.arange(vol.shape[1]),
-                np.arange(vol.shape[2]),
-                vol[slc, :, :]),
-            1: (np.arange(vol.shape[0]),
-                np.arange(vol.shape[2]),
-                vol[:, slc, :]),
-            2: (np.arange(vol.shape[0]),
-                np.arange(vol.shape[1]),
-                vol[:, :, slc])
-        }.get(ax))
-        
-        try:
-            figs = []
-            for ci, roi in enumerate(self.roi_info):
-                fig, ax = plt.subplots(1, 3, figsize=(40.0, 20.0))
-                
-                # Plot a slice in each axis through the ROI center
-                cx, cy, cz = (
-                    int(roi['cx']/dx),
-                    int(roi['cy']/dy),
-                    int(roi['cz']/dz)
-                )
-                
-                rows, cols, xslice = prvw_slc_gen(vol3d, cx, 0)
-                rows, cols, yslice = prvw_slc_gen(vol3d, cy, 1)
-                rows, cols, zslice = prvw_slc_gen(vol3d, cz, 2)
-                
-                roi_data = np.zeros((nx, ny, nz, 4), dtype=np.float)
-                roi_data[:,:,:,1] = roi['mask']
-                roi_data[:,:,:,3] = alpha * roi['mask']
-                
-                ax[0].imshow(xslice, cmap=plt.cm.gray)
-                ax[0].imshow(roi_data[cx,:,:,:])
-                
-                ax[1].imshow(yslice, cmap=plt.cm.gray)
-                ax[1].imshow(roi_data[:,cy,:,:])
-                
-                ax[2].imshow(zslice, cmap=plt.cm.gray)
-                ax[2].imshow(roi_data[:,:,cz,:])
-                
-                fig.tight_layout()
-                figs.append(fig)
-        except KeyError:
-            raise Exception("ROI masks not computed")
-            
-        return figs
-
-
-# MP-Mk5
-class MaterialsPhantom_Mk5(BasePhantom):
-    _designation = 'MP-Mk5'
-    _container_spec = {
-        'nc' : 19,
-        'physical' : {
-            'material' : 'HDPE',
-            'shape' : 'cylinder'
-        },
-        'dims' : {
-            'rc' : 13.5, # (mm)
-            'hc' : 95.25 / 2.0 # (mm) [Approximate!!!]
-        }
-    }
-
-    def __init__(self, phantom_uid, container_labels=None, roi_rd_scl=0.25, roi_ht_scl=0.5, db=False):
-        if db:
-            try:
-                self.phantom_info = db.MaterialPhantom.get(phantom_uid=phantom_uid)
-            except DoesNotExist:
-                if not container_labels:
-                    raise Exception('Unable to construct phantom record')
-                
-                # otherwise build the phantom record
-                self.phantom_info = db.MaterialPhantom(phantom_uid=phantom_uid)
-                for ci,clabel in enumerate(container_labels):
-                    sample_rec = db.MaterialSample(label=clabel); sample_rec.save()
-                    self.phantom_info.containers.append(sample_rec)
-                    
-                self.phantom_info.save()
-        
-        self.nc = self._container_spec['nc']
-        self.rc = self._container_spec['dims']['rc']
-        self.hc = self._container_spec['dims']['hc']
-
-        roi_ht = self.hc * roi_ht_scl
-        roi_rd = self.rc * roi_rd_scl
-        
-        self.roi_info = []
-        if db:
-            for cc in self.phantom_info.containers:
+        else:
+            for ci, clabel in enumerate(container_labels):
                 self.roi_info.append({
-                    'label' : cc.label,
+                    'label' : 'C{:02d}: {:s}'.format(ci, clabel),
                     'ht' : roi_ht,
                     'rd' : roi_rd,
                 })
         
-        for ci, clabel in enumerate(container_labels):
-            self.roi_info.append({
-                'label' : 'C{:02d}: {:s}'.format(ci, clabel),
-                'ht' : roi_ht,
-                'rd' : roi_rd,
-            })
-        
         return
 
+    def _phantom_record(self, phantom_uid, container_labels):
+        """Phantom record from the database (created from container_labels if there is none)"""
+        try:
+            return db.MaterialPhantom.objects.get(phantom_uid=phantom_uid)
+        except mg.DoesNotExist:
+            if not container_labels:
+                raise Exception('Unable to construct phantom record')
+            
+            # otherwise build the phantom record (all sample records in one round-trip)
+            phantom_info = db.MaterialPhantom(phantom_uid=phantom_uid)
+            phantom_info.containers = db.insert_samples(container_labels)
+            phantom_info.save()
+            return phantom_info
+
     def compute_roi_centers(self, nx, ny, nz, dx, dy, dz,
-                            cz0=None, cx0=None, cy0=None, th0=0.0):
+                            cz0=None, cx0=None, cy0=None, th0=0.0, rot=None):
+        """Container centers (mm), [(cx, cy, cz), ...] in container order
 
-        im_cx = int(nx/2) * dx
-        im_cy = int(ny/2) * dy
+        @param rot :: optional 3x3 rotation about the phantom center (e.g., geo.rotation_matrix(axis, angle))
+        """
         im_cz = int(nz/2) * dz
 
         cz = im_cz if not cz0 else cz0
 
-        roi_ctrs = []
-        roi_ctrs.append((cx0, cy0, cz))
-
-        for ci in range(1,7):
-            thi = th0 + (np.pi / 2.0) + ((ci - 1) * np.pi / 3.0)
-            del_cx = 2 * (2 * self.rc * np.cos(np.pi/6.0)) * np.cos(thi)
-            del_cy = 2 * (2 * self.rc * np.cos(np.pi/6.0)) * np.sin(thi)
-
-            roi_ctrs.append((
-                cx0 + del_cx,
-                cy0 + del_cy,
-                cz
-            ))
-
-        for ci in range(7,self.nc):
-            c1 = ci - 7
-            if (c1 % 2 == 0):
-                thi = th0 + np.floor(c1/2) * np.pi / 3.0
-                del_cx = 2 * self.rc * np.cos(thi)
-                del_cy = 2 * self.rc * np.sin(thi)
-            else:
-                thi = np.pi + th0 + np.floor(c1/2) * np.pi / 3.0
-                del_cx = 4 * self.rc * np.cos(thi)
-                del_cy = 4 * self.rc * np.sin(thi)
-
-            roi_ctrs.append((
-                cx0 + del_cx,
-                cy0 + del_cy,
-                cz
-            ))
-
-        roi_ctrs = [tuple(cc) for cc in np.array(roi_ctrs)[__6x2_plus_7_placement_order]]
-        return roi_ctrs
+        roi_ctrs = self._geometry.centers(self.rc, cx0, cy0, cz, th0=th0, rot=rot)
+        return [tuple(cc) for cc in roi_ctrs]
         
     def compute_rois(self, nx, ny, nz, dx, dy, dz,
-                     cz0=None, cx0=None, cy0=None, th0=0.0):
+                     cz0=None, cx0=None, cy0=None, th0=0.0, rot=None, sparse=True, labels=False,
+                     cache=True):
+        """ROI centers & masks ([x, y, z]) of all containers
+
+        @param rot :: optional 3x3 rotation about the phantom center (the ROI cylinders stay parallel to z)
+        @param sparse :: store masks as ru.SparseMask (bounding box only) instead of dense float32 volumes
+        @param labels :: also build self.roi_labels, one int8 [z, y, x] volume labelling every
+                         container (-1: background, ci: roi_info[ci]), and return it
+        @param cache :: reuse the masks of an identical geometry, grid & pose (True: the shared
+                        geo.ROISetCache, or a geo.ROISetCache, e.g., persisted; False: always compute)
+        """
 
         # initialize cx0, cy0, cz0, th0 and/or set defaults
         im_cx = int(nx/2) * dx
@@ -481,27 +210,51 @@ class MaterialsPhantom_Mk5(BasePhantom):
 
         # compute ROI centers:
         roi_ctrs = self.compute_roi_centers(nx, ny, nz, dx, dy, dz,
-                                            cz0=cz, cx0=cx0, cy0=cy0, th0=th0)
+                                            cz0=cz, cx0=cx0, cy0=cy0, th0=th0, rot=rot)
 
         # populate roi_info and generate masks
         for ci, roi in enumerate(self.roi_info):
-            cx = roi_ctrs[ci][0]
-            cy = roi_ctrs[ci][1]
-            cz = roi_ctrs[ci][2]
-            
-            roi['cx'] = cx
-            roi['cy'] = cy
-            roi['cz'] = cz
-
-            roi['mask'] = ru.CylinderROI(
-                roi['cx'],
-                roi['cy'],
-                roi['cz'],
-                roi['ht'],
-                roi['rd'],
-            ).generate_mask(nx, ny, nz, dx, dy, dz)
-
+            roi['cx'] = roi_ctrs[ci][0]
+            roi['cy'] = roi_ctrs[ci][1]
+            roi['cz'] = roi_ctrs[ci][2]
+
+        def build_masks():
+            return [ru.CylinderROI(roi['cx'], roi['cy'], roi['cz'], roi['ht'], roi['rd'],
+                                   ).generate_sparse_mask(nx, ny, nz, dx, dy, dz) for roi in self.roi_info]
+
+        if cache:
+            roi_cache = geo.shared_roi_cache() if cache is True else cache
+            key = (self._designation, self._geometry.key, float(self.rc),
+                   tuple((float(roi['ht']), float(roi['rd'])) for roi in self.roi_info),
+                   (int(nx), int(ny), int(nz)), (float(dx), float(dy), float(dz)),
+                   (float(cx0), float(cy0), float(cz), float(th0)),
+                   None if rot is None else tuple(float(rr) for rr in np.ravel(rot)))
+            masks = roi_cache.cached(key, build_masks)
+        else:
+            masks = build_masks()
+
+        for roi, mask in zip(self.roi_info, masks):
+            roi['mask'] = mask if sparse else mask.dense(np.float32)
+
+        if labels:
+            self.roi_labels = ru.label_volume([roi['mask'] for roi in self.roi_info])
+            return self.roi_labels
         return
+
+    def register_pose(self, vol3d, dx, dy, dz, voltype='cplx', th0=0.0, th_range=30.0, cz0=None,
+                      max_shift=None):
+        """Find cx0, cy0, cz0 & th0 (compute_rois arguments) by maximizing the container contrast
+
+        Coarse-to-fine search (see registration.register_pose); th0 is found modulo 60 degrees,
+        within +/- th_range (deg) of the given th0. Sets self.pose & self.pose_score.
+
+            pose = phantom.register_pose(vol, dx, dy, dz)
+            phantom.compute_rois(nx, ny, nz, dx, dy, dz, **pose)
+        """
+        self.pose, self.pose_score = reg.register_pose(self, vol3d, dx, dy, dz, voltype=voltype,
+                                                       th0=th0, th_range=th_range, cz0=cz0,
+                                                       max_shift=max_shift)
+        return self.pose
     
     def preview_geometry_2d(self, prvw_slc, dx, dy,
                             dcx0=0.0, # (mm)
@@ -533,7 +286,7 @@ class MaterialsPhantom_Mk5(BasePhantom):
         fig = plt.figure(figsize=(10.0, 10.0))
         if not (slctype == 'mag'):
             if (slctype == 'cplx'): # ... this needs some work
-                rr, cc, prvw_slc = vu.norm_mag_slice(prvw_slc)
+                prvw_slc = vu.magnitude(prvw_slc, pairs=(np.ndim(prvw_slc) == 3))
             else:
                 raise Exception("Slice type (slctype) should be 'mag' or 'cplx'")
         
@@ -554,13 +307,15 @@ class MaterialsPhantom_Mk5(BasePhantom):
 
         return fig
 
+
     def preview_geometry_3d(self, vol3d, nx, ny, nz, dx, dy, dz,
                             cz0=None,
                             cy0=None,
                             cx0=None,
                             th0=0.0,
                             voltype='cplx',
-                            alpha=0.4):
+                            alpha=0.4,
+                            figsize=(30.0, 10.0)):
         
         if (voltype not in ('cplx', 'mag')):
             raise Exception("Volume type (voltype) should be 'mag' or 'cplx'")
@@ -579,12 +334,16 @@ class MaterialsPhantom_Mk5(BasePhantom):
                         np.arange(vol.shape[1]),
                         vol[:, :, slc])
         
-        prvw_slc_gen = vu.norm_mag_slice if (voltype=='cplx') else mag_slc_gen
+        # magnitude of the whole volume once, transposed to [x, y, z] like the 'mag' volumes
+        if (voltype == 'cplx'):
+            vol3d = vu.magnitude(vol3d, pairs=(np.ndim(vol3d) == 4)).T
+        
+        prvw_slc_gen = mag_slc_gen
         
         try:
             figs = []
             for ci, roi in enumerate(self.roi_info):
-                fig, ax = plt.subplots(1, 3, figsize=(40.0, 20.0))
+                fig, ax = plt.subplots(1, 3, figsize=figsize)
                 
                 # Plot a slice in each axis through the ROI center
                 cx, cy, cz = (
@@ -597,18 +356,15 @@ class MaterialsPhantom_Mk5(BasePhantom):
                 rows, cols, yslice = prvw_slc_gen(vol3d, cy, 1)
                 rows, cols, zslice = prvw_slc_gen(vol3d, cz, 2)
                 
-                roi_data = np.zeros((nx, ny, nz, 4), dtype=np.float)
-                roi_data[:,:,:,1] = roi['mask']
-                roi_data[:,:,:,3] = alpha * roi['mask']
-                
+                # overlays only for the 2-D mask slices that are shown
                 ax[0].imshow(xslice, cmap=plt.cm.gray)
-                ax[0].imshow(roi_data[cx,:,:,:])
+                ax[0].imshow(vu.mask_rgba(roi['mask'][cx,:,:], alpha=alpha))
                 
                 ax[1].imshow(yslice, cmap=plt.cm.gray)
-                ax[1].imshow(roi_data[:,cy,:,:])
+                ax[1].imshow(vu.mask_rgba(roi['mask'][:,cy,:], alpha=alpha))
                 
                 ax[2].imshow(zslice, cmap=plt.cm.gray)
-                ax[2].imshow(roi_data[:,:,cz,:])
+                ax[2].imshow(vu.mask_rgba(roi['mask'][:,:,cz], alpha=alpha))
                 
                 fig.tight_layout()
                 figs.append(fig)
@@ -616,3 +372,39 @@ class MaterialsPhantom_Mk5(BasePhantom):
             raise Exception("ROI masks not computed")
             
         return figs
+
+
+# MP-Mk4
+class MaterialsPhantom_Mk4(HexPhantom):
+    _designation = 'MP-Mk4'
+    _container_spec = {
+        'nc' : 19,
+        'physical' : {
+            'material' : 'glass',
+            'shape' : 'cylinder'
+        },
+        'dims' : {
+            'rc' : 13.5, # (mm)
+            'hc' : 95.25 / 2.0 # (mm) [Approximate!!!]
+        }
+    }
+    _geometry = geo.HexGeometry(_19C_HEX_RINGS,
+                                placement_order=[10, 4, 12, 3, 15, 17, 5, 8, 13, 0, 7, 14, 2, 11, 9, 6, 18, 1, 16])
+
+
+# MP-Mk5
+class MaterialsPhantom_Mk5(HexPhantom):
+    _designation = 'MP-Mk5'
+    _container_spec = {
+        'nc' : 19,
+        'physical' : {
+            'material' : 'HDPE',
+            'shape' : 'cylinder'
+        },
+        'dims' : {
+            'rc' : 13.5, # (mm)
+            'hc' : 95.25 / 2.0 # (mm) [Approximate!!!]
+        }
+    }
+    _geometry = geo.HexGeometry(_19C_HEX_RINGS,
+                                placement_order=[14, 6, 16, 5, 7, 9, 1, 12, 17, 0, 11, 18, 4, 15, 13, 2, 10, 3, 8])
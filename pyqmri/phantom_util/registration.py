@@ -0,0 +1,230 @@
+"""
+Automatic phantom pose registration
+
+Finds the pose (cx0, cy0, cz0, th0) of a hex-packed phantom (Mk4/Mk5) in a
+magnitude volume, i.e., the arguments of compute_rois, instead of tuning
+them by hand in preview_geometry_2d.
+
+The in-plane pose is found on an axial image (mean over the container
+slab) by correlating it with a template of the container layout from
+compute_roi_centers: positive inside the containers (a cone, highest at the
+centers), negative in the gaps & around the phantom, so the score is a
+weighted container contrast that peaks smoothly at the true pose. For each
+candidate angle the template is correlated with the image by FFT, which
+scores every translation at once. The search runs coarse-to-fine over a 2x pyramid:
+all angles of the range and all translations at the coarsest level, then a
+few angles and a few pixels around the previous optimum per finer level,
+and a sub-pixel (parabolic) refinement at full resolution. cz0 is the
+center of the z window (container height) of highest container contrast.
+
+The container layout is 6-fold symmetric, so th0 is only defined modulo
+60 degrees (the default search range is +/- 30 degrees around th0).
+
+    pose = phantom.register_pose(vol, dx, dy, dz)
+    phantom.compute_rois(nx, ny, nz, dx, dy, dz, **pose)
+"""
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+from ..img_utils import view_utils as vu
+from ..img_utils.preview_cache import downsample2
+
+def _xyz_magnitude(vol, voltype):
+    """Magnitude as [x, y, z] (or [x, y]), like preview_geometry_3d / _2d"""
+    if (voltype not in ('cplx', 'mag')):
+        raise Exception("Volume type (voltype) should be 'mag' or 'cplx'")
+    if (voltype == 'mag'):
+        return np.asarray(vol, dtype=np.float32)
+    if (np.ndim(vol) == 2) or ((np.ndim(vol) == 3) and (np.shape(vol)[-1] == 2)):
+        # complex slices are [x, y] (as in preview_geometry_2d)
+        return vu.magnitude(vol, pairs=(np.ndim(vol) == 3)).astype(np.float32)
+    return vu.magnitude(vol, pairs=(np.ndim(vol) == 4)).T.astype(np.float32)
+
+def _layout_offsets(phantom, thetas):
+    """Container centers (mm) relative to the phantom center, for each angle: (n_angles, nc, 2)"""
+    return np.array([[cc[:2] for cc in phantom.compute_roi_centers(1, 1, 1, 1.0, 1.0, 1.0, cz0=1.0,
+                                                                    cx0=0.0, cy0=0.0, th0=th)]
+                     for th in thetas])
+
+def _template_weights(dist_c, dist_p, rc, r_hull, dpix, edge_scl=1.0, ramp_scl=0.25, margin=0.5):
+    """Zero-sum contrast weights from the distance to the nearest container center & to the phantom center
+
+    Inside the containers the weight is a cone, 1 at the center falling to 0 at edge_scl * rc; the
+    background weight rises from 0 at the edge to 1 at (edge_scl + ramp_scl) * rc and stays there
+    (up to margin * rc outside the phantom). There is no flat band at the container edges, so the
+    score falls off smoothly (about quadratically) around the true pose and the sub-pixel
+    refinement has a peak to fit. The two parts are normalized to +1 / -1 in total.
+    """
+    r_edge = edge_scl * rc
+    w_in = np.clip(1.0 - dist_c / r_edge, 0.0, 1.0)
+    w_bg = (np.clip((dist_c - r_edge) / max(ramp_scl * rc, dpix), 0.0, 1.0) *
+            np.clip(((r_hull + margin * rc) - dist_p) / dpix + 0.5, 0.0, 1.0))
+    n_in = np.maximum(w_in.sum(axis=(-2, -1), keepdims=True), 1e-12)
+    n_bg = np.maximum(w_bg.sum(axis=(-2, -1), keepdims=True), 1e-12)
+    return w_in / n_in - w_bg / n_bg
+
+def _nearest_center_distance(xg, yg, offsets):
+    """Distance (mm) from grid points to the nearest of the centers, for each angle: (n_angles, nx, ny)"""
+    dist = None
+    for ci in range(offsets.shape[1]):
+        dd = np.hypot(xg[None] - offsets[:, ci, 0, None, None], yg[None] - offsets[:, ci, 1, None, None])
+        dist = dd if dist is None else np.minimum(dist, dd)
+    return dist
+
+def layout_templates(phantom, thetas, dx, dy, **weight_kwargs):
+    """Contrast templates of the container layout, centered on the phantom center
+
+    @param thetas :: angles (rad)
+    @param dx, dy :: pixel size (mm)
+
+    @return templates :: (n_angles, mx, my) zero-sum weights, phantom center at pixel (mx // 2, my // 2)
+    """
+    offsets = _layout_offsets(phantom, np.atleast_1d(thetas))
+    r_hull = np.max(np.hypot(offsets[..., 0], offsets[..., 1])) + phantom.rc
+    extent = r_hull + phantom.rc
+    hx, hy = int(np.ceil(extent / dx)), int(np.ceil(extent / dy))
+    xg, yg = np.meshgrid(np.arange(-hx, hx + 1) * dx, np.arange(-hy, hy + 1) * dy, indexing='ij')
+
+    dist_c = _nearest_center_distance(xg, yg, offsets)
+    return _template_weights(dist_c, np.hypot(xg, yg)[None], phantom.rc, r_hull, min(dx, dy), **weight_kwargs)
+
+def correlate_templates(img, templates):
+    """Score of every template at every position of its center in img (FFT correlation, no wrap-around)
+
+    @param img :: [x, y] image
+    @param templates :: (n_templates, mx, my), centers at (mx // 2, my // 2)
+
+    @return scores :: (n_templates, x, y), scores[ti, px, py] = sum(template placed with its center at (px, py) * img)
+    """
+    nx, ny = img.shape
+    n_t, mx, my = templates.shape
+    px, py = nx + mx, ny + my
+    f_img = np.fft.rfft2(img, s=(px, py))
+    f_tpl = np.fft.rfft2(templates, s=(px, py))
+    corr = np.fft.irfft2(f_img[None] * np.conj(f_tpl), s=(px, py))
+
+    # corr[k] = sum_u img[u + k] tpl[u]: the center sits at k + m // 2
+    ix = (np.arange(nx) - mx // 2) % px
+    iy = (np.arange(ny) - my // 2) % py
+    return corr[:, ix[:, None], iy[None, :]]
+
+def _parabolic_peak(sm, s0, sp):
+    """Offset (-0.5 .. 0.5) of the vertex of the parabola through (-1, sm), (0, s0), (1, sp)"""
+    den = sm - 2.0 * s0 + sp
+    return 0.0 if den >= 0 else float(np.clip(0.5 * (sm - sp) / den, -0.5, 0.5))
+
+def _z_window_center(profile, width):
+    """Index of the center of the width-sample window of highest mean in profile"""
+    width = int(min(max(round(width), 1), len(profile)))
+    csum = np.concatenate(([0.0], np.cumsum(profile)))
+    means = (csum[width:] - csum[:-width]) / width
+    return int(np.argmax(means)) + (width - 1) / 2.0
+
+def register_pose(phantom, vol, dx, dy, dz, voltype='cplx', th0=0.0, th_range=30.0, cz0=None,
+                  max_shift=None, min_radius_px=4.0, n_fine_angles=5):
+    """Pose (cx0, cy0, cz0, th0) of a hex-packed phantom (see compute_rois) from its image
+
+    @param phantom :: MaterialsPhantom_Mk4 / _Mk5 (anything with compute_roi_centers, rc, hc)
+    @param vol :: complex [z, y, x] volume ('cplx') or magnitude [x, y, z] volume ('mag'),
+                  or a single [x, y] slice (as in preview_geometry_2d)
+    @param dx, dy, dz :: voxel size (mm)
+    @param th0 :: initial angle (rad)
+    @param th_range :: angles searched around th0 (+/- deg; 30: the whole hex symmetry period)
+    @param cz0 :: container center along z (mm) (default: registered as well)
+    @param max_shift :: maximum in-plane distance (mm) of the phantom center from the image center
+                        (default: anywhere in the image)
+    @param min_radius_px :: container radius (pixels) at the coarsest level
+    @param n_fine_angles :: angles tried around the previous optimum at each finer level
+
+    @return pose :: {'cx0', 'cy0', 'cz0', 'th0'} in mm / rad
+    @return score :: container contrast of the pose (weighted mean inside - mean outside the containers)
+    """
+    mag = _xyz_magnitude(vol, voltype)
+    if mag.ndim == 2:
+        mag = mag[:, :, None]
+    nx, ny, nz = mag.shape
+
+    # axial image: mean over the central half of the container slab
+    if cz0 is None:
+        cz_idx = _z_window_center(mag.mean(axis=(0, 1)), phantom.hc / dz)
+    else:
+        cz_idx = cz0 / dz
+    half = max(int(round(phantom.hc / (4.0 * dz))), 0)
+    z0 = min(max(int(round(cz_idx)) - half, 0), nz - 1)
+    z1 = min(max(int(round(cz_idx)) + half + 1, z0 + 1), nz)
+    img = mag[:, :, z0:z1].mean(axis=2)
+    img = img - np.percentile(img, 10.0)
+
+    # pyramid (the last three axes are downsampled, the image is [1, x, y])
+    pyramid = [img]
+    while ((phantom.rc / (max(dx, dy) * 2 ** len(pyramid)) >= min_radius_px) and
+           (min(pyramid[-1].shape) >= 32)):
+        pyramid.append(downsample2(pyramid[-1][None])[0])
+
+    # coarsest level: all angles of the range & every translation, then around the optimum
+    th_range = np.deg2rad(th_range)
+    best = None
+    for lvl in range(len(pyramid) - 1, -1, -1):
+        scl = 2 ** lvl
+        ldx, ldy = dx * scl, dy * scl
+        # level pixel p covers full resolution pixels p * scl ... (p + 1) * scl - 1
+        off = (scl - 1) / 2.0
+        # angular step: ~1 pixel displacement of the outermost containers
+        step = min(ldx, ldy) / (4.0 * phantom.rc)
+        limg = pyramid[lvl]
+
+        if best is None:
+            n_ang = int(np.ceil(th_range / step))
+            thetas = th0 + np.arange(-n_ang, n_ang + 1) * step
+            allowed = np.ones(limg.shape, dtype=bool)
+            if max_shift is not None:
+                xg = (np.arange(limg.shape[0]) * scl + off) * dx - int(nx / 2) * dx
+                yg = (np.arange(limg.shape[1]) * scl + off) * dy - int(ny / 2) * dy
+                allowed = np.hypot(xg[:, None], yg[None, :]) <= max_shift
+        else:
+            b_th, b_x, b_y = best
+            thetas = b_th + (np.arange(n_fine_angles) - n_fine_angles // 2) * step
+            # +/- 2 pixels of this level around the previous optimum
+            px = (b_x / dx - off) / scl
+            py = (b_y / dy - off) / scl
+            xi = np.arange(limg.shape[0])
+            yi = np.arange(limg.shape[1])
+            allowed = (np.abs(xi - px)[:, None] <= 2.0) & (np.abs(yi - py)[None, :] <= 2.0)
+
+        scores = correlate_templates(limg, layout_templates(phantom, thetas, ldx, ldy))
+        ti, pxi, pyi = np.unravel_index(np.argmax(np.where(allowed[None], scores, -np.inf)), scores.shape)
+        best = (thetas[ti], (pxi * scl + off) * dx, (pyi * scl + off) * dy)
+
+    # sub-pixel / sub-step refinement at full resolution
+    s0 = scores[ti, pxi, pyi]
+    d_th = d_x = d_y = 0.0
+    if 0 < ti < len(thetas) - 1:
+        d_th = _parabolic_peak(scores[ti - 1, pxi, pyi], s0, scores[ti + 1, pxi, pyi])
+    if 0 < pxi < nx - 1:
+        d_x = _parabolic_peak(scores[ti, pxi - 1, pyi], s0, scores[ti, pxi + 1, pyi])
+    if 0 < pyi < ny - 1:
+        d_y = _parabolic_peak(scores[ti, pxi, pyi - 1], s0, scores[ti, pxi, pyi + 1])
+    th_best = thetas[ti] + d_th * step
+    cx_best = (pxi + d_x) * dx
+    cy_best = (pyi + d_y) * dy
+
+    # cz0: z window (container height) of highest container contrast
+    if cz0 is None and nz > 1:
+        weights = placed_template(phantom, nx, ny, dx, dy, cx_best, cy_best, th_best)
+        contrast = np.tensordot(weights, mag, axes=([0, 1], [0, 1]))
+        cz0 = _z_window_center(contrast, phantom.hc / dz) * dz
+    elif cz0 is None:
+        cz0 = 0.0
+
+    pose = {'cx0' : float(cx_best), 'cy0' : float(cy_best), 'cz0' : float(cz0), 'th0' : float(th_best)}
+    return pose, float(s0)
+
+def placed_template(phantom, nx, ny, dx, dy, cx0, cy0, th0, **weight_kwargs):
+    """Contrast weights of the container layout at a pose, on the [x, y] image grid"""
+    offsets = _layout_offsets(phantom, [th0])
+    r_hull = np.max(np.hypot(offsets[..., 0], offsets[..., 1])) + phantom.rc
+    xg, yg = np.meshgrid(np.arange(nx) * dx - cx0, np.arange(ny) * dy - cy0, indexing='ij')
+    dist_c = _nearest_center_distance(xg, yg, offsets)
+    return _template_weights(dist_c, np.hypot(xg, yg)[None], phantom.rc, r_hull,
+                             min(dx, dy), **weight_kwargs)[0]
@@ -2,6 +2,297 @@ __author__ = "Dharshan Chandramohan"
 
 import numpy as np
 
+class SparseMask(object):
+    """Boolean mask stored as a bounding box and the local mask inside it
+
+    Behaves like the dense (float32 by default) mask where the code needs it:
+    basic indexing (points, slices, 2-D planes) returns dense values of just
+    the selection, np.asarray / dense() builds the full volume on demand,
+    np.nonzero, sum / max / min work, comparisons with a scalar (mask > 0,
+    mask == 1) give boolean masks (sparse where the background compares
+    False), and &, |, ^ between masks (and difference) stay sparse.
+    Arithmetic (+, -, *) gives dense values, as with dense masks.
+
+    @param shape :: shape of the full mask
+    @param bbox :: ((start, stop), ...) of the bounding box along each axis
+    @param local :: boolean mask of the bounding box
+    @param dtype :: dtype of dense values (float32, like the dense ROI masks)
+    """
+    def __init__(self, shape, bbox, local, dtype=np.float32):
+        self.shape = tuple(int(nn) for nn in shape)
+        self.bbox = tuple((int(b0), int(b1)) for b0, b1 in bbox)
+        self.local = np.asarray(local, dtype=bool)
+        self.dtype = np.dtype(dtype)
+        if self.local.shape != tuple(b1 - b0 for b0, b1 in self.bbox):
+            raise Exception('Local mask shape {:s} does not match the bounding box {:s}'.format(
+                str(self.local.shape), str(self.bbox)))
+
+    @classmethod
+    def from_local(cls, shape, offset, local, dtype=np.float32):
+        """Mask from a local boolean block at offset (the bounding box is trimmed to the set voxels)"""
+        local = np.asarray(local, dtype=bool)
+        if not local.any():
+            return cls(shape, [(0, 0)] * len(shape), np.zeros((0,) * len(shape), dtype=bool), dtype)
+
+        bbox = []
+        for ai in range(local.ndim):
+            hit = np.nonzero(local.any(axis=tuple(aa for aa in range(local.ndim) if aa != ai)))[0]
+            bbox.append((offset[ai] + hit[0], offset[ai] + hit[-1] + 1))
+        trim = tuple(slice(b0 - oo, b1 - oo) for (b0, b1), oo in zip(bbox, offset))
+        return cls(shape, bbox, local[trim], dtype)
+
+    @classmethod
+    def from_dense(cls, dense, dtype=None):
+        dense = np.asarray(dense)
+        return cls.from_local(dense.shape, (0,) * dense.ndim, dense != 0,
+                              dense.dtype if dtype is None else dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.local.nbytes
+
+    @property
+    def count(self):
+        """Number of voxels in the mask"""
+        return int(np.count_nonzero(self.local))
+
+    def bbox_slices(self):
+        return tuple(slice(b0, b1) for b0, b1 in self.bbox)
+
+    def dense(self, dtype=None):
+        """Full-volume mask"""
+        out = np.zeros(self.shape, dtype=self.dtype if dtype is None else dtype)
+        out[self.bbox_slices()] = self.local
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dense(dtype)
+
+    def astype(self, dtype):
+        return self.dense(dtype)
+
+    # reductions: whole-mask results from the voxel count, anything else from the dense mask
+    def sum(self, axis=None, dtype=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            if dtype is None:
+                # as numpy: bool masks sum to integers
+                dtype = np.int_ if self.dtype.kind == 'b' else self.dtype
+            return np.dtype(dtype).type(self.count)
+        return self.dense().sum(axis=axis, dtype=dtype, out=out, keepdims=keepdims)
+
+    def max(self, axis=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            return self.dtype.type(self.count > 0)
+        return self.dense().max(axis=axis, out=out, keepdims=keepdims)
+
+    def min(self, axis=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            return self.dtype.type(self.count == self.size)
+        return self.dense().min(axis=axis, out=out, keepdims=keepdims)
+
+    def mean(self, axis=None, dtype=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            if dtype is None:
+                dtype = self.dtype if self.dtype.kind == 'f' else np.float64
+            return np.dtype(dtype).type(self.count / float(self.size))
+        return self.dense().mean(axis=axis, dtype=dtype, out=out, keepdims=keepdims)
+
+    def any(self, axis=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            return np.bool_(self.count > 0)
+        return self.dense(bool).any(axis=axis, out=out, keepdims=keepdims)
+
+    def all(self, axis=None, out=None, keepdims=False):
+        if (axis is None) and (out is None) and not keepdims:
+            return np.bool_(self.count == self.size)
+        return self.dense(bool).all(axis=axis, out=out, keepdims=keepdims)
+
+    def nonzero(self):
+        """Indices of the mask voxels (as np.nonzero of the dense mask)"""
+        return tuple(ii + b0 for ii, (b0, b1) in zip(np.nonzero(self.local), self.bbox))
+
+    def ravel_index(self, order=None):
+        """Flat indices of the mask voxels in a volume of the mask's shape
+
+        @param order :: axis order of the volume (e.g., (2, 1, 0): [x, y, z] mask, [z, y, x] volume)
+        """
+        idx = self.nonzero()
+        if order is None:
+            return np.ravel_multi_index(idx, self.shape)
+        return np.ravel_multi_index(tuple(idx[ai] for ai in order), tuple(self.shape[ai] for ai in order))
+
+    def gather(self, vol, transposed=True):
+        """Values of vol at the mask voxels, reading only the bounding box
+
+        @param vol :: [..., z, y, x] volume (transposed=True, for [x, y, z] masks) or [..., x, y, z]
+        @return values :: [..., n_voxels], in np.nonzero order
+        """
+        idx = np.nonzero(self.local)
+        box = self.bbox_slices()
+        if transposed:
+            block = vol[(Ellipsis,) + box[::-1]]
+            return block[(Ellipsis,) + tuple(idx[::-1])]
+        block = vol[(Ellipsis,) + box]
+        return block[(Ellipsis,) + tuple(idx)]
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(kk is Ellipsis for kk in key):
+            ei = key.index(Ellipsis)
+            key = key[:ei] + (slice(None),) * (self.ndim - len(key) + 1) + key[ei + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim or not all(isinstance(kk, (slice, int, np.integer)) for kk in key):
+            return None
+        return key
+
+    def __getitem__(self, key):
+        nkey = self._normalize_key(key)
+        if nkey is None:
+            # advanced indexing: fall back to the dense mask
+            return self.dense()[key]
+
+        sel = [np.arange(nn)[kk] for nn, kk in zip(self.shape, nkey)]
+        out = np.zeros(tuple(ss.size for ss in sel if ss.ndim), dtype=self.dtype)
+
+        src, dst = [], []
+        for ss, (b0, b1) in zip(sel, self.bbox):
+            ss = np.atleast_1d(ss)
+            inside = np.nonzero((ss >= b0) & (ss < b1))[0]
+            src.append(ss[inside] - b0)
+            dst.append(inside)
+        if all(ss.size for ss in src):
+            vals = self.local[np.ix_(*src)]
+            dst = [dd for dd, ss in zip(dst, sel) if ss.ndim]
+            vals = vals.reshape(tuple(dd.size for dd in dst))
+            out[np.ix_(*dst)] = vals
+
+        if out.ndim == 0:
+            return out[()]
+        return out
+
+    def _combined(self, other, op, union):
+        if not isinstance(other, SparseMask):
+            return NotImplemented
+        if other.shape != self.shape:
+            raise Exception('Mask shapes {:s} and {:s} differ'.format(str(self.shape), str(other.shape)))
+
+        masks = [mm for mm in (self, other) if mm.count]
+        if union and not masks:
+            return SparseMask.from_local(self.shape, (0,) * self.ndim, np.zeros((0,) * self.ndim))
+        if union:
+            bbox = [(min(mm.bbox[ai][0] for mm in masks), max(mm.bbox[ai][1] for mm in masks))
+                    for ai in range(self.ndim)]
+        else:
+            bbox = self.bbox
+
+        def embed(mm):
+            block = np.zeros(tuple(max(b1 - b0, 0) for b0, b1 in bbox), dtype=bool)
+            lo = [max(m0, b0) for (m0, m1), (b0, b1) in zip(mm.bbox, bbox)]
+            hi = [min(m1, b1) for (m0, m1), (b0, b1) in zip(mm.bbox, bbox)]
+            if all(h > l for l, h in zip(lo, hi)):
+                block[tuple(slice(l - b0, h - b0) for l, h, (b0, b1) in zip(lo, hi, bbox))] = \
+                    mm.local[tuple(slice(l - m0, h - m0) for l, h, (m0, m1) in zip(lo, hi, mm.bbox))]
+            return block
+
+        return SparseMask.from_local(self.shape, [b0 for b0, b1 in bbox], op(embed(self), embed(other)),
+                                     self.dtype)
+
+    def __or__(self, other):
+        return self._combined(other, np.logical_or, True)
+
+    def __and__(self, other):
+        return self._combined(other, np.logical_and, False)
+
+    def __xor__(self, other):
+        return self._combined(other, np.logical_xor, True)
+
+    def difference(self, other):
+        """Voxels of this mask that are not in other (sparse)"""
+        return self._combined(other, lambda aa, bb: aa & ~bb, False)
+
+    def __invert__(self):
+        return ~self.dense(bool)
+
+    def _compared(self, other, op):
+        """Elementwise comparison: sparse (bool) if the background compares False, else dense"""
+        if isinstance(other, SparseMask) or np.ndim(other) != 0:
+            return op(self.dense(), np.asarray(other))
+        zero, one = self.dtype.type(0), self.dtype.type(1)
+        if op(zero, other):
+            return op(self.dense(), other)
+        local = self.local if op(one, other) else np.zeros(self.local.shape, dtype=bool)
+        return SparseMask(self.shape, self.bbox, local, dtype=bool)
+
+    def __eq__(self, other):
+        return self._compared(other, np.equal)
+
+    def __ne__(self, other):
+        return self._compared(other, np.not_equal)
+
+    def __gt__(self, other):
+        return self._compared(other, np.greater)
+
+    def __ge__(self, other):
+        return self._compared(other, np.greater_equal)
+
+    def __lt__(self, other):
+        return self._compared(other, np.less)
+
+    def __le__(self, other):
+        return self._compared(other, np.less_equal)
+
+    __hash__ = None
+
+    # arithmetic (e.g., sum(masks), mask_a - mask_b) works on the dense mask, as before
+    def __add__(self, other):
+        return self.dense() + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self.dense() - other
+
+    def __rsub__(self, other):
+        return other - self.dense()
+
+    def __mul__(self, other):
+        return self.dense() * other
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return 'SparseMask(shape={:s}, bbox={:s}, count={:d})'.format(str(self.shape), str(self.bbox), self.count)
+
+def label_volume(masks, dtype=np.int8, transposed=True):
+    """One label volume for a list of (non-overlapping) masks
+
+    @param masks :: [x, y, z] masks (SparseMask or dense) of the same shape
+    @param transposed :: return the labels as [z, y, x] (the image volume order)
+
+    @return labels :: -1 outside all masks, index of the mask inside
+    """
+    if len(masks) > np.iinfo(dtype).max:
+        raise Exception('{:d} masks do not fit labels of type {:s}'.format(len(masks), np.dtype(dtype).name))
+
+    shape = masks[0].shape
+    labels = np.full(shape[::-1] if transposed else shape, -1, dtype=dtype)
+    lab_view = labels.T if transposed else labels
+    for mi, mask in enumerate(masks):
+        if isinstance(mask, SparseMask):
+            lab_view[mask.bbox_slices()][mask.local] = mi
+        else:
+            lab_view[np.asarray(mask) != 0] = mi
+    return labels
+
 class CylinderROI(object):
     def __init__(self, cx, cy, cz, ht, rd):
         self.cx = cx # center x-coordinate
@@ -11,31 +302,37 @@ class CylinderROI(object):
         self.ht = ht # height
         self.rd = rd # radius
 
-    def generate_mask(self, nx, ny, nz, dx, dy, dz, axis=2):
-        # xx = np.arange(0.0, nx * dx, dx)
-        # yy = np.arange(0.0, ny * dy, dy)
-        # zz = np.arange(0.0, nz * dz, dz)
+    def _index_range(self, c, half, d, n):
+        """Voxel index range (with a 1 voxel margin) covering c +/- half"""
+        i0 = int(np.floor((c - half) / d)) - 1
+        i1 = int(np.ceil((c + half) / d)) + 2
+        i0 = min(max(i0, 0), n)
+        return i0, max(min(i1, n), i0)
 
-        xx = np.arange(nx) * dx
-        yy = np.arange(ny) * dy
-        zz = np.arange(nz) * dz
+    def generate_sparse_mask(self, nx, ny, nz, dx, dy, dz, axis=2):
+        """ROI mask (indexed [x, y, z]) evaluated only inside the cylinder's bounding box"""
+        halves = [self.rd, self.rd, self.rd]
+        halves[axis] = self.ht / 2.0
+        ranges = [self._index_range(cc, hh, dd, nn) for cc, hh, dd, nn in
+                  zip((self.cx, self.cy, self.cz), halves, (dx, dy, dz), (nx, ny, nz))]
 
-        (xg, yg, zg) = np.meshgrid(xx, yy, zz, indexing='ij')
+        # same coordinates & comparisons as the dense mask, on an open grid of the box
+        (xg, yg, zg) = np.ix_(*[np.arange(i0, i1) * dd for (i0, i1), dd in zip(ranges, (dx, dy, dz))])
         if (axis == 2):
-            #(xg, yg, zg) = np.meshgrid(xx, yy, zz)
             roi_mask = np.power(xg - self.cx, 2) + np.power(yg - self.cy, 2) <= np.power(self.rd, 2)
             roi_mask = np.logical_and(roi_mask, zg >= self.cz - (self.ht/2))
             roi_mask = np.logical_and(roi_mask, zg <= self.cz + (self.ht/2))
         elif (axis == 1):
-            #(yg, xg, zg) = np.meshgrid(xx, yy, zz)
             roi_mask = np.power(xg - self.cx, 2) + np.power(zg - self.cz, 2) <= np.power(self.rd, 2)
             roi_mask = np.logical_and(roi_mask, yg >= self.cy - (self.ht/2))
             roi_mask = np.logical_and(roi_mask, yg <= self.cy + (self.ht/2))
         elif (axis == 0):
-            #(yg, xg, zg) = np.meshgrid(xx, yy, zz)
             roi_mask = np.power(yg - self.cy, 2) + np.power(zg - self.cz, 2) <= np.power(self.rd, 2)
             roi_mask = np.logical_and(roi_mask, xg >= self.cx - (self.ht/2))
             roi_mask = np.logical_and(roi_mask, xg <= self.cx + (self.ht/2))
 
-        return np.float32(roi_mask)
+        roi_mask = np.broadcast_to(roi_mask, tuple(i1 - i0 for i0, i1 in ranges))
+        return SparseMask.from_local((nx, ny, nz), [i0 for i0, i1 in ranges], roi_mask)
 
+    def generate_mask(self, nx, ny, nz, dx, dy, dz, axis=2):
+        return self.generate_sparse_mask(nx, ny, nz, dx, dy, dz, axis=axis).dense(np.float32)
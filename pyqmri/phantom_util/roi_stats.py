@@ -0,0 +1,123 @@
+"""
+Per-container statistics from a label volume
+
+All containers and all echoes / parameter maps are reduced together: the
+labelled voxels are gathered once, grouped by label with one sort and
+reduced with reduceat / bincount, so there is no Python loop over voxels or
+echoes (only the in-group sort for the percentiles runs per container).
+
+    labels = phantom.compute_rois(nx, ny, nz, dx, dy, dz, labels=True)
+    stats = roi_statistics(echo_stack, labels)       # echo_stack: [echo, z, y, x]
+    stats['mean'][ci, ei]                            # mean of container ci at echo ei
+"""
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+def _percentile_sorted(sorted_vals, starts, counts, q):
+    """Percentile q (linear interpolation, as np.percentile) of sorted groups
+
+    @param sorted_vals :: (n_maps, n_voxels) values sorted within each group (NaN last)
+    @param starts :: (n_labels,) first voxel of each group
+    @param counts :: (n_labels, n_maps) number of valid values per group and map
+    """
+    pos = (q / 100.0) * np.maximum(counts - 1, 0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(counts - 1, 0))
+    frac = pos - lo
+
+    if sorted_vals.shape[1] == 0:
+        return np.full(counts.shape, np.nan)
+
+    # (empty groups may start past the end; their result is NaN anyway)
+    last = sorted_vals.shape[1] - 1
+    map_idx = np.arange(sorted_vals.shape[0])[None, :]
+    v_lo = sorted_vals[map_idx, np.minimum(starts[:, None] + lo, last)]
+    v_hi = sorted_vals[map_idx, np.minimum(starts[:, None] + hi, last)]
+    out = v_lo + frac * (v_hi - v_lo)
+    out[counts == 0] = np.nan
+    return out
+
+def roi_statistics(data, labels, n_labels=None, axis=0, percentiles=(25.0, 75.0), ddof=0,
+                   ignore_nan=True):
+    """Count, mean, std, median & percentiles of every labelled container, for every map at once
+
+    @param data :: [z, y, x] map or stack of maps (echoes, flip angles, parameter maps) along axis
+    @param labels :: [z, y, x] integer labels, < 0 for background (e.g., compute_rois(..., labels=True))
+    @param n_labels :: number of containers (default: max label + 1)
+    @param axis :: stack axis of data (ignored for a single [z, y, x] map)
+    @param percentiles :: extra percentiles, returned as 'p<q>' (e.g., 'p25')
+    @param ddof :: delta degrees of freedom of the std
+    @param ignore_nan :: exclude NaN values (e.g., failed fits) per map
+
+    @return stats :: dict of (n_labels, n_maps) arrays ((n_labels,) for a single map):
+                     'count', 'mean', 'std', 'median', 'min', 'max', 'p<q>'
+    """
+    data = np.asarray(data)
+    labels = np.asarray(labels)
+    single = (data.ndim == labels.ndim)
+    if single:
+        data = data[None]
+    else:
+        data = np.moveaxis(data, axis, 0)
+    if data.shape[1:] != labels.shape:
+        raise Exception('Data {:s} and labels {:s} do not match'.format(str(data.shape), str(labels.shape)))
+
+    lab_flat = labels.ravel()
+    vox = np.flatnonzero(lab_flat >= 0)
+    lab = lab_flat[vox].astype(np.int64)
+    n_labels = (int(lab.max()) + 1 if lab.size else 0) if n_labels is None else n_labels
+
+    # group voxels by label (one integer sort), then sort each map's values within the groups (NaN last)
+    grouped = vox[np.argsort(lab, kind='stable')]
+    sorted_vals = data.reshape(data.shape[0], -1)[:, grouped].astype(np.float64)
+
+    n_vox = np.bincount(lab, minlength=n_labels)[:n_labels]
+    starts = np.concatenate(([0], np.cumsum(n_vox)[:-1])).astype(np.int64)
+    for s0, nn in zip(starts, n_vox):
+        sorted_vals[:, s0:s0 + nn].sort(axis=1)
+
+    valid = ~np.isnan(sorted_vals) if ignore_nan else np.ones(sorted_vals.shape, dtype=bool)
+    filled = np.where(valid, sorted_vals, 0.0)
+
+    # reduceat needs non-empty groups: reduce over those, leave the others at 0
+    nonempty = n_vox > 0
+    counts = np.zeros((n_labels, data.shape[0]))
+    sums = np.zeros((n_labels, data.shape[0]))
+    sumsq = np.zeros((n_labels, data.shape[0]))
+    if vox.size:
+        idx = starts[nonempty]
+        counts[nonempty] = np.add.reduceat(valid.astype(np.float64), idx, axis=1).T
+        sums[nonempty] = np.add.reduceat(filled, idx, axis=1).T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+        if vox.size:
+            # centered second moment (more accurate than sum of squares - n mean^2)
+            seg_mean = np.repeat(np.nan_to_num(mean[nonempty]), n_vox[nonempty], axis=0).T
+            dev = np.where(valid, sorted_vals - seg_mean, 0.0)
+            sumsq[nonempty] = np.add.reduceat(dev * dev, idx, axis=1).T
+        std = np.sqrt(sumsq / (counts - ddof))
+    std[counts - ddof <= 0] = np.nan
+
+    counts_i = counts.astype(np.int64)
+    stats = {
+        'count' : counts_i,
+        'mean' : mean,
+        'std' : std,
+        'median' : _percentile_sorted(sorted_vals, starts, counts_i, 50.0),
+        'min' : _percentile_sorted(sorted_vals, starts, counts_i, 0.0),
+        'max' : _percentile_sorted(sorted_vals, starts, counts_i, 100.0),
+    }
+    for q in percentiles:
+        stats['p{:g}'.format(q)] = _percentile_sorted(sorted_vals, starts, counts_i, q)
+
+    if single:
+        stats = {name: val[:, 0] for name, val in stats.items()}
+    return stats
+
+def store_roi_statistics(roi_info, stats, key='stats'):
+    """Copy per-container statistics into roi_info (roi[key][stat] = value(s) of that container)"""
+    for ci, roi in enumerate(roi_info):
+        roi[key] = {name: val[ci] for name, val in stats.items()}
+    return roi_info
@@ -0,0 +1,36 @@
+"""
+Command line entry point of the batch phantom QA
+
+    python -m pyqmri.qa run manifest.json [--workers N] [--out DIR] [--force]
+"""
+__author__ = "Dharshan Chandramohan"
+
+import sys
+import argparse
+
+from .runner import run_manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyqmri.qa', description='Batch phantom QA')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='run (or resume) the QA of every exam of a manifest')
+    run.add_argument('manifest', help='JSON manifest (see pyqmri.qa.runner)')
+    run.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    run.add_argument('--out', default=None, help="output directory (default: the manifest's output_dir)")
+    run.add_argument('--force', action='store_true', help='rerun finished exams too')
+    run.add_argument('--quiet', action='store_true', help='no progress output')
+
+    args = parser.parse_args(argv)
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    summary = run_manifest(args.manifest, out_dir=args.out, n_workers=args.workers, force=args.force,
+                           verbose=not args.quiet)
+    if not args.quiet:
+        print('Results: {:s}'.format(summary['table']))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+Batch phantom QA over many exams
+
+Each exam of a manifest goes through the whole pipeline: load the DICOM
+series, register the phantom pose (MaterialsPhantom_Mk*.register_pose),
+compute the container ROIs, fit T2* (and T1, with variable flip angle
+series) in the ROI voxels only, and reduce the fits to per-container
+statistics. Exams run in parallel on a process pool. Every finished exam is
+checkpointed (<output_dir>/exams/<id>/result.json), so a rerun only
+processes exams that are unfinished, failed, or whose manifest entry
+changed; the results of all finished exams are then written to one table
+(<output_dir>/results.csv, one row per exam, container & parameter).
+
+Manifest (JSON; relative paths are relative to the manifest):
+
+    {
+        "output_dir" : "qa_results",
+        "defaults" : {"phantom" : "Mk5", "container_labels" : ["A", "B", ...]},
+        "exams" : [
+            {"id" : "2020_01_13", "t2star" : "exam1/ute_mte", "t1" : ["exam1/fa4", "exam1/fa20"]},
+            {"id" : "2020_01_20", "t2star" : "exam2/ute_mte", "pose" : {"cx0" : 64.0, ...}}
+        ]
+    }
+
+Exam entries (defaults apply to every exam, exam entries override them):
+    id :: unique exam name
+    phantom :: 'Mk4' or 'Mk5'
+    container_labels :: one label per container
+    roi_rd_scl, roi_ht_scl :: ROI size relative to the containers
+    t2star :: multi-echo DICOM series directory
+    t2star_method :: 'lm' (default), 'loglinear' or 'arlo'
+    t1 :: variable flip angle DICOM series directories
+    pose :: fixed pose {cx0, cy0, cz0, th0} (default: registered)
+    registration :: register_pose options (th0, th_range, max_shift, ...)
+    report :: also render an ROI report image (report.png)
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import csv
+import json
+import time
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from ..img_utils.loaders import load_DICOM_from_ordered_dir
+from ..phantom_util import material_phantoms as mp
+from ..phantom_util.roi_stats import roi_statistics
+from ..parameter_mapping.roi_fitting import fit_rois
+from ..signal_models import batch_fit
+from ..signal_models.gre_3dute import calc_T2str_loglinear, calc_T2str_ARLO, calc_VFA_T1_linear
+
+STAT_NAMES = ('count', 'mean', 'std', 'median', 'min', 'max', 'p25', 'p75')
+TABLE_COLUMNS = ('exam', 'container', 'label', 'parameter') + STAT_NAMES + ('cx', 'cy', 'cz')
+
+def load_manifest(fname):
+    """Exams of a manifest (defaults merged in, paths made absolute) and its output directory"""
+    with open(fname, 'r') as src:
+        manifest = json.load(src)
+    root = os.path.dirname(os.path.abspath(fname))
+
+    def resolve(path):
+        return os.path.normpath(os.path.join(root, path))
+
+    exams = []
+    for entry in manifest.get('exams', []):
+        exam = dict(manifest.get('defaults', {}))
+        exam.update(entry)
+        if 'id' not in exam:
+            raise Exception('Manifest exam entry without an id: {:s}'.format(json.dumps(entry)))
+        if exam.get('t2star'):
+            exam['t2star'] = resolve(exam['t2star'])
+        if exam.get('t1'):
+            exam['t1'] = [resolve(path) for path in ([exam['t1']] if isinstance(exam['t1'], str) else exam['t1'])]
+        exams.append(exam)
+
+    ids = [exam['id'] for exam in exams]
+    if len(set(ids)) != len(ids):
+        raise Exception('Manifest exam ids are not unique')
+    return exams, resolve(manifest.get('output_dir', 'qa_results'))
+
+def exam_key(exam):
+    """Fingerprint of an exam entry (a checkpoint is reused only for the same entry)"""
+    return hashlib.sha1(json.dumps(exam, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def exam_dir(out_dir, exam_id):
+    return os.path.join(out_dir, 'exams', exam_id)
+
+def _write_json(fname, obj):
+    tmp_fname = fname + '.{:d}.tmp'.format(os.getpid())
+    with open(tmp_fname, 'w') as dst:
+        json.dump(obj, dst, indent=1)
+    os.replace(tmp_fname, fname)
+
+def load_checkpoint(exam, out_dir):
+    """Result of a finished exam, or None (not run, failed, or run with a different entry)"""
+    fname = os.path.join(exam_dir(out_dir, exam['id']), 'result.json')
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as src:
+        result = json.load(src)
+    return result if result.get('key') == exam_key(exam) else None
+
+def make_phantom(exam):
+    name = exam.get('phantom', 'Mk5')
+    cls = getattr(mp, 'MaterialsPhantom_{:s}'.format(name), None)
+    if cls is None or not hasattr(cls, 'register_pose'):
+        raise Exception('Unsupported phantom: {:s}'.format(name))
+    return cls(exam['id'], container_labels=exam['container_labels'],
+               roi_rd_scl=exam.get('roi_rd_scl', 0.25), roi_ht_scl=exam.get('roi_ht_scl', 0.5))
+
+def same_grid(shape, acq, ref_shape, ref_acq, tol=1e-3):
+    """Whether a series lies on the reference grid: same shape, voxel spacing & slice positions (within tol mm)
+
+    @param acq, ref_acq :: acquisition parameters as returned by the DICOM loaders ('spacing', 'slice_pos')
+    """
+    return ((tuple(shape) == tuple(ref_shape))
+            and np.allclose(acq['spacing'], ref_acq['spacing'], rtol=0.0, atol=tol)
+            and np.allclose(acq['slice_pos'], ref_acq['slice_pos'], rtol=0.0, atol=tol))
+
+def vfa_stack(series):
+    """Variable flip angle stack from loaded series (shortest TE of each flip angle)
+
+    @param series :: list of (vol [echo, z, y, x], params) as returned by the DICOM loaders
+
+    @return S :: [FA, z, y, x] magnitude, FA :: flip angles (rad), TR
+    """
+    S, FA, TR = [], [], []
+    for fa in np.unique(np.concatenate([acq['FA'] for vol, acq in series])):
+        vol, acq, ii = min(((vol, acq, ii) for vol, acq in series for ii in range(len(acq['TE']))
+                            if acq['FA'][ii] == fa), key=lambda item: item[1]['TE'][item[2]])
+        S.append(np.abs(vol[ii]))
+        FA.append(np.radians(fa))
+        TR.append(acq['TR'])
+
+    if len(S) < 2:
+        raise Exception('At least two flip angles are needed for T1 mapping')
+    # (the loaders return an array of TRs for a series that mixes repetition times)
+    if any(np.ndim(tr) != 0 for tr in TR) or not all(tr == TR[0] for tr in TR):
+        raise Exception('Repetition time is inconsistent')
+    return np.array(S, dtype=np.float64), np.array(FA), TR[0]
+
+def _fit_t2star(sig, utes, method='lm'):
+    """ROI-voxel T2* fit -> T2str, K, N, status (sig :: [echo, voxels])"""
+    if method == 'lm':
+        return batch_fit.fit_t2str_mag(sig, utes)
+    if method in ('loglinear', 'arlo'):
+        calc_est = calc_T2str_loglinear if method == 'loglinear' else calc_T2str_ARLO
+        T2str, K = calc_est(sig, utes)
+        ok = np.isfinite(T2str)
+        return T2str, K, np.zeros(T2str.shape), np.where(ok, batch_fit.FIT_FTOL, batch_fit.FIT_FAILED)
+    raise Exception("T2* method should be 'lm', 'loglinear' or 'arlo'")
+
+def _stat_rows(exam, roi_info, results, labels, names, status=None):
+    """Per-container statistics of ROI-voxel fit results -> table rows (failed fits excluded)"""
+    vals = np.stack([np.asarray(res, dtype=np.float64) for res in results])
+    if status is not None:
+        vals[:, np.asarray(status) < 0] = np.nan
+    stats = roi_statistics(vals, labels, n_labels=len(roi_info))
+
+    rows = []
+    for ci, roi in enumerate(roi_info):
+        for pi, name in enumerate(names):
+            row = {'exam' : exam['id'], 'container' : ci, 'label' : roi['label'], 'parameter' : name,
+                   'cx' : float(roi['cx']), 'cy' : float(roi['cy']), 'cz' : float(roi['cz'])}
+            for sname in STAT_NAMES:
+                row[sname] = stats[sname][ci, pi].item()
+            rows.append(row)
+    return rows
+
+def run_exam(exam, out_dir):
+    """Run the QA pipeline on one exam and checkpoint its result
+
+    @return result :: {'id', 'key', 'pose', 'rows', 'elapsed'}
+    """
+    t0 = time.time()
+    edir = exam_dir(out_dir, exam['id'])
+    os.makedirs(edir, exist_ok=True)
+    phantom = make_phantom(exam)
+
+    # the first series is the reference grid for the pose & ROIs
+    ref = None
+    t2s = t1s = None
+    if exam.get('t2star'):
+        vol, acq = load_DICOM_from_ordered_dir(exam['t2star'], dtype=np.float32)
+        t2s = (np.abs(vol), np.asarray(acq['TE'], dtype=np.float64))
+        ref = (t2s[0][np.argmin(t2s[1])], acq)
+    if exam.get('t1'):
+        series = [load_DICOM_from_ordered_dir(dirname, dtype=np.float32) for dirname in exam['t1']]
+        # the ROIs are computed on the reference grid, so every T1 series has to lie on it
+        grid = (series[0][0].shape[1:], series[0][1]) if ref is None else (ref[0].shape, ref[1])
+        for dirname, (vol, acq) in zip(exam['t1'], series):
+            if not same_grid(vol.shape[1:], acq, *grid):
+                raise Exception('T1 series {:s} is not on the reference grid '
+                                '(shape, spacing & slice positions)'.format(dirname))
+        t1s = vfa_stack(series)
+        ref = (t1s[0][0], series[0][1]) if ref is None else ref
+    if ref is None:
+        raise Exception('Exam {:s} has neither a t2star nor a t1 series'.format(exam['id']))
+
+    ref_img, ref_acq = ref
+    dx, dy, dz = ref_acq['spacing']
+    nz, ny, nx = ref_img.shape
+    pose = exam.get('pose')
+    if pose is None:
+        pose = phantom.register_pose(ref_img.T, dx, dy, dz, voltype='mag', **exam.get('registration', {}))
+    phantom.compute_rois(nx, ny, nz, dx, dy, dz, **pose)
+
+    rows = []
+    if t2s is not None:
+        results, labels = fit_rois(_fit_t2star, t2s[0], phantom.roi_info, fit_args=(t2s[1],),
+                                   fit_kwargs={'method' : exam.get('t2star_method', 'lm')},
+                                   param_names=('T2str', 'K', 'N', 'status'), key='t2star')
+        rows += _stat_rows(exam, phantom.roi_info, results[:3], labels, ('T2str', 'K', 'N'), status=results[3])
+    if t1s is not None:
+        S, FA, TR = t1s
+        results, labels = fit_rois(calc_VFA_T1_linear, S, phantom.roi_info, fit_args=(FA, TR),
+                                   param_names=('T1', 'M0'), key='t1')
+        rows += _stat_rows(exam, phantom.roi_info, results, labels, ('T1', 'M0'))
+
+    if exam.get('report'):
+        from ..img_utils.montage import render_roi_report, save_image
+        save_image(os.path.join(edir, 'report.png'), render_roi_report(ref_img, phantom.roi_info, (dx, dy, dz)))
+
+    result = {
+        'id' : exam['id'],
+        'key' : exam_key(exam),
+        'pose' : {name: float(val) for name, val in pose.items()},
+        'rows' : rows,
+        'elapsed' : time.time() - t0,
+    }
+    _write_json(os.path.join(edir, 'result.json'), result)
+    error_fname = os.path.join(edir, 'error.txt')
+    if os.path.exists(error_fname):
+        os.remove(error_fname)
+    return result
+
+def _run_exam_logged(exam, out_dir):
+    """run_exam, with failures written to <exam dir>/error.txt -> (id, result or None, error or None)"""
+    try:
+        return exam['id'], run_exam(exam, out_dir), None
+    except Exception:
+        err = traceback.format_exc()
+        edir = exam_dir(out_dir, exam['id'])
+        os.makedirs(edir, exist_ok=True)
+        with open(os.path.join(edir, 'error.txt'), 'w') as dst:
+            dst.write(err)
+        return exam['id'], None, err
+
+def write_table(fname, results):
+    """Consolidated results table (CSV, one row per exam, container & parameter)"""
+    tmp_fname = fname + '.{:d}.tmp'.format(os.getpid())
+    with open(tmp_fname, 'w', newline='') as dst:
+        writer = csv.DictWriter(dst, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        for result in results:
+            writer.writerows(result['rows'])
+    os.replace(tmp_fname, fname)
+    return fname
+
+def run_manifest(manifest, out_dir=None, n_workers=None, force=False, verbose=True):
+    """Run (or resume) the QA of every exam of a manifest
+
+    @param manifest :: manifest file name
+    @param out_dir :: output directory (default: the manifest's output_dir)
+    @param n_workers :: number of processes (1: run in this process)
+    @param force :: rerun finished exams too
+
+    @return summary :: {'done': ids run now, 'skipped': ids already finished,
+                        'failed': {id: traceback}, 'table': results table file}
+    """
+    exams, manifest_out = load_manifest(manifest)
+    out_dir = manifest_out if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+    finished = {}
+    if not force:
+        for exam in exams:
+            result = load_checkpoint(exam, out_dir)
+            if result is not None:
+                finished[exam['id']] = result
+    pending = [exam for exam in exams if exam['id'] not in finished]
+    summary = {'done' : [], 'skipped' : sorted(finished), 'failed' : {}}
+    if verbose:
+        print('{:d} exams, {:d} finished, {:d} to run'.format(len(exams), len(finished), len(pending)))
+
+    def collect(exam_id, result, err):
+        if result is None:
+            summary['failed'][exam_id] = err
+        else:
+            finished[exam_id] = result
+            summary['done'].append(exam_id)
+        if verbose:
+            print('[{:d}/{:d}] {:s} {:s}'.format(len(summary['done']) + len(summary['failed']), len(pending),
+                                                exam_id, 'failed' if result is None else
+                                                'done ({:.1f} s)'.format(result['elapsed'])))
+
+    if n_workers == 1:
+        for exam in pending:
+            collect(*_run_exam_logged(exam, out_dir))
+    elif pending:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_run_exam_logged, exam, out_dir) for exam in pending]
+            for future in as_completed(futures):
+                collect(*future.result())
+
+    summary['table'] = write_table(os.path.join(out_dir, 'results.csv'),
+                                   [finished[exam['id']] for exam in exams if exam['id'] in finished])
+    if verbose and summary['failed']:
+        print('Failed: {:s} (see {:s})'.format(', '.join(sorted(summary['failed'])),
+                                               os.path.join(out_dir, 'exams', '<id>', 'error.txt')))
+    return summary
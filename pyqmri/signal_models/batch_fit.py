@@ -0,0 +1,358 @@
+"""
+Batched (vectorized) least-squares fitting of signal models over many voxels at once
+"""
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+from . import gre_3dute
+from ..parameter_mapping.mrfit_utils import Hz2ppm
+from ..img_utils.noise import estimate_noise_power
+
+# Per-voxel fit status codes (positive values follow scipy.optimize.least_squares)
+FIT_SKIPPED = -2  # voxel excluded by the mask
+FIT_FAILED = -1   # non-finite data/initial estimate
+FIT_MAXITER = 0   # maximum number of iterations reached
+FIT_GTOL = 1      # gradient convergence
+FIT_FTOL = 2      # cost convergence (or no further decrease possible)
+FIT_XTOL = 3      # step size convergence
+
+_LAM_MAX = 1e16
+
+def levenberg_marquardt(fun, x0, obs, args=(), lb=None, ub=None,
+                        max_iter=100, ftol=1e-8, xtol=1e-8, gtol=1e-10,
+                        lam0=1e-3):
+    """Levenberg-Marquardt minimization of many independent least-squares problems
+
+    Every row of x0/obs is a separate voxel. Each voxel keeps its own damping
+    factor and convergence state; converged voxels are dropped from the active
+    set so later iterations only touch the voxels that are still moving.
+
+    @param fun :: fun(params, obs, *args) -> (res, jac)
+                  params (n, n_params), obs (n, n_obs)
+                  res (n, n_obs) residuals, jac (n, n_obs, n_params) d(res)/d(params)
+    @param x0 :: initial estimates, shape (n_voxels, n_params)
+    @param obs :: observations, shape (n_voxels, n_obs)
+    @param args :: additional (shared) arguments passed to fun
+    @param lb, ub :: optional lower/upper bounds (length n_params), steps are projected onto them
+    @param max_iter :: maximum number of iterations
+    @param ftol, xtol, gtol :: convergence tolerances (see scipy.optimize.least_squares)
+    @param lam0 :: initial damping factor
+
+    @return x :: parameter estimates, shape (n_voxels, n_params)
+    @return cost :: final cost (0.5 * sum of squared residuals) per voxel
+    @return status :: per-voxel status code (FIT_* constants)
+    """
+    x = np.array(x0, dtype=np.float64, ndmin=2, copy=True)
+    obs = np.asarray(obs)
+    n_vox, n_params = x.shape
+
+    lb = np.full(n_params, -np.inf) if lb is None else np.asarray(lb, dtype=np.float64)
+    ub = np.full(n_params, np.inf) if ub is None else np.asarray(ub, dtype=np.float64)
+    x = np.clip(x, lb, ub)
+
+    cost = np.full(n_vox, np.nan)
+    status = np.full(n_vox, FIT_MAXITER, dtype=np.int8)
+
+    # only voxels with finite data and initial estimates take part
+    ok = np.all(np.isfinite(x), axis=1) & np.all(np.isfinite(obs.reshape(n_vox, -1)), axis=1)
+    idx = np.flatnonzero(ok)
+    status[~ok] = FIT_FAILED
+    if idx.size == 0:
+        return x, cost, status
+
+    xa = x[idx]
+    oa = obs[idx]
+    res, jac = fun(xa, oa, *args)
+    ca = 0.5 * np.sum(res * res, axis=1)
+
+    bad = ~np.isfinite(ca)
+    status[idx[bad]] = FIT_FAILED
+    keep = ~bad
+    idx, xa, oa, res, jac, ca = idx[keep], xa[keep], oa[keep], res[keep], jac[keep], ca[keep]
+    lam = np.full(idx.size, lam0)
+
+    for it in range(max_iter):
+        if idx.size == 0:
+            break
+
+        JtJ = np.einsum('nmp,nmq->npq', jac, jac)
+        g = np.einsum('nmp,nm->np', jac, res)
+
+        # gradient convergence (checked before stepping, as in scipy)
+        g_conv = np.max(np.abs(g), axis=1) <= gtol
+
+        dd = np.einsum('npp->np', JtJ)
+        dd = np.maximum(dd, 1e-12 * np.max(dd, axis=1, keepdims=True) + np.finfo(np.float64).tiny)
+        A = JtJ + (lam[:, None] * dd)[:, :, None] * np.eye(n_params)
+        try:
+            step = -np.linalg.solve(A, g[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('npq,nq->np', np.linalg.pinv(A), g)
+
+        x_new = np.clip(xa + step, lb, ub)
+        res_new, jac_new = fun(x_new, oa, *args)
+        c_new = 0.5 * np.sum(res_new * res_new, axis=1)
+
+        accept = np.isfinite(c_new) & (c_new < ca)
+        dx = x_new - xa
+        dF = ca - c_new
+
+        xa[accept] = x_new[accept]
+        res[accept] = res_new[accept]
+        jac[accept] = jac_new[accept]
+        c_prev = ca.copy()
+        ca[accept] = c_new[accept]
+        lam = np.where(accept, lam * 0.1, lam * 10.0)
+
+        f_conv = accept & (dF <= ftol * c_prev)
+        x_conv = accept & (np.linalg.norm(dx, axis=1) <= xtol * (xtol + np.linalg.norm(xa, axis=1)))
+        stalled = ~accept & (lam > _LAM_MAX)
+
+        done_status = np.full(idx.size, FIT_MAXITER, dtype=np.int8)
+        done_status[stalled] = FIT_FTOL
+        done_status[x_conv] = FIT_XTOL
+        done_status[f_conv] = FIT_FTOL
+        done_status[g_conv] = FIT_GTOL
+        done = g_conv | f_conv | x_conv | stalled
+
+        if np.any(done):
+            di = idx[done]
+            x[di] = xa[done]
+            cost[di] = ca[done]
+            status[di] = done_status[done]
+
+            keep = ~done
+            idx, xa, oa, res, jac, ca, lam = (idx[keep], xa[keep], oa[keep],
+                                              res[keep], jac[keep], ca[keep], lam[keep])
+
+    # whatever is left hit the iteration limit
+    x[idx] = xa
+    cost[idx] = ca
+    status[idx] = FIT_MAXITER
+
+    return x, cost, status
+
+def _t2str_mag_res_jac(params, obs_sig, utes):
+    """Residuals & Jacobian of the T2str-weighted magnitude model (see gre_3dute.T2str_mag_simplified)"""
+    res = gre_3dute.T2str_mag_simplified_batch(params, utes) - obs_sig
+    jac = gre_3dute.T2str_mag_simplified_jac(params, utes)
+    return res, jac
+
+def _t2str_mag_seed(sig, utes, init='loglinear'):
+    """Closed-form initial estimates for the T2str-weighted magnitude model
+
+    @param init :: 'loglinear' or 'arlo' (see gre_3dute), or 'twopoint' (min/max TE only)
+                   voxels where the closed-form estimate fails fall back to 'twopoint'
+    """
+    i0 = np.argmin(utes)
+    i1 = np.argmax(utes)
+
+    S0 = sig[:, i0]
+    S1 = sig[:, i1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        T2str = (utes[i1] - utes[i0]) / np.log(S0 / S1)
+    T2str = np.where(np.isfinite(T2str) & (T2str > 0), T2str, utes[i1] - utes[i0])
+    K = S0 * np.exp(utes[i0] / T2str)
+    N = np.zeros_like(K)
+
+    if init in ('loglinear', 'arlo'):
+        est = gre_3dute.calc_T2str_loglinear if init == 'loglinear' else gre_3dute.calc_T2str_ARLO
+        T2str_cf, K_cf = est(sig, utes, axis=1)
+        ok = np.isfinite(T2str_cf) & np.isfinite(K_cf)
+        T2str = np.where(ok, T2str_cf, T2str)
+        K = np.where(ok, K_cf, K)
+    elif init != 'twopoint':
+        raise Exception("Initial estimate (init) should be 'loglinear', 'arlo' or 'twopoint'")
+
+    return np.stack((T2str, K, N), axis=1)
+
+def _spatial_to_rows(data, axis):
+    """Move the echo axis last and flatten the spatial axes -> (n_voxels, n_echoes)"""
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    return data.reshape(-1, data.shape[-1]), data.shape[:-1]
+
+def fit_t2str_mag(mag_data, utes, x0=None, mask=None, axis=0, bounds=None,
+                  init='loglinear', block_size=65536, **lm_kwargs):
+    """Voxelwise fit of the T2str-weighted UTE GRE magnitude model for a whole volume
+
+    S = K * [ exp(-TE/T2*) ] + N
+
+    All voxels are fit together (in blocks of block_size voxels) with the
+    batched Levenberg-Marquardt solver above, using the analytic Jacobian.
+
+    @param mag_data :: magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param x0 :: optional initial estimates (T2str, K, N); each may be a scalar or a map
+                 with the spatial shape of mag_data. Default: closed-form estimate (see init)
+    @param mask :: optional boolean map (spatial shape); voxels outside it are not fit
+    @param axis :: echo axis of mag_data
+    @param bounds :: optional (lb, ub) parameter bounds; default keeps T2str positive
+    @param init :: closed-form initial estimate used when x0 is None ('loglinear', 'arlo', 'twopoint')
+    @param block_size :: number of voxels fit together (bounds memory use)
+    @param lm_kwargs :: passed on to levenberg_marquardt (max_iter, ftol, ...)
+
+    @return T2str, K, N :: parameter maps (spatial shape)
+    @return status :: per-voxel fit status map (FIT_* constants)
+    """
+    utes = np.asarray(utes, dtype=np.float64)
+    sig, sp_shape = _spatial_to_rows(mag_data, axis)
+    n_vox = sig.shape[0]
+
+    if x0 is not None:
+        x0 = np.stack([np.broadcast_to(np.asarray(p, dtype=np.float64), sp_shape).ravel()
+                       for p in x0], axis=1)
+
+    if bounds is None:
+        bounds = ([1e-3 * np.max(np.abs(utes)), -np.inf, -np.inf], [np.inf, np.inf, np.inf])
+    lb, ub = bounds
+
+    params = np.full((n_vox, 3), np.nan)
+    status = np.full(n_vox, FIT_SKIPPED, dtype=np.int8)
+
+    vox = np.arange(n_vox) if mask is None else np.flatnonzero(np.asarray(mask).ravel())
+    for b0 in range(0, vox.size, block_size):
+        bi = vox[b0:b0 + block_size]
+        obs = sig[bi].astype(np.float64)
+        xb = _t2str_mag_seed(obs, utes, init) if x0 is None else x0[bi]
+
+        xb, cost, st = levenberg_marquardt(_t2str_mag_res_jac, xb, obs, args=(utes,),
+                                           lb=lb, ub=ub, **lm_kwargs)
+        params[bi] = xb
+        status[bi] = st
+
+    T2str, K, N = (params[:, pi].reshape(sp_shape) for pi in range(3))
+    return T2str, K, N, status.reshape(sp_shape)
+
+def _t2str_cplx_res_jac(params, obs_ri, utes):
+    """Residuals & Jacobian of the complex T2str-weighted model (see gre_3dute.T2str_cplx)
+
+    Real and imaginary parts are stacked along the observation axis: [Re(S), Im(S)]
+    """
+    pred = gre_3dute.T2str_cplx_batch(params, utes)
+    Jc = gre_3dute.T2str_cplx_jac(params, utes)
+    res = np.concatenate((pred.real, pred.imag), axis=1) - obs_ri
+    jac = np.concatenate((Jc.real, Jc.imag), axis=1)
+    return res, jac
+
+def fit_t2str_cplx(cplx_data, utes, mask=None, axis=0, bounds=None, te_units=1.0, B0=3.0,
+                   init='loglinear', block_size=32768, **lm_kwargs):
+    """Voxelwise fit of the complex T2str-weighted UTE GRE model for a whole volume
+
+    S = K * exp(-TE/T2* - i2pi * df * TE + i * phi)
+
+    T2* and K are seeded from the magnitudes (see init), df and phi from the
+    echo-to-echo phase differences (gre_3dute.calc_df_phi_est); all voxels are
+    then refined together with the batched Levenberg-Marquardt solver.
+
+    @param cplx_data :: complex images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param mask :: optional boolean map (spatial shape); voxels outside it are not fit
+    @param axis :: echo axis of cplx_data
+    @param bounds :: optional (lb, ub) parameter bounds; default keeps T2str positive
+    @param te_units :: seconds per unit of utes (e.g., 1e-6 for microseconds), for df in Hz
+    @param B0 :: field strength (T), for df in ppm
+    @param init :: closed-form T2*/K estimate ('loglinear', 'arlo', 'twopoint')
+    @param block_size :: number of voxels fit together (bounds memory use)
+    @param lm_kwargs :: passed on to levenberg_marquardt (max_iter, ftol, ...)
+
+    @return T2str, K :: parameter maps (spatial shape)
+    @return df_Hz, df_ppm :: frequency shift maps in Hz and ppm (mrfit_utils.Hz2ppm)
+    @return phi :: phase map (radians, wrapped to (-pi, pi])
+    @return status :: per-voxel fit status map (FIT_* constants)
+    """
+    utes = np.asarray(utes, dtype=np.float64)
+    sig, sp_shape = _spatial_to_rows(cplx_data, axis)
+    n_vox = sig.shape[0]
+
+    if bounds is None:
+        bounds = ([1e-3 * np.max(np.abs(utes)), -np.inf, -np.inf, -np.inf], [np.inf] * 4)
+    lb, ub = bounds
+
+    params = np.full((n_vox, 4), np.nan)
+    status = np.full(n_vox, FIT_SKIPPED, dtype=np.int8)
+
+    vox = np.arange(n_vox) if mask is None else np.flatnonzero(np.asarray(mask).ravel())
+    for b0 in range(0, vox.size, block_size):
+        bi = vox[b0:b0 + block_size]
+        obs = sig[bi].astype(np.complex128)
+
+        x0 = np.empty((bi.size, 4))
+        x0[:, 0:2] = _t2str_mag_seed(np.abs(obs), utes, init)[:, 0:2]
+        x0[:, 2], x0[:, 3] = gre_3dute.calc_df_phi_est(obs, utes, axis=1)
+
+        obs_ri = np.concatenate((obs.real, obs.imag), axis=1)
+        xb, cost, st = levenberg_marquardt(_t2str_cplx_res_jac, x0, obs_ri, args=(utes,),
+                                           lb=lb, ub=ub, **lm_kwargs)
+        params[bi] = xb
+        status[bi] = st
+
+    T2str, K, df, phi = (params[:, pi].reshape(sp_shape) for pi in range(4))
+    df_Hz = df / te_units
+    phi = np.angle(np.exp(1j * phi))
+    return T2str, K, df_Hz, Hz2ppm(df_Hz, B0=B0), phi, status.reshape(sp_shape)
+
+def _t2str_power_res_jac(params, obs_power, utes):
+    """Residuals & Jacobian of the T2str-weighted power model (see gre_3dute.T2str_power)"""
+    res = gre_3dute.T2str_power_batch(params, utes) - obs_power
+    jac = gre_3dute.T2str_power_jac(params, utes)
+    return res, jac
+
+def fit_t2str_power(data, utes, noise_est=None, mask=None, axis=0, bounds=None,
+                    exclude_mask=None, init='loglinear', block_size=65536, **lm_kwargs):
+    """Voxelwise noise-corrected fit of the T2str-weighted power model for a whole volume
+
+    P = |S|^2 - noise_est = P_0 * [ exp(-2TE/T2*) ]
+
+    Fitting the noise-corrected power avoids the noise floor bias of magnitude
+    fits at long echo times. If noise_est is not given, it is estimated from the
+    background of `data` (img_utils.noise.estimate_noise_power); when fitting a
+    volume slab by slab, estimate it once for the whole volume and pass it in.
+
+    @param data :: complex or magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param noise_est :: background noise power (scalar or one value per echo)
+    @param mask :: optional boolean map (spatial shape); voxels outside it are not fit
+    @param axis :: echo axis of data
+    @param bounds :: optional (lb, ub) parameter bounds; default keeps T2str positive
+    @param exclude_mask :: voxels never used as background for the noise estimate (e.g., phantom ROIs)
+    @param init :: closed-form initial estimate applied to sqrt(P) ('loglinear', 'arlo', 'twopoint')
+    @param block_size :: number of voxels fit together (bounds memory use)
+    @param lm_kwargs :: passed on to levenberg_marquardt (max_iter, ftol, ...)
+
+    @return T2str, P_0 :: parameter maps (spatial shape)
+    @return status :: per-voxel fit status map (FIT_* constants)
+    @return noise_est :: noise power used for the correction (per echo)
+    """
+    utes = np.asarray(utes, dtype=np.float64)
+    if noise_est is None:
+        noise_est, bg_mask = estimate_noise_power(data, axis=axis, exclude_mask=exclude_mask)
+    noise_est = np.broadcast_to(np.asarray(noise_est, dtype=np.float64), utes.shape)
+
+    sig, sp_shape = _spatial_to_rows(data, axis)
+    n_vox = sig.shape[0]
+
+    if bounds is None:
+        bounds = ([1e-3 * np.max(np.abs(utes)), -np.inf], [np.inf, np.inf])
+    lb, ub = bounds
+
+    params = np.full((n_vox, 2), np.nan)
+    status = np.full(n_vox, FIT_SKIPPED, dtype=np.int8)
+
+    vox = np.arange(n_vox) if mask is None else np.flatnonzero(np.asarray(mask).ravel())
+    for b0 in range(0, vox.size, block_size):
+        bi = vox[b0:b0 + block_size]
+        mag = np.abs(sig[bi]).astype(np.float64)
+        P_corr = mag * mag - noise_est
+
+        x0 = _t2str_mag_seed(np.sqrt(np.clip(P_corr, 0, None)), utes, init)[:, 0:2]
+        x0[:, 1] = x0[:, 1] * x0[:, 1]
+
+        xb, cost, st = levenberg_marquardt(_t2str_power_res_jac, x0, P_corr, args=(utes,),
+                                           lb=lb, ub=ub, **lm_kwargs)
+        params[bi] = xb
+        status[bi] = st
+
+    T2str, P_0 = (params[:, pi].reshape(sp_shape) for pi in range(2))
+    return T2str, P_0, status.reshape(sp_shape), noise_est
@@ -0,0 +1,199 @@
+"""
+Dictionary (lookup table) fitting of the GRE UTE signal models
+
+A dictionary of simulated signal evolutions is built over a grid of parameter
+values for a fixed acquisition protocol (TE/TR/flip angles). Voxels are matched
+to the atom with the largest normalized inner product, using blocked matrix
+products (optionally after SVD compression of the echo/flip-angle axis).
+Dictionaries are cached on disk, keyed by the protocol and grid.
+
+Note: matching is by normalized inner product, so a constant offset (e.g., the
+N term of T2str_mag_simplified) is not modelled.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from . import gre_3dute
+
+def default_cache_dir():
+    """Dictionary cache directory ($PYQMRI_CACHE/dictionaries, default ~/.cache/pyqmri/dictionaries)"""
+    root = os.environ.get('PYQMRI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pyqmri'))
+    return os.path.join(root, 'dictionaries')
+
+class SignalDictionary(object):
+    def __init__(self, atoms, params, param_names, protocol=None):
+        self.atoms = np.asarray(atoms, dtype=np.float64)   # (n_atoms, n_acq)
+        self.params = np.asarray(params, dtype=np.float64) # (n_atoms, n_params)
+        self.param_names = tuple(param_names)
+        self.protocol = protocol if protocol else {}
+
+        self.norms = np.linalg.norm(self.atoms, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.unit_atoms = np.nan_to_num(self.atoms / self.norms[:, None])
+        self.basis = None # (n_acq, rank) SVD basis, see compress(...)
+
+    def compress(self, rank=None, energy=0.9999):
+        """Compress the acquisition axis to the leading right singular vectors of the dictionary
+
+        @param rank :: number of singular vectors to keep
+        @param energy :: if rank is None, keep enough vectors for this fraction of the energy
+        """
+        U, sv, Vt = np.linalg.svd(self.unit_atoms, full_matrices=False)
+        if rank is None:
+            cum = np.cumsum(sv * sv) / np.sum(sv * sv)
+            rank = int(np.searchsorted(cum, energy) + 1)
+
+        self.basis = Vt[:rank].T
+        return self
+
+    def match(self, data, axis=0, mask=None, max_block_elems=2**24):
+        """Match every voxel to its best dictionary atom
+
+        @param data :: signal, acquisition axis along `axis` (e.g., [echo, z, y, x])
+        @param axis :: acquisition axis of data
+        @param mask :: optional boolean map (spatial shape); voxels outside it are NaN
+        @param max_block_elems :: bounds the size of the (voxels x atoms) inner product blocks
+
+        @return maps :: dict of parameter maps (one per param_names), plus
+                        'scale' (amplitude, e.g., K or PD) and 'corr' (normalized inner product)
+        """
+        sig = np.moveaxis(np.asarray(data), axis, -1)
+        sp_shape = sig.shape[:-1]
+        sig = sig.reshape(-1, sig.shape[-1])
+        n_vox = sig.shape[0]
+
+        atoms = self.unit_atoms if self.basis is None else self.unit_atoms @ self.basis
+
+        best = np.full(n_vox, -1, dtype=np.int64)
+        ip = np.full(n_vox, np.nan)
+        snorm = np.full(n_vox, np.nan)
+
+        vox = np.arange(n_vox) if mask is None else np.flatnonzero(np.asarray(mask).ravel())
+        block_size = max(1, int(max_block_elems // atoms.shape[0]))
+        for b0 in range(0, vox.size, block_size):
+            bi = vox[b0:b0 + block_size]
+            ss = sig[bi].astype(np.float64)
+            snorm[bi] = np.linalg.norm(ss, axis=1)
+            if self.basis is not None:
+                ss = ss @ self.basis
+
+            corr = ss @ atoms.T
+            kk = np.argmax(corr, axis=1)
+            best[bi] = kk
+            ip[bi] = corr[np.arange(bi.size), kk]
+
+        maps = {}
+        matched = best >= 0
+        for pi, pname in enumerate(self.param_names):
+            pmap = np.full(n_vox, np.nan)
+            pmap[matched] = self.params[best[matched], pi]
+            maps[pname] = pmap.reshape(sp_shape)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.full(n_vox, np.nan)
+            scale[matched] = ip[matched] / self.norms[best[matched]]
+            maps['scale'] = scale.reshape(sp_shape)
+            maps['corr'] = (ip / snorm).reshape(sp_shape)
+
+        return maps
+
+    def save(self, fname):
+        np.savez(fname, atoms=self.atoms, params=self.params,
+                 param_names=np.array(self.param_names),
+                 protocol=np.array(json.dumps(self.protocol)))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as dd:
+            return cls(dd['atoms'], dd['params'], [str(pn) for pn in dd['param_names']],
+                       protocol=json.loads(str(dd['protocol'])))
+
+def _protocol_key(protocol):
+    """Hash of the protocol/grid description (used as the cache file name)"""
+    desc = json.dumps(protocol, sort_keys=True)
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()[:16]
+
+def _as_list(vals):
+    return [float(vv) for vv in np.atleast_1d(np.asarray(vals, dtype=np.float64))]
+
+def _cached(protocol, build, cache_dir, use_cache):
+    if not use_cache:
+        return build()
+
+    cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+    fname = os.path.join(cache_dir, '{:s}-{:s}.npz'.format(protocol['model'], _protocol_key(protocol)))
+    if os.path.exists(fname):
+        return SignalDictionary.load(fname)
+
+    sdict = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fname = fname + '.{:d}.tmp.npz'.format(os.getpid())
+    sdict.save(tmp_fname)
+    os.replace(tmp_fname, fname)
+    return sdict
+
+def t2str_dictionary(utes, T2str_grid, cache_dir=None, use_cache=True):
+    """Dictionary of T2str_mag_simplified(...) decays (K = 1, N = 0)
+
+    @param utes :: echo times of the protocol (e.g., from loaders.load_ute_list)
+    @param T2str_grid :: T2* values (same units as utes)
+    @param cache_dir :: dictionary cache directory (default: default_cache_dir())
+    @param use_cache :: load/save the dictionary from/to the cache
+
+    @return SignalDictionary with param_names ('T2str',)
+    """
+    protocol = {
+        'model' : 'T2str_mag_simplified',
+        'TE' : _as_list(utes),
+        'T2str_grid' : _as_list(T2str_grid),
+    }
+
+    def build():
+        TE = np.array(protocol['TE'])
+        T2str = np.array(protocol['T2str_grid'])[:, None]
+        atoms = gre_3dute.T2str_mag_simplified(1.0, TE, T2str, 0.0)
+        return SignalDictionary(atoms, T2str, ('T2str',), protocol)
+
+    return _cached(protocol, build, cache_dir, use_cache)
+
+def spgr_dictionary(TR, TE, alph, T1_grid, T2str_grid=(np.inf,), b1_grid=(1.0,),
+                    cache_dir=None, use_cache=True):
+    """Dictionary of spgr_mag(...) signals (PD = 1) over T1, T2* and flip angle scaling (B1)
+
+    TR, TE and alph (radians) are broadcast against each other to the acquisition axis.
+
+    @param T1_grid, T2str_grid :: parameter values (same units as TR/TE)
+    @param b1_grid :: flip angle scale factors (actual/nominal flip angle)
+    @param cache_dir :: dictionary cache directory (default: default_cache_dir())
+    @param use_cache :: load/save the dictionary from/to the cache
+
+    @return SignalDictionary with param_names ('T1', 'T2str', 'B1')
+    """
+    TR, TE, alph = np.broadcast_arrays(*(np.atleast_1d(np.asarray(vv, dtype=np.float64))
+                                         for vv in (TR, TE, alph)))
+    protocol = {
+        'model' : 'spgr_mag',
+        'TR' : _as_list(TR),
+        'TE' : _as_list(TE),
+        'alph' : _as_list(alph),
+        'T1_grid' : _as_list(T1_grid),
+        'T2str_grid' : _as_list(T2str_grid),
+        'b1_grid' : _as_list(b1_grid),
+    }
+
+    def build():
+        T1, T2str, B1 = (gg.ravel() for gg in np.meshgrid(protocol['T1_grid'],
+                                                          protocol['T2str_grid'],
+                                                          protocol['b1_grid'],
+                                                          indexing='ij'))
+        params = np.stack((T1, T2str, B1), axis=1)
+        atoms = gre_3dute.spgr_mag(1.0, T1[:, None], T2str[:, None],
+                                   TR, TE, B1[:, None] * alph)
+        return SignalDictionary(atoms, params, ('T1', 'T2str', 'B1'), protocol)
+
+    return _cached(protocol, build, cache_dir, use_cache)
@@ -21,6 +21,44 @@ def T2str_mag_simplified(K, TE, T2str, N):
     S = K * np.exp((-1.0 * TE)/T2str) + N
     return S
 
+def T2str_mag_simplified_batch(params, TE):
+    """Batched T2str_mag_simplified(...) [above] for many voxels with a shared TE axis
+    
+    @param params :: parameter array, shape (n_voxels, 3) (or (3,) for a single voxel)
+    @param TE :: echo times, shape (n_TE,)
+    
+    Parameter ordering (same as t2strw_mag_resid):
+      params[..., 0] = T2str
+      params[..., 1] = K
+      params[..., 2] = N
+    
+    @return S :: expected (magnitude) signal, shape (n_voxels, n_TE)
+    """
+    T2str = params[..., 0, None]
+    K = params[..., 1, None]
+    N = params[..., 2, None]
+
+    return T2str_mag_simplified(K, TE, T2str, N)
+
+def T2str_mag_simplified_jac(params, TE):
+    """Closed-form Jacobian of T2str_mag_simplified_batch(...) [above]
+    
+    dS/dT2str = K * TE/T2*^2 * exp(-TE/T2*)
+    dS/dK = exp(-TE/T2*)
+    dS/dN = 1
+    
+    @return J :: dS/dparams, shape (n_voxels, n_TE, 3)
+    """
+    T2str = params[..., 0, None]
+    K = params[..., 1, None]
+
+    E = np.exp((-1.0 * TE)/T2str)
+    J = np.empty(E.shape + (3,))
+    J[..., 0] = K * E * TE / (T2str * T2str)
+    J[..., 1] = E
+    J[..., 2] = 1.0
+    return J
+
 def t2strw_mag_resid(params, utes, obs_sig):
     """Residuals when fitting the T2str-weighted UTE GRE magnitude signal
     
@@ -44,6 +82,16 @@ def t2strw_mag_resid(params, utes, obs_sig):
     res = T2str_mag_simplified(K, utes, T2str, N) - obs_sig
     return res
 
+def t2strw_mag_jac(params, utes, obs_sig):
+    """Jacobian of t2strw_mag_resid(...) [above]
+    
+    Same call signature as the residual function, so it can be passed as
+    scipy.optimize.least_squares(t2strw_mag_resid, x0, jac=t2strw_mag_jac, ...)
+    
+    @return J :: d(res)/d(params), shape (n_TE, 3)
+    """
+    return T2str_mag_simplified_jac(np.asarray(params, dtype=np.float64), np.asarray(utes))
+
 def T2str_power(P_0, TE, T2str):
     """Signal Model for the "power" (square of the magnitude) of a complex signal from a T2* weighted GRE image
     
@@ -65,6 +113,37 @@ def T2str_power(P_0, TE, T2str):
     P = P_0 * np.exp((-2.0 * TE)/T2str)
     return P
 
+def T2str_power_batch(params, TE):
+    """Batched T2str_power(...) [above] for many voxels with a shared TE axis
+    
+    Parameter ordering (same as t2strw_pow_resid):
+      params[..., 0] = T2str
+      params[..., 1] = P_0
+    
+    @return P :: predicted power of the signal, shape (n_voxels, n_TE)
+    """
+    T2str = params[..., 0, None]
+    P_0 = params[..., 1, None]
+
+    return T2str_power(P_0, TE, T2str)
+
+def T2str_power_jac(params, TE):
+    """Closed-form Jacobian of T2str_power_batch(...) [above]
+    
+    dP/dT2str = P_0 * 2TE/T2*^2 * exp(-2TE/T2*)
+    dP/dP_0 = exp(-2TE/T2*)
+    
+    @return J :: dP/dparams, shape (n_voxels, n_TE, 2)
+    """
+    T2str = params[..., 0, None]
+    P_0 = params[..., 1, None]
+
+    E2 = np.exp((-2.0 * TE)/T2str)
+    J = np.empty(E2.shape + (2,))
+    J[..., 0] = P_0 * E2 * 2.0 * TE / (T2str * T2str)
+    J[..., 1] = E2
+    return J
+
 def t2strw_pow_resid(params, utes, obs_power, noise_est):
     """Residuals when fitting the power of the T2str-weighted UTE GRE signal
     
@@ -90,6 +169,13 @@ def t2strw_pow_resid(params, utes, obs_power, noise_est):
     res = T2str_power(P_0, utes, T2str) - P_corr
     return res
 
+def t2strw_pow_jac(params, utes, obs_power, noise_est):
+    """Jacobian of t2strw_pow_resid(...) [above] (same call signature)
+    
+    @return J :: d(res)/d(params), shape (n_TE, 2)
+    """
+    return T2str_power_jac(np.asarray(params, dtype=np.float64), np.asarray(utes))
+
 def T2str_cplx(K, TE, T2str, df, phi):
     """Signal Model of T2str-weighted UTE GRE Magnitude Image
     
@@ -107,6 +193,48 @@ def T2str_cplx(K, TE, T2str, df, phi):
     S = K * np.exp((-1.0 * TE)/T2str - 1j*2*np.pi*df*TE + 1j*phi)
     return S
 
+def T2str_cplx_batch(params, TE):
+    """Batched T2str_cplx(...) [above] for many voxels with a shared TE axis
+    
+    Parameter ordering (same as t2strw_cplx_resid):
+      params[..., 0] = T2str
+      params[..., 1] = K
+      params[..., 2] = df
+      params[..., 3] = phi
+    
+    @return S :: expected (complex) signal, shape (n_voxels, n_TE)
+    """
+    T2str = params[..., 0, None]
+    K = params[..., 1, None]
+    df = params[..., 2, None]
+    phi = params[..., 3, None]
+
+    return T2str_cplx(K, TE, T2str, df, phi)
+
+def T2str_cplx_jac(params, TE):
+    """Closed-form (complex) Jacobian of T2str_cplx_batch(...) [above]
+    
+    dS/dT2str = S * TE/T2*^2
+    dS/dK = S/K
+    dS/ddf = -i2pi * TE * S
+    dS/dphi = i * S
+    
+    @return J :: dS/dparams, shape (n_voxels, n_TE, 4)
+    """
+    T2str = params[..., 0, None]
+    K = params[..., 1, None]
+    df = params[..., 2, None]
+    phi = params[..., 3, None]
+
+    G = np.exp((-1.0 * TE)/T2str - 1j*2*np.pi*df*TE + 1j*phi)
+    S = K * G
+    J = np.empty(S.shape + (4,), dtype=np.complex128)
+    J[..., 0] = S * TE / (T2str * T2str)
+    J[..., 1] = G
+    J[..., 2] = -1j*2*np.pi * TE * S
+    J[..., 3] = 1j * S
+    return J
+
 def t2strw_cplx_resid(params, utes, obs_sig):
     """Residuals when fitting the T2str-weighted UTE GRE magnitude signal
     
@@ -132,17 +260,323 @@ def t2strw_cplx_resid(params, utes, obs_sig):
     res = T2str_cplx(K, utes, T2str, df, phi) - obs_sig
     return np.array([res.real, res.imag]).T.flatten()
 
+def t2strw_cplx_jac(params, utes, obs_sig):
+    """Jacobian of t2strw_cplx_resid(...) [above] (same call signature)
+    
+    Rows are interleaved (Re, Im) per echo to match the residual vector.
+    
+    @return J :: d(res)/d(params), shape (2 * n_TE, 4)
+    """
+    Jc = T2str_cplx_jac(np.asarray(params, dtype=np.float64), np.asarray(utes))
+    return np.stack((Jc.real, Jc.imag), axis=-2).reshape(-1, 4)
+
+def T2str_mag_biexp(rho, TE, w_short, T2str_short, w_long, T2str_long):
+    """Signal Model of a bi-exponential (short/long T2*) UTE GRE Magnitude Image
+    
+    S = rho * [ w_short * exp(-TE/T2*_short) + w_long * exp(-TE/T2*_long) ]
+    
+    parameters:
+      rho :: overall proton density
+      TE :: sequence echo time
+      w_short, T2str_short :: fraction and T2* of the ultrashort component
+      w_long, T2str_long :: fraction and T2* of the long component
+    
+    @return expected (magnitude) signal
+    """
+    S = rho * ((w_short * np.exp((-1.0 * TE)/T2str_short)) + \
+               (w_long * np.exp((-1.0 * TE)/T2str_long)))
+    return S
+
+def mag_biexp_resid(params, utes, obs_sig):
+    """Residuals when fitting the bi-exponential UTE GRE magnitude signal
+    
+    See T2str_mag_biexp(...) [above]
+    Used for least-squares fitting
+    
+    Parameter ordering:
+      params[0] = rho
+      params[1] = w_short
+      params[2] = T2str_short
+      params[3] = w_long
+      params[4] = T2str_long
+    
+    @return res :: signal residuals
+    """
+    rho = params[0]
+    w_short = params[1]
+    T2str_short = params[2]
+    w_long = params[3]
+    T2str_long = params[4]
+
+    res = T2str_mag_biexp(rho, utes, w_short, T2str_short, w_long, T2str_long) - obs_sig
+    return res
+
 def spgr_mag(PD, T1, T2str, TR, TE, alph, k=1.0):
     """Spoiled Gradient Recall at Steady State (SPGR) signal equation"""
     S = k * PD * np.exp(-TE/T2str) * ((np.sin(alph) * (1 - np.exp(-TR/T1)))/(1 - (np.cos(alph) * np.exp(-TR/T1))))
     return S
 
+def _T1_steady_state(T1, TR, alph):
+    """Steady-state T1 weighting sin(a)(1 - E1)/(1 - cos(a)E1) and its derivative w.r.t. T1"""
+    E1 = np.exp((-1.0 * TR)/T1)
+    cos_a = np.cos(alph)
+    denom = 1 - (cos_a * E1)
+
+    f = (np.sin(alph) * (1 - E1)) / denom
+    df_dT1 = np.sin(alph) * (cos_a - 1) * E1 * TR / (T1 * T1 * denom * denom)
+    return f, df_dT1
+
+def spgr_mag_batch(params, TR, TE, alph, k=1.0):
+    """Batched spgr_mag(...) [above] for many voxels with a shared acquisition axis
+    
+    TR, TE and alph are broadcast against each other to the acquisition axis (n_acq,)
+    
+    Parameter ordering:
+      params[..., 0] = PD
+      params[..., 1] = T1
+      params[..., 2] = T2str
+    
+    @return S :: expected signal, shape (n_voxels, n_acq)
+    """
+    PD = params[..., 0, None]
+    T1 = params[..., 1, None]
+    T2str = params[..., 2, None]
+
+    return spgr_mag(PD, T1, T2str, TR, TE, alph, k=k)
+
+def spgr_mag_jac(params, TR, TE, alph, k=1.0):
+    """Closed-form Jacobian of spgr_mag_batch(...) [above]
+    
+    @return J :: dS/dparams, shape (n_voxels, n_acq, 3)
+    """
+    PD = params[..., 0, None]
+    T1 = params[..., 1, None]
+    T2str = params[..., 2, None]
+
+    E2 = np.exp(-TE/T2str)
+    f, df_dT1 = _T1_steady_state(T1, TR, alph)
+    S = k * PD * E2 * f
+
+    J = np.empty(S.shape + (3,))
+    J[..., 0] = k * E2 * f
+    J[..., 1] = k * PD * E2 * df_dT1
+    J[..., 2] = S * TE / (T2str * T2str)
+    return J
+
 def T1_mag(K, T1, TR, alph):
     """Expected signal for T1w UTE GRE 'magnitude' images"""
     S = K * ((np.sin(alph) * (1 - np.exp((-1.0 * TR)/T1))) / (1 - (np.cos(alph) * np.exp((-1.0 * TR)/T1))))
     return S
 
+def T1_mag_batch(params, TR, alph):
+    """Batched T1_mag(...) [above] for many voxels with a shared flip angle (and/or TR) axis
+    
+    Parameter ordering:
+      params[..., 0] = K
+      params[..., 1] = T1
+    
+    @return S :: expected signal, shape (n_voxels, n_acq)
+    """
+    K = params[..., 0, None]
+    T1 = params[..., 1, None]
+
+    return T1_mag(K, T1, TR, alph)
+
+def T1_mag_jac(params, TR, alph):
+    """Closed-form Jacobian of T1_mag_batch(...) [above]
+    
+    dS/dK = sin(a)(1 - E1)/(1 - cos(a)E1)
+    dS/dT1 = K * sin(a)(cos(a) - 1) * E1 * TR / (T1^2 * (1 - cos(a)E1)^2)
+    
+    @return J :: dS/dparams, shape (n_voxels, n_acq, 2)
+    """
+    K = params[..., 0, None]
+    T1 = params[..., 1, None]
+
+    f, df_dT1 = _T1_steady_state(T1, TR, alph)
+    J = np.empty(f.shape + (2,))
+    J[..., 0] = f
+    J[..., 1] = K * df_dT1
+    return J
+
 def calc_VFA_T1(S1, S2, fa1, fa2, TR):
     """Equation to calculate T1 from two T1w UTE GRE 'magnitude' images with different flip angles"""
     T1 = -1.0 * TR / np.log((S1/np.sin(fa1) - S2/np.sin(fa2)) / (S1/np.tan(fa1) - S2/np.tan(fa2)))
     return T1
+
+def calc_VFA_T1_linear(S, fas, TR, axis=0, b1=None, weighted=False, n_iter=2):
+    """Linearized variable flip angle (DESPOT1) T1 & M0 estimate from any number of flip angles
+    
+    S/sin(a) = E1 * S/tan(a) + M0 * (1 - E1),  E1 = exp(-TR/T1)
+    
+    Every voxel is solved at once with the closed-form least-squares line fit.
+    With weighted=True the fit is refined with weights (sin(a) / (1 - E1 cos(a)))^2
+    from the previous estimate, which accounts for the error propagation of the
+    linearization.
+    
+    @param S :: T1w magnitude images, flip angles along `axis` (e.g., [fa, z, y, x])
+    @param fas :: nominal flip angles (radians, same length as the flip angle axis)
+    @param TR :: repetition time
+    @param axis :: flip angle axis of S
+    @param b1 :: optional B1+ scaling map (actual/nominal flip angle, spatial shape of S)
+    @param weighted :: refine with the weighted fit
+    @param n_iter :: number of weighted refinement passes
+    
+    @return T1, M0 :: estimate maps (NaN where T1 could not be estimated)
+    """
+    S = np.moveaxis(np.asarray(S, dtype=np.float64), axis, 0)
+    alph = np.asarray(fas, dtype=np.float64).reshape((-1,) + (1,) * (S.ndim - 1))
+    if b1 is not None:
+        alph = alph * np.asarray(b1, dtype=np.float64)
+
+    y = S / np.sin(alph)
+    x = S / np.tan(alph)
+    w = np.ones_like(S)
+
+    for ii in range(1 + (n_iter if weighted else 0)):
+        E1, b = _weighted_line_fit(x, y, w)
+        E1 = np.where((E1 > 0) & (E1 < 1), E1, np.nan)
+
+        if weighted:
+            w = np.square(np.sin(alph) / (1 - E1 * np.cos(alph)))
+            w = np.where(np.isfinite(w), w, 1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        T1 = -1.0 * TR / np.log(E1)
+        M0 = b / (1 - E1)
+    return T1, M0
+
+def _echoes_first(mag_data, utes, axis):
+    """Move the echo axis of mag_data to the front and shape utes to broadcast against it"""
+    S = np.moveaxis(np.asarray(mag_data, dtype=np.float64), axis, 0)
+    TE = np.asarray(utes, dtype=np.float64).reshape((-1,) + (1,) * (S.ndim - 1))
+    return S, TE
+
+def _weighted_line_fit(x, y, w):
+    """Closed-form weighted least-squares line y = slope * x + intercept along axis 0 (all voxels at once)"""
+    Sw = np.sum(w, axis=0)
+    Sx = np.sum(w * x, axis=0)
+    Sy = np.sum(w * y, axis=0)
+    Sxx = np.sum(w * x * x, axis=0)
+    Sxy = np.sum(w * x * y, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (Sw * Sxy - Sx * Sy) / (Sw * Sxx - Sx * Sx)
+        intercept = (Sy - slope * Sx) / Sw
+    return slope, intercept
+
+def calc_T2str_loglinear(mag_data, utes, axis=0, noise_offset=0.0, weighted=True):
+    """Closed-form T2* (and K) estimate from all echoes by (weighted) log-linear regression
+    
+    log(S - N) = log(K) - TE/T2*
+    
+    Every voxel is solved at once with the closed-form weighted least-squares
+    line fit. Weights are (S - N)^2, which accounts for the noise amplification
+    of the log transform at low signal. Echoes with S - N <= 0 are ignored.
+    
+    @param mag_data :: magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param axis :: echo axis of mag_data
+    @param noise_offset :: offset N subtracted before taking the log (scalar or map)
+    @param weighted :: use (S - N)^2 weights (otherwise ordinary least squares)
+    
+    @return T2str, K :: estimate maps (NaN where no decay could be estimated)
+    """
+    S, TE = _echoes_first(mag_data, utes, axis)
+    S = S - noise_offset
+
+    valid = S > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(valid, np.log(np.where(valid, S, 1.0)), 0.0)
+    w = np.where(valid, (S * S) if weighted else 1.0, 0.0)
+
+    slope, intercept = _weighted_line_fit(TE, y, w)
+    with np.errstate(divide='ignore'):
+        T2str = -1.0 / slope
+
+    ok = np.isfinite(T2str) & (T2str > 0) & (np.sum(valid, axis=0) >= 2)
+    T2str = np.where(ok, T2str, np.nan)
+    K = np.where(ok, np.exp(intercept), np.nan)
+    return T2str, K
+
+def calc_T2str_ARLO(mag_data, utes, axis=0):
+    """Closed-form T2* (and K) estimate by auto-regression on linear operations (ARLO)
+    
+    Uses the integral form of the mono-exponential decay:
+    
+      S(TE_i) - S(TE_0) = -(1/T2*) * integral_{TE_0}^{TE_i} S dTE
+    
+    For evenly spaced echoes this is the Simpson's-rule ARLO estimator
+    (Pei et al., MRM 2015); for arbitrary echo spacing the integrals are
+    accumulated with the trapezoid rule and 1/T2* is found by linear least squares.
+    K is then the least-squares amplitude for the estimated decay.
+    
+    @param mag_data :: magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param axis :: echo axis of mag_data
+    
+    @return T2str, K :: estimate maps (NaN where no decay could be estimated)
+    """
+    S, TE = _echoes_first(mag_data, utes, axis)
+    order = np.argsort(TE.ravel())
+    S = S[order]
+    TE = TE[order]
+
+    dTE = np.diff(TE.ravel())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if (TE.size >= 3) and np.allclose(dTE, dTE[0]):
+            h3 = dTE[0] / 3.0
+            s = h3 * (S[:-2] + 4 * S[1:-1] + S[2:])
+            d = S[:-2] - S[2:]
+            T2str = (np.sum(s * s, axis=0) + h3 * np.sum(s * d, axis=0)) / \
+                    (h3 * np.sum(d * d, axis=0) + np.sum(s * d, axis=0))
+        else:
+            I = np.cumsum(0.5 * (TE[1:] - TE[:-1]) * (S[1:] + S[:-1]), axis=0)
+            T2str = -1.0 * np.sum(I * I, axis=0) / np.sum(I * (S[1:] - S[0]), axis=0)
+
+        E = np.exp((-1.0 * TE) / T2str)
+        K = np.sum(S * E, axis=0) / np.sum(E * E, axis=0)
+
+    ok = np.isfinite(T2str) & (T2str > 0)
+    return np.where(ok, T2str, np.nan), np.where(ok, K, np.nan)
+
+def calc_df_phi_est(cplx_data, utes, axis=0):
+    """Closed-form frequency shift (df) and phase (phi) estimate from echo-to-echo phase differences
+    
+    Phase model of T2str_cplx(...): angle(S) = phi - 2pi * df * TE
+    
+    df is first estimated from the (magnitude-weighted) phase differences of the
+    most closely spaced echo pairs, which are the least likely to alias. The
+    phase is then unwrapped along the echoes relative to that estimate, and df
+    and phi are found by a |S|^2-weighted linear fit of phase vs. TE.
+    
+    @param cplx_data :: complex images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param axis :: echo axis of cplx_data
+    
+    @return df, phi :: estimate maps (df in cycles per unit of utes, phi in radians)
+    """
+    S = np.moveaxis(np.asarray(cplx_data), axis, 0)
+    TE = np.asarray(utes, dtype=np.float64)
+    order = np.argsort(TE)
+    S = S[order]
+    TE = TE[order]
+
+    dTE = np.diff(TE)
+    pairs = np.flatnonzero(np.isclose(dTE, np.min(dTE)))
+    z = np.sum(S[pairs + 1] * np.conj(S[pairs]), axis=0)
+    df = -1.0 * np.angle(z) / (2 * np.pi * dTE[pairs[0]])
+
+    # unwrap along the echoes around the predicted phase evolution
+    ph = np.empty(S.shape)
+    ph[0] = np.angle(S[0])
+    for ei in range(1, TE.size):
+        pred = ph[ei - 1] - 2 * np.pi * df * dTE[ei - 1]
+        ph[ei] = pred + np.angle(S[ei] * np.exp(-1j * pred))
+
+    TEb = TE.reshape((-1,) + (1,) * (S.ndim - 1))
+    slope, intercept = _weighted_line_fit(TEb, ph, np.abs(S)**2)
+
+    df = -1.0 * slope / (2 * np.pi)
+    phi = np.angle(np.exp(1j * intercept))
+    return df, phi
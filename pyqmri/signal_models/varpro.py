@@ -0,0 +1,119 @@
+"""
+Variable projection (VARPRO) fitting of the bi-exponential UTE GRE magnitude model
+
+The linear amplitudes (rho * w_short, rho * w_long) are eliminated in closed
+form, so only the two decay constants (T2*_short, T2*_long) are searched:
+first on a coarse grid shared by all voxels, then refined with the batched
+Levenberg-Marquardt solver using the Kaufman approximation of the Jacobian.
+"""
+__author__ = "Dharshan Chandramohan"
+
+import numpy as np
+
+from . import batch_fit
+
+def _basis(theta, utes):
+    """Exponential basis exp(-TE/T2*_k) and its derivative w.r.t. T2*_k
+
+    @param theta :: (n, 2) decay constants
+    @return Phi, dPhi :: shape (n, n_TE, 2)
+    """
+    T2 = theta[:, None, :]
+    TE = utes[None, :, None]
+    Phi = np.exp((-1.0 * TE)/T2)
+    dPhi = Phi * TE / (T2 * T2)
+    return Phi, dPhi
+
+def _amplitudes(Phi, obs_sig):
+    """Closed-form linear least-squares amplitudes for each voxel"""
+    G = np.einsum('nmk,nml->nkl', Phi, Phi)
+    G = G + (1e-12 * np.einsum('nkk->n', G))[:, None, None] * np.eye(2)
+    b = np.einsum('nmk,nm->nk', Phi, obs_sig)
+    return np.linalg.solve(G, b[:, :, None])[:, :, 0], G
+
+def _varpro_res_jac(theta, obs_sig, utes):
+    """Projected residuals and (Kaufman) Jacobian w.r.t. the decay constants"""
+    Phi, dPhi = _basis(theta, utes)
+    amp, G = _amplitudes(Phi, obs_sig)
+    res = np.einsum('nmk,nk->nm', Phi, amp) - obs_sig
+
+    # J_k = P_perp (dPhi_k * a_k), P_perp = I - Phi (Phi^T Phi)^-1 Phi^T
+    V = dPhi * amp[:, None, :]
+    coef = np.linalg.solve(G, np.einsum('nmk,nml->nkl', Phi, V))
+    jac = V - np.einsum('nmk,nkl->nml', Phi, coef)
+    return res, jac
+
+def _grid_search(obs_sig, utes, grid):
+    """Best (T2*_short < T2*_long) pair on a log-spaced grid with non-negative amplitudes"""
+    ii, jj = np.triu_indices(grid.size, k=1)
+    theta = np.stack((grid[ii], grid[jj]), axis=1)
+    Phi, dPhi = _basis(theta, utes) # (n_pairs, n_TE, 2)
+
+    Q, R = np.linalg.qr(Phi)
+    Rinv = np.linalg.inv(R)
+    qy = np.einsum('pmk,nm->npk', Q, obs_sig)
+    amp = np.einsum('pkl,npl->npk', Rinv, qy)
+
+    # residual norm = |y|^2 - |Q^T y|^2; pairs with negative amplitudes are not allowed
+    cost = -np.sum(qy * qy, axis=2)
+    cost[np.any(amp < 0, axis=2)] = np.inf
+    best = np.argmin(cost, axis=1)
+    return theta[best]
+
+def fit_biexp_varpro(mag_data, utes, mask=None, axis=0, bounds=None, grid_size=24,
+                     block_size=16384, **lm_kwargs):
+    """Voxelwise bi-exponential T2* fit by variable projection for a whole volume (or slab)
+
+    S = rho * [ w_short * exp(-TE/T2*_short) + w_long * exp(-TE/T2*_long) ]
+
+    (see gre_3dute.T2str_mag_biexp)
+
+    @param mag_data :: magnitude images, echoes along `axis` (e.g., [echo, z, y, x])
+    @param utes :: echo times (same length as the echo axis)
+    @param mask :: optional boolean map (spatial shape); voxels outside it are not fit
+    @param axis :: echo axis of mag_data
+    @param bounds :: optional (lb, ub) on both decay constants;
+                     default (shortest echo spacing, 10 * longest TE)
+    @param grid_size :: number of log-spaced grid points per decay constant for the initial search
+    @param block_size :: number of voxels fit together (bounds memory use)
+    @param lm_kwargs :: passed on to batch_fit.levenberg_marquardt (max_iter, ftol, ...)
+
+    @return rho, w_short, T2str_short, w_long, T2str_long :: parameter maps (spatial shape)
+    @return status :: per-voxel fit status map (batch_fit.FIT_* constants)
+    """
+    utes = np.asarray(utes, dtype=np.float64)
+    sig, sp_shape = batch_fit._spatial_to_rows(mag_data, axis)
+    n_vox = sig.shape[0]
+
+    if bounds is None:
+        dTE = np.diff(np.sort(utes))
+        bounds = (np.min(dTE[dTE > 0]), 10.0 * np.max(utes))
+    lb, ub = bounds
+    grid = np.geomspace(lb, ub, grid_size)
+
+    params = np.full((n_vox, 5), np.nan)
+    status = np.full(n_vox, batch_fit.FIT_SKIPPED, dtype=np.int8)
+
+    vox = np.arange(n_vox) if mask is None else np.flatnonzero(np.asarray(mask).ravel())
+    for b0 in range(0, vox.size, block_size):
+        bi = vox[b0:b0 + block_size]
+        obs = sig[bi].astype(np.float64)
+        finite = np.all(np.isfinite(obs), axis=1)
+
+        theta0 = np.full((bi.size, 2), np.nan)
+        theta0[finite] = _grid_search(obs[finite], utes, grid)
+        theta, cost, st = batch_fit.levenberg_marquardt(_varpro_res_jac, theta0, obs, args=(utes,),
+                                                        lb=(lb, lb), ub=(ub, ub), **lm_kwargs)
+
+        # keep the short component first
+        theta = np.sort(theta, axis=1)
+        amp = np.full((bi.size, 2), np.nan)
+        ok = np.all(np.isfinite(theta), axis=1)
+        amp[ok] = _amplitudes(_basis(theta[ok], utes)[0], obs[ok])[0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho = amp[:, 0] + amp[:, 1]
+            params[bi] = np.stack((rho, amp[:, 0]/rho, theta[:, 0], amp[:, 1]/rho, theta[:, 1]), axis=1)
+        status[bi] = st
+
+    return tuple(params[:, pi].reshape(sp_shape) for pi in range(5)) + (status.reshape(sp_shape),)
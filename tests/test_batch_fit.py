@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from pyqmri.signal_models import batch_fit
+from pyqmri.signal_models import gre_3dute
+
+UTES = np.array([0.1, 0.5, 1.0, 2.0, 3.5, 5.0, 8.0])
+
+def t2str_mag_truth(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.stack((rng.uniform(0.5, 6.0, n),      # T2str
+                     rng.uniform(100.0, 1000.0, n), # K
+                     rng.uniform(0.0, 20.0, n)),    # N
+                    axis=1)
+
+def test_lm_recovers_exact_parameters():
+    truth = t2str_mag_truth(200)
+    obs = gre_3dute.T2str_mag_simplified_batch(truth, UTES)
+    x0 = truth * np.array([1.5, 0.7, 0.0]) + np.array([0.0, 0.0, 1.0])
+
+    x, cost, status = batch_fit.levenberg_marquardt(batch_fit._t2str_mag_res_jac, x0, obs, args=(UTES,),
+                                                    lb=[1e-3, -np.inf, -np.inf], max_iter=200)
+
+    np.testing.assert_allclose(x, truth, rtol=1e-5, atol=1e-4)
+    assert np.all(cost < 1e-8)
+    assert np.all(status > batch_fit.FIT_MAXITER)
+
+def test_lm_status_codes():
+    truth = t2str_mag_truth(4)
+    obs = gre_3dute.T2str_mag_simplified_batch(truth, UTES)
+    obs[1, 2] = np.nan
+    x0 = truth.copy()
+    x0[2, 0] = np.inf
+    x0[3] *= 3.0
+
+    x, cost, status = batch_fit.levenberg_marquardt(batch_fit._t2str_mag_res_jac, x0, obs, args=(UTES,))
+    assert status[0] == batch_fit.FIT_GTOL  # starts at the solution
+    assert status[1] == batch_fit.FIT_FAILED and np.isnan(cost[1])
+    assert status[2] == batch_fit.FIT_FAILED and np.isnan(cost[2])
+
+    x, cost, status = batch_fit.levenberg_marquardt(batch_fit._t2str_mag_res_jac, x0[3:], obs[3:],
+                                                    args=(UTES,), max_iter=1)
+    assert status[0] == batch_fit.FIT_MAXITER
+
+def test_lm_bounds():
+    truth = t2str_mag_truth(50)
+    obs = gre_3dute.T2str_mag_simplified_batch(truth, UTES)
+    x, cost, status = batch_fit.levenberg_marquardt(batch_fit._t2str_mag_res_jac, truth * 1.2, obs,
+                                                    args=(UTES,), lb=[1e-3, -np.inf, 5.0],
+                                                    ub=[np.inf, np.inf, 10.0])
+    assert np.all((x[:, 2] >= 5.0) & (x[:, 2] <= 10.0))
+
+@pytest.mark.parametrize('init', ['loglinear', 'arlo', 'twopoint'])
+def test_fit_t2str_mag_volume(init):
+    shape = (3, 4, 5)
+    truth = t2str_mag_truth(int(np.prod(shape)), seed=1)
+    sig = gre_3dute.T2str_mag_simplified_batch(truth, UTES)  # (n_voxels, n_TE)
+    mag = np.moveaxis(sig.reshape(shape + (UTES.size,)), -1, 0)  # [echo, z, y, x]
+
+    mask = np.ones(shape, dtype=bool)
+    mask[0, 0, :2] = False
+    mag[:, 2, 3, 4] = np.nan
+
+    T2str, K, N, status = batch_fit.fit_t2str_mag(mag, UTES, mask=mask, init=init, max_iter=300)
+    fitted = mask.copy()
+    fitted[2, 3, 4] = False
+
+    for est, pi in zip((T2str, K, N), range(3)):
+        np.testing.assert_allclose(est[fitted], truth[:, pi].reshape(shape)[fitted], rtol=1e-4, atol=1e-3)
+    assert np.all(status[fitted] > batch_fit.FIT_MAXITER)
+
+    # masked voxels are skipped (NaN), bad data fails
+    assert np.all(status[~mask] == batch_fit.FIT_SKIPPED)
+    assert np.all(np.isnan(T2str[~mask]) & np.isnan(K[~mask]) & np.isnan(N[~mask]))
+    assert status[2, 3, 4] == batch_fit.FIT_FAILED
+
+def test_fit_t2str_mag_noise_and_blocks():
+    rng = np.random.default_rng(2)
+    truth = np.tile([[2.0, 500.0, 10.0]], (400, 1))
+    sig = gre_3dute.T2str_mag_simplified_batch(truth, UTES) + rng.normal(0.0, 2.0, (400, UTES.size))
+
+    T2str, K, N, status = batch_fit.fit_t2str_mag(sig.T, UTES, block_size=64)
+    assert abs(np.median(T2str) - 2.0) < 0.02
+    assert abs(np.median(K) - 500.0) < 5.0
+    assert np.all(status != batch_fit.FIT_FAILED)
+
+def test_fit_t2str_mag_axis_and_x0():
+    truth = t2str_mag_truth(12, seed=3)
+    sig = gre_3dute.T2str_mag_simplified_batch(truth, UTES).reshape(3, 4, UTES.size)  # echo axis last
+    T2str, K, N, status = batch_fit.fit_t2str_mag(sig, UTES, axis=-1, x0=(3.0, 500.0, 0.0), max_iter=300)
+    np.testing.assert_allclose(T2str, truth[:, 0].reshape(3, 4), rtol=1e-4)
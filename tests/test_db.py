@@ -0,0 +1,102 @@
+import datetime
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+from mongoengine import connect, disconnect
+
+from pyqmri.phantom_util import db
+
+N_SAMPLES, N_PARAMS = 19, 10
+
+@pytest.fixture
+def mock_db():
+    disconnect()
+    connect('pyqmri_test', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient,
+            uuidRepresentation='standard')
+    for doc_cls in (db.Phantom, db.MaterialSample, db.Experiment, db.Measurement):
+        doc_cls._collection = None  # collections are cached per connection
+    yield
+    disconnect()
+
+@pytest.fixture
+def study(mock_db):
+    samples = db.insert_samples(['s{:d}'.format(ci) for ci in range(N_SAMPLES)], base_material='agar')
+    phantom = db.MaterialPhantom(phantom_uid='mk5-001', containers=samples).save()
+    exam = db.MR_Experiment(session_date=datetime.datetime(2020, 3, 4, 12, 0), exam_number=1234).save()
+
+    rng = np.random.default_rng(0)
+    stats = {'mean' : rng.normal(size=(N_SAMPLES, N_PARAMS)), 'std' : rng.random((N_SAMPLES, N_PARAMS)),
+             'count' : np.full((N_SAMPLES, N_PARAMS), 120)}
+    params = ['p{:d}'.format(pi) for pi in range(N_PARAMS)]
+    make_docs = lambda: db.measurements_from_stats(stats, params, samples, experiment=exam, phantom=phantom,
+                                                   details={'method' : 'lm'})
+    return phantom, exam, stats, make_docs
+
+@pytest.fixture
+def bulk_writes(monkeypatch):
+    calls = []
+    bulk_write = mongomock.collection.Collection.bulk_write
+
+    def counted(self, requests, *args, **kwargs):
+        requests = list(requests)
+        calls.append(requests)
+        return bulk_write(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', counted)
+    return calls
+
+def test_study_in_one_bulk_write(study, bulk_writes):
+    phantom, exam, stats, make_docs = study
+    docs = make_docs()
+    result = db.ingest_measurements(docs)
+
+    assert len(bulk_writes) == 1 and len(bulk_writes[0]) == N_SAMPLES * N_PARAMS
+    assert result.inserted_count == N_SAMPLES * N_PARAMS
+    assert db.Measurement.objects.count() == N_SAMPLES * N_PARAMS
+    assert all(doc.id is not None for doc in docs)
+
+    stored = db.Measurement.objects.get(sample=phantom.containers[3], parameter='p7')
+    assert stored.value == pytest.approx(stats['mean'][3, 7])
+    assert stored.quantification_details == {'std' : pytest.approx(stats['std'][3, 7]), 'count' : 120,
+                                             'method' : 'lm'}
+    assert stored.experiment.id == exam.id and stored.phantom.id == phantom.id
+
+def test_replace_does_not_duplicate(study, bulk_writes):
+    phantom, exam, stats, make_docs = study
+    db.ingest_measurements(make_docs())
+    db.ingest_measurements(make_docs(), replace=True)
+    db.ingest_measurements(make_docs(), replace=True)
+
+    assert len(bulk_writes) == 3
+    assert db.Measurement.objects.count() == N_SAMPLES * N_PARAMS
+    assert db.Measurement.objects(phantom=phantom, sample=phantom.containers[0], parameter='p0').count() == 1
+
+    # a different experiment is kept
+    other = db.MR_Experiment(session_date=datetime.datetime(2020, 4, 1)).save()
+    docs = make_docs()
+    for doc in docs:
+        doc.experiment = other
+    db.ingest_measurements(docs, replace=True)
+    assert db.Measurement.objects.count() == 2 * N_SAMPLES * N_PARAMS
+
+def test_experiment_date_from_clean(study):
+    phantom, exam, stats, make_docs = study
+    db.ingest_measurements(make_docs())
+    dates = set(mm.experiment_date for mm in db.Measurement.objects)
+    assert dates == {exam.session_date}
+
+    newer = db.Measurement.objects(phantom=phantom, parameter='p2',
+                                   experiment_date__gte=datetime.datetime(2020, 1, 1))
+    assert newer.count() == N_SAMPLES
+
+def test_compound_indexes(mock_db):
+    db.ensure_indexes()
+    keys = [tuple(name for name, direction in info['key'])
+            for info in db.Measurement._get_collection().index_information().values()]
+    assert ('phantom', 'sample', 'parameter', 'experiment_date') in keys
+    assert ('experiment', 'parameter') in keys
+
+def test_nothing_to_ingest(mock_db):
+    assert db.ingest_measurements([]) is None
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+from pyqmri.signal_models import gre_3dute
+
+UTES = np.array([0.1, 0.5, 1.0, 2.0, 3.5, 5.0, 8.0])
+FAS = np.deg2rad([2.0, 5.0, 10.0, 15.0, 25.0])
+
+def numerical_jac(model, params, eps=1e-6):
+    """Central differences of model(params) -> (n, n_obs), w.r.t. each column of params"""
+    cols = []
+    for pi in range(params.shape[1]):
+        step = eps * np.maximum(np.abs(params[:, pi]), 1.0)
+        hi, lo = params.copy(), params.copy()
+        hi[:, pi] += step
+        lo[:, pi] -= step
+        cols.append((model(hi) - model(lo)) / (2.0 * step[:, None]))
+    return np.stack(cols, axis=-1)
+
+rng = np.random.default_rng(0)
+JAC_CASES = {
+    'mag' : (lambda p: gre_3dute.T2str_mag_simplified_batch(p, UTES),
+             lambda p: gre_3dute.T2str_mag_simplified_jac(p, UTES),
+             np.stack((rng.uniform(0.5, 6.0, 20), rng.uniform(100, 1000, 20), rng.uniform(0, 20, 20)), axis=1)),
+    'power' : (lambda p: gre_3dute.T2str_power_batch(p, UTES),
+               lambda p: gre_3dute.T2str_power_jac(p, UTES),
+               np.stack((rng.uniform(0.5, 6.0, 20), rng.uniform(1e3, 1e5, 20)), axis=1)),
+    'cplx' : (lambda p: gre_3dute.T2str_cplx_batch(p, UTES),
+              lambda p: gre_3dute.T2str_cplx_jac(p, UTES),
+              np.stack((rng.uniform(0.5, 6.0, 20), rng.uniform(100, 1000, 20),
+                        rng.uniform(-0.1, 0.1, 20), rng.uniform(-np.pi, np.pi, 20)), axis=1)),
+    'spgr' : (lambda p: gre_3dute.spgr_mag_batch(p, 5.0, 0.1, FAS),
+              lambda p: gre_3dute.spgr_mag_jac(p, 5.0, 0.1, FAS),
+              np.stack((rng.uniform(100, 1000, 20), rng.uniform(200, 2000, 20), rng.uniform(0.5, 6.0, 20)), axis=1)),
+    'T1' : (lambda p: gre_3dute.T1_mag_batch(p, 5.0, FAS),
+            lambda p: gre_3dute.T1_mag_jac(p, 5.0, FAS),
+            np.stack((rng.uniform(100, 1000, 20), rng.uniform(200, 2000, 20)), axis=1)),
+}
+
+@pytest.mark.parametrize('case', sorted(JAC_CASES))
+def test_analytic_jacobians(case):
+    model, jac, params = JAC_CASES[case]
+    J = jac(params)
+    assert J.shape == model(params).shape + (params.shape[1],)
+    np.testing.assert_allclose(J, numerical_jac(model, params), rtol=1e-5, atol=1e-6 * np.max(np.abs(J)))
+
+def test_batch_matches_scalar_models():
+    params = JAC_CASES['mag'][2]
+    expected = [gre_3dute.T2str_mag_simplified(K, UTES, T2, N) for T2, K, N in params]
+    np.testing.assert_allclose(gre_3dute.T2str_mag_simplified_batch(params, UTES), expected)
+
+    params = JAC_CASES['cplx'][2]
+    expected = [gre_3dute.T2str_cplx(K, UTES, T2, df, phi) for T2, K, df, phi in params]
+    np.testing.assert_allclose(gre_3dute.T2str_cplx_batch(params, UTES), expected)
+
+def test_single_voxel_jacobians_match_residuals():
+    params = JAC_CASES['mag'][2][0]
+    obs = gre_3dute.T2str_mag_simplified_batch(params, UTES) + 1.0
+    res = lambda p: gre_3dute.t2strw_mag_resid(p[0], UTES, obs)[None]
+    np.testing.assert_allclose(gre_3dute.t2strw_mag_jac(params, UTES, obs),
+                               numerical_jac(res, params[None])[0], rtol=1e-5)
+
+def mono_exp_stack(T2str, K, utes, N=0.0):
+    """[echo, ...] mono-exponential decays of T2str & K maps"""
+    TE = np.asarray(utes).reshape((-1,) + (1,) * np.ndim(T2str))
+    return K * np.exp(-TE / T2str) + N
+
+# unevenly spaced echoes dense enough for the trapezoid integrals of ARLO
+UTES_DENSE = np.array([0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.65, 0.8, 1.0, 1.25, 1.5, 1.8, 2.2, 2.6, 3.0])
+
+@pytest.mark.parametrize('utes', [UTES_DENSE, np.linspace(0.2, 4.2, 11)], ids=['uneven', 'even'])
+@pytest.mark.parametrize('estimator', [gre_3dute.calc_T2str_loglinear, gre_3dute.calc_T2str_ARLO])
+def test_closed_form_T2str_exact(estimator, utes):
+    rng = np.random.default_rng(1)
+    T2str = rng.uniform(0.5, 6.0, (4, 5))
+    K = rng.uniform(100, 1000, (4, 5))
+    est_T2str, est_K = estimator(mono_exp_stack(T2str, K, utes), utes)
+
+    # ARLO integrates numerically: exact up to the quadrature error
+    rtol = 1e-10 if estimator is gre_3dute.calc_T2str_loglinear else 0.02
+    np.testing.assert_allclose(est_T2str, T2str, rtol=rtol)
+    np.testing.assert_allclose(est_K, K, rtol=rtol)
+
+def test_ARLO_even_echoes_accuracy():
+    utes = np.linspace(0.1, 4.1, 21)
+    T2str = np.array([1.0, 2.0, 4.0])
+    est_T2str, est_K = gre_3dute.calc_T2str_ARLO(mono_exp_stack(T2str, 100.0, utes), utes)
+    np.testing.assert_allclose(est_T2str, T2str, rtol=1e-3)
+
+def test_closed_form_T2str_axis_and_invalid():
+    T2str = np.array([[1.0, 2.0], [3.0, 4.0]])
+    stack = mono_exp_stack(T2str, 100.0, UTES)
+    stack[:, 1, 1] = 50.0                 # no decay
+    stack[:, 0, 1] = -1.0                 # no positive signal
+    for estimator in (gre_3dute.calc_T2str_loglinear, gre_3dute.calc_T2str_ARLO):
+        est_T2str, est_K = estimator(np.moveaxis(stack, 0, -1), UTES, axis=-1)
+        np.testing.assert_allclose(est_T2str[:, 0], T2str[:, 0], rtol=0.05)
+        assert np.all(np.isnan(est_T2str[:, 1])) and np.all(np.isnan(est_K[:, 1]))
+
+def test_loglinear_noise_offset():
+    T2str = np.array([1.5, 3.0])
+    stack = mono_exp_stack(T2str, 200.0, UTES, N=20.0)
+    est_T2str, est_K = gre_3dute.calc_T2str_loglinear(stack, UTES, noise_offset=20.0)
+    np.testing.assert_allclose(est_T2str, T2str, rtol=1e-10)
+    np.testing.assert_allclose(est_K, 200.0, rtol=1e-10)
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_VFA_T1_exact(weighted):
+    rng = np.random.default_rng(2)
+    T1 = rng.uniform(200.0, 2000.0, (3, 4))
+    M0 = rng.uniform(100.0, 1000.0, (3, 4))
+    b1 = rng.uniform(0.8, 1.2, (3, 4))
+    TR = 5.0
+    alph = FAS.reshape(-1, 1, 1) * b1
+    S = gre_3dute.T1_mag(M0, T1, TR, alph)
+
+    est_T1, est_M0 = gre_3dute.calc_VFA_T1_linear(S, FAS, TR, b1=b1, weighted=weighted)
+    np.testing.assert_allclose(est_T1, T1, rtol=1e-8)
+    np.testing.assert_allclose(est_M0, M0, rtol=1e-8)
+
+    # without the B1 map the nominal angles are wrong, and so is T1
+    est_T1, est_M0 = gre_3dute.calc_VFA_T1_linear(S, FAS, TR, weighted=weighted)
+    assert np.max(np.abs(est_T1 / T1 - 1.0)) > 0.05
+
+def test_VFA_T1_two_angles_match_closed_form():
+    T1 = np.array([300.0, 900.0, 1500.0])
+    S = gre_3dute.T1_mag(500.0, T1, 5.0, FAS[[1, 3], None])
+    est_T1, est_M0 = gre_3dute.calc_VFA_T1_linear(S, FAS[[1, 3]], 5.0)
+    np.testing.assert_allclose(est_T1, gre_3dute.calc_VFA_T1(S[0], S[1], FAS[1], FAS[3], 5.0), rtol=1e-8)
+    np.testing.assert_allclose(est_T1, T1, rtol=1e-8)
+
+def test_VFA_T1_weighted_noise_and_invalid():
+    rng = np.random.default_rng(3)
+    T1 = np.full(2000, 1000.0)
+    S = gre_3dute.T1_mag(1000.0, T1, 5.0, FAS[:, None]) + rng.normal(0.0, 0.5, (FAS.size, T1.size))
+    plain, _ = gre_3dute.calc_VFA_T1_linear(S, FAS, 5.0)
+    weighted, _ = gre_3dute.calc_VFA_T1_linear(S, FAS, 5.0, weighted=True)
+    assert abs(np.median(weighted) - 1000.0) < 20.0
+    assert np.std(weighted) <= np.std(plain)
+
+    # a signal that grows like sin(a) has no T1 weighting (E1 = 0): NaN
+    flat = 100.0 * np.sin(FAS)[:, None] * np.ones((1, 2))
+    est_T1, est_M0 = gre_3dute.calc_VFA_T1_linear(flat, FAS, 5.0)
+    assert np.all(np.isnan(est_T1)) and np.all(np.isnan(est_M0))
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRBigEndian, ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from pyqmri.img_utils import loaders
+from pyqmri.img_utils.dicom_index import DICOMIndex
+
+def write_slice(fname, raw, zi, te=1.0, bits_stored=12, signed=False, big_endian=False):
+    """Write one uncompressed MR slice; raw holds the 16-bit words as stored (unused high bits included)"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRBigEndian if big_endian else ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.EchoTime = te
+    ds.RepetitionTime = 10.0
+    ds.FlipAngle = 15.0
+    ds.Rows, ds.Columns = raw.shape
+    ds.PixelSpacing = [1.0, 1.0]
+    ds.SliceThickness = 2.0
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [0, 0, 2.0 * zi]
+    ds.InstanceNumber = zi + 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 1 if signed else 0
+    ds.PixelData = raw.astype('>u2' if big_endian else '<u2').tobytes()
+    ds.save_as(fname, enforce_file_format=True)
+
+def write_series(dirname, bits_stored=12, signed=False, big_endian=False, nz=3, seed=0):
+    rng = np.random.default_rng(seed)
+    fnames = []
+    for zi in range(nz):
+        # garbage in the unused high bits, and the full range of the stored bits
+        raw = rng.integers(0, 1 << 16, (6, 5)).astype(np.uint16)
+        if signed:
+            raw[0, :2] = [0x0FFB, 0xF800]  # -5 & -2048 (12 bit two's complement)
+        else:
+            raw[0, :2] = [0xF123, 0x0FFF]  # 291 & 4095
+        fname = os.path.join(dirname, 'slice_{:d}.dcm'.format(zi))
+        write_slice(fname, raw, zi, bits_stored=bits_stored, signed=signed, big_endian=big_endian)
+        fnames.append(fname)
+    return fnames
+
+@pytest.mark.parametrize('signed', [False, True])
+@pytest.mark.parametrize('big_endian', [False, True])
+def test_stored_bits_match_pydicom(tmp_path, signed, big_endian):
+    fnames = write_series(str(tmp_path), signed=signed, big_endian=big_endian)
+    expected = np.stack([pydicom.dcmread(fname).pixel_array for fname in fnames])
+
+    hdr = loaders._read_DICOM_header(fnames[0])
+    assert hdr['pixel_offset'] is not None and hdr['pixel_bits'] == 12
+
+    vol, _ = loaders.load_DICOM_from_dcm_list(fnames)
+    np.testing.assert_array_equal(vol[0], expected)
+
+    slabs = [slab for _, _, slab in loaders.iter_DICOM_slabs(fnames, slab_size=2)]
+    np.testing.assert_array_equal(np.concatenate(slabs, axis=1)[0], expected)
+
+    with DICOMIndex(str(tmp_path / 'index.sqlite')) as index:
+        for _ in range(2):  # parsed, then looked up
+            vol, _ = loaders.load_DICOM_from_dcm_list(fnames, index=index)
+            np.testing.assert_array_equal(vol[0], expected)
+
+    if signed:
+        assert expected[0, 0, 0] == -5 and expected[0, 0, 1] == -2048
+    else:
+        assert expected[0, 0, 0] == 291 and expected[0, 0, 1] == 4095
+
+def test_headers_without_stored_bits_use_pydicom(tmp_path):
+    fnames = write_series(str(tmp_path), signed=True, nz=1)
+    hdr = loaders._read_DICOM_header(fnames[0])
+    del hdr['pixel_bits']  # indexed by an older version
+    np.testing.assert_array_equal(loaders._read_pixels(hdr), pydicom.dcmread(fnames[0]).pixel_array)
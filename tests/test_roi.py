@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from pyqmri.phantom_util import roi as ru
+
+GRID = (24, 20, 16, 0.7, 0.9, 1.3)  # nx, ny, nz, dx, dy, dz
+
+def dense_cylinder(cyl, nx, ny, nz, dx, dy, dz, axis=2):
+    """Reference mask on the full grid (the original CylinderROI.generate_mask)"""
+    xg, yg, zg = np.meshgrid(np.arange(nx) * dx, np.arange(ny) * dy, np.arange(nz) * dz, indexing='ij')
+    cc = {'x' : (xg, cyl.cx), 'y' : (yg, cyl.cy), 'z' : (zg, cyl.cz)}
+    along = 'xyz'[axis]
+    (ga, ca), (gb, cb) = [cc[ax] for ax in 'xyz' if ax != along]
+    gz, cz = cc[along]
+    roi_mask = np.power(ga - ca, 2) + np.power(gb - cb, 2) <= np.power(cyl.rd, 2)
+    roi_mask = np.logical_and(roi_mask, gz >= cz - (cyl.ht/2))
+    roi_mask = np.logical_and(roi_mask, gz <= cz + (cyl.ht/2))
+    return np.float32(roi_mask)
+
+CYLINDERS = [ru.CylinderROI(8.0, 9.0, 10.0, 8.0, 4.0),
+             ru.CylinderROI(0.5, 17.5, 19.0, 6.0, 3.5),    # clipped by the volume
+             ru.CylinderROI(6.3, 6.3, 6.5, 1.3, 1.26),     # edges on grid points
+             ru.CylinderROI(100.0, 9.0, 10.0, 8.0, 4.0)]   # outside: empty
+
+@pytest.mark.parametrize('axis', [0, 1, 2])
+@pytest.mark.parametrize('ci', range(len(CYLINDERS)))
+def test_sparse_mask_matches_dense(ci, axis):
+    cyl = CYLINDERS[ci]
+    ref = dense_cylinder(cyl, *GRID, axis=axis)
+    sm = cyl.generate_sparse_mask(*GRID, axis=axis)
+
+    np.testing.assert_array_equal(np.asarray(sm), ref)
+    np.testing.assert_array_equal(cyl.generate_mask(*GRID, axis=axis), ref)
+    assert np.asarray(sm).dtype == ref.dtype
+    assert sm.count == np.count_nonzero(ref)
+    assert sm.sum() == ref.sum() and sm.max() == ref.max() and sm.min() == ref.min()
+    assert sm.mean() == pytest.approx(ref.mean())
+    assert sm.any() == ref.any() and sm.all() == ref.all()
+    for got, exp in zip(sm.nonzero(), np.nonzero(ref)):
+        np.testing.assert_array_equal(got, exp)
+
+def test_reductions_and_indexing_match_dense():
+    sm = CYLINDERS[0].generate_sparse_mask(*GRID)
+    ref = np.asarray(sm)
+    for axis in (0, 1, (0, 2)):
+        np.testing.assert_array_equal(sm.sum(axis=axis), ref.sum(axis=axis))
+        np.testing.assert_array_equal(sm.max(axis=axis), ref.max(axis=axis))
+        np.testing.assert_array_equal(sm.any(axis=axis, keepdims=True), ref.any(axis=axis, keepdims=True))
+    out = np.empty(GRID[1:3], dtype=np.float32)
+    sm.sum(axis=0, out=out)
+    np.testing.assert_array_equal(out, ref.sum(axis=0))
+
+    for key in [(5, 9, 7), (slice(None), 9), (Ellipsis, 7), (slice(3, 14, 2), slice(None, None, -1), 7),
+                (-1,), (slice(None), slice(None), slice(None))]:
+        np.testing.assert_array_equal(sm[key], ref[key])
+    np.testing.assert_array_equal(sm[ref > 0], ref[ref > 0])
+
+def test_set_operations_match_dense():
+    aa = CYLINDERS[0].generate_sparse_mask(*GRID)
+    bb = ru.CylinderROI(11.0, 11.0, 8.0, 6.0, 4.0).generate_sparse_mask(*GRID)
+    da, db = np.asarray(aa) > 0, np.asarray(bb) > 0
+    empty = CYLINDERS[3].generate_sparse_mask(*GRID)
+
+    for got, exp in [(aa | bb, da | db), (aa & bb, da & db), (aa ^ bb, da ^ db),
+                     (aa.difference(bb), da & ~db), (aa | empty, da), (aa & empty, np.zeros_like(da))]:
+        assert isinstance(got, ru.SparseMask)
+        np.testing.assert_array_equal(np.asarray(got, dtype=bool), exp)
+    np.testing.assert_array_equal(~aa, ~da)
+
+    # arithmetic is dense, as with dense masks (including -1 for sparse - sparse)
+    np.testing.assert_array_equal(aa + bb, np.asarray(aa) + np.asarray(bb))
+    np.testing.assert_array_equal(aa - bb, np.asarray(aa) - np.asarray(bb))
+    np.testing.assert_array_equal(2.0 * aa, 2.0 * np.asarray(aa))
+    np.testing.assert_array_equal(sum([aa, bb]), np.asarray(aa) + np.asarray(bb))
+
+@pytest.mark.parametrize('op', ['==', '!=', '>', '>=', '<', '<='])
+@pytest.mark.parametrize('value', [0, 0.5, 1, 2])
+def test_comparisons_match_dense(op, value):
+    sm = CYLINDERS[0].generate_sparse_mask(*GRID)
+    ref = np.asarray(sm)
+    got = eval('sm {:s} value'.format(op))
+    exp = eval('ref {:s} value'.format(op))
+    assert np.asarray(got).dtype == bool
+    np.testing.assert_array_equal(np.asarray(got), exp)
+
+def test_from_dense_and_gather():
+    rng = np.random.default_rng(0)
+    ref = dense_cylinder(CYLINDERS[0], *GRID)
+    sm = ru.SparseMask.from_dense(ref)
+    np.testing.assert_array_equal(np.asarray(sm), ref)
+    assert sm.nbytes < ref.nbytes
+
+    vol = rng.normal(size=(3,) + GRID[:3][::-1])  # [echo, z, y, x]
+    # values in np.nonzero order of the [x, y, z] mask
+    np.testing.assert_array_equal(sm.gather(vol), vol.T[np.nonzero(ref)].T)
+    np.testing.assert_array_equal(vol.reshape(3, -1)[:, sm.ravel_index(order=(2, 1, 0))], sm.gather(vol))
+
+def test_label_volume():
+    masks = [CYLINDERS[0].generate_sparse_mask(*GRID), CYLINDERS[1].generate_sparse_mask(*GRID)]
+    labels = ru.label_volume(masks)
+    dense_labels = ru.label_volume([np.asarray(mm) for mm in masks])
+    np.testing.assert_array_equal(labels, dense_labels)
+    assert labels.shape == GRID[:3][::-1]
+    for mi, mm in enumerate(masks):
+        np.testing.assert_array_equal(labels.T == mi, np.asarray(mm) > 0)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from pyqmri.phantom_util.roi_stats import roi_statistics, store_roi_statistics
+
+def reference_stats(data, labels, n_labels, percentiles, ddof=0):
+    """Per-label statistics with the plain numpy reductions, one label & map at a time"""
+    out = {name: np.full((n_labels, data.shape[0]), np.nan)
+           for name in ['count', 'mean', 'std', 'median', 'min', 'max'] + ['p{:g}'.format(q) for q in percentiles]}
+    for li in range(n_labels):
+        for mi in range(data.shape[0]):
+            vals = data[mi][labels == li]
+            vals = vals[~np.isnan(vals)]
+            out['count'][li, mi] = vals.size
+            if vals.size == 0:
+                continue
+            out['mean'][li, mi] = vals.mean()
+            if vals.size > ddof:
+                out['std'][li, mi] = vals.std(ddof=ddof)
+            out['median'][li, mi] = np.percentile(vals, 50.0)
+            out['min'][li, mi] = vals.min()
+            out['max'][li, mi] = vals.max()
+            for q in percentiles:
+                out['p{:g}'.format(q)][li, mi] = np.percentile(vals, q)
+    return out
+
+@pytest.fixture
+def labelled_stack():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(-1, 6, (7, 9, 11)).astype(np.int8)
+    labels[(labels == 3) | (labels == 4)] = -1  # an empty label in the middle
+    labels[0, 0, 0] = 4                         # ...and one with a single voxel
+    data = rng.normal(100.0, 20.0, (4,) + labels.shape)
+    data[1, labels == 2] = np.round(data[1, labels == 2])  # ties
+    data[2, rng.random(labels.shape) < 0.2] = np.nan       # failed fits
+    data[3, labels == 5] = np.nan                          # a map with no valid values in a label
+    return data, labels
+
+@pytest.mark.parametrize('ddof', [0, 1])
+def test_roi_statistics_match_numpy(labelled_stack, ddof):
+    data, labels = labelled_stack
+    percentiles = (5.0, 25.0, 62.5, 75.0, 99.0)
+    stats = roi_statistics(data, labels, n_labels=7, percentiles=percentiles, ddof=ddof)
+    ref = reference_stats(data, labels, 7, percentiles, ddof=ddof)
+
+    assert set(stats) == set(ref)
+    for name in ref:
+        assert stats[name].shape == (7, 4)
+        np.testing.assert_allclose(stats[name], ref[name], rtol=1e-12, atol=1e-9, err_msg=name)
+    assert stats['count'].dtype.kind == 'i'
+
+def test_roi_statistics_single_map_and_axis(labelled_stack):
+    data, labels = labelled_stack
+    single = roi_statistics(data[0], labels)
+    stacked = roi_statistics(np.moveaxis(data, 0, -1), labels, axis=-1)
+    full = roi_statistics(data, labels)
+    for name in full:
+        np.testing.assert_array_equal(single[name], full[name][:, 0])
+        np.testing.assert_array_equal(stacked[name], full[name])
+
+def test_roi_statistics_keep_nan(labelled_stack):
+    data, labels = labelled_stack
+    stats = roi_statistics(data, labels, ignore_nan=False)
+    has_nan = np.array([[np.isnan(data[mi][labels == li]).any() for mi in range(4)] for li in range(6)])
+    assert np.all(np.isnan(stats['mean'][has_nan]))
+    np.testing.assert_allclose(stats['mean'][~has_nan],
+                               roi_statistics(data, labels)['mean'][~has_nan])
+
+def test_roi_statistics_errors_and_store(labelled_stack):
+    data, labels = labelled_stack
+    with pytest.raises(Exception):
+        roi_statistics(data[:, 1:], labels)
+
+    stats = roi_statistics(data[0], labels)
+    roi_info = [{} for _ in range(stats['count'].size)]
+    store_roi_statistics(roi_info, stats)
+    assert roi_info[2]['stats']['mean'] == stats['mean'][2]